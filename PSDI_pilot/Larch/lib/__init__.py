@@ -0,0 +1,6 @@
+# modules of the larch_workflow library shared with the pilot (the records
+# of athena projects, lib/athena_records.py) are imported from its
+# directory, after the modules of the pilot
+from pathlib import Path
+
+__path__.append(str(Path(__file__).resolve().parents[3] / 'larch_workflow' / 'lib'))
@@ -11,6 +11,16 @@ from larch.xafs import xftf
 # plotting library
 import matplotlib.pyplot as plt
 
+# read the files in threads and parse the projects in processes
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import gzip
+import os
+from larch.utils.strutils import bytes2str
+# build the projects from their text as read_athena does
+import lib.athena_records as athena_records
+# copies of the projects of repeated files
+import copy
+
  #######################################################
 # |         Read data from Athena project file        | #
 # V              returns a project object             V #
@@ -18,6 +28,56 @@ import matplotlib.pyplot as plt
 def read_project(project_file):
     return read_athena(project_file)
 
+# text of an athena project file, as read_athena reads it (gzip.decompress
+# releases the GIL, so the files are decompressed in threads)
+def _read_project_text(project_file):
+    with open(project_file, 'rb') as prj_file:
+        raw = prj_file.read()
+    if raw[:2] == b'\x1f\x8b':
+        return bytes2str(gzip.decompress(raw))
+    with open(project_file, 'r') as prj_file:
+        return prj_file.read()
+
+ #######################################################
+# |       Read data from many Athena project files    | #
+# | project_files: list of project files              | #
+# | workers: processes parsing the projects (None for | #
+# |          all cpus, 1 parses them in this process) | #
+# | read_threads: threads reading and decompressing   | #
+# |          the files while the projects are parsed  | #
+# V returns the projects in the order of the list     V #
+ #######################################################
+def read_projects(project_files, workers=None, read_threads=4):
+    # each file is read once even if it is in the list more than once
+    unique_files = list(dict.fromkeys(str(prj_file) for prj_file in project_files))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(unique_files)))
+    projects = {}
+    # each project is parsed as soon as its file is decompressed, while
+    # the other files are still read
+    with ThreadPoolExecutor(max_workers=max(1, read_threads)) as readers:
+        texts = {readers.submit(_read_project_text, prj_file): prj_file
+                 for prj_file in unique_files}
+        if workers == 1:
+            for text in as_completed(texts):
+                projects[texts[text]] = athena_records.read_text(texts[text], text.result())
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as parsers:
+                parsed = {texts[text]: parsers.submit(athena_records.read_text, texts[text],
+                                                         text.result())
+                          for text in as_completed(texts)}
+                projects = {prj_file: athena_project.result()
+                            for prj_file, athena_project in parsed.items()}
+    # the projects of a file repeated in the list are copies, so their
+    # groups can be changed separately
+    loaded = []
+    for prj_file in project_files:
+        athena_project = projects[str(prj_file)]
+        loaded.append(athena_project if not any(athena_project is a_prj for a_prj in loaded)
+                      else copy.deepcopy(athena_project))
+    return loaded
+
  #######################################################
 # |         Extract groups from Athena project        | #
 # V              returns a list of groups             V #
@@ -0,0 +1,194 @@
+# Catalogue of the Athena projects in a directory tree
+#
+# The athena groups files (pub_037_athena.csv) point to groups by project
+# file and label, and finding a group means opening and decompressing each
+# project. The catalogue records the groups of all the projects under a
+# directory in a local sqlite database, so the groups can be found by
+# label or by their properties without opening the projects.
+#
+# The projects are indexed in parallel, only the label and parameters of
+# each group and the first and last energy values are decoded. When the
+# catalogue is updated only the projects that changed (size, modification
+# time and then hash of the file) are indexed again and the projects
+# removed from the directory are removed from the catalogue.
+#
+# build_catalogue: creates or updates the catalogue of a directory tree.
+# find_groups: groups matching a label, name, element, edge or e0 range.
+# project_groups: groups of a project file.
+#
+# The catalogue of a directory can be created or updated with:
+#   python -m lib.project_catalogue <directory> [catalogue.db] [workers]
+
+# index the projects in parallel
+from concurrent.futures import ProcessPoolExecutor
+# hash of the project files
+import hashlib
+import os
+import sqlite3
+import sys
+from contextlib import closing
+# File handling
+from pathlib import Path
+
+# records of the groups of a project
+import lib.athena_records as athena_records
+
+CATALOGUE_FILE = 'athena_catalogue.db'
+PROJECT_PATTERN = '*.prj'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT,
+    n_groups INTEGER, error TEXT);
+CREATE TABLE IF NOT EXISTS groups (
+    path TEXT, position INTEGER, name TEXT, label TEXT, athena_key TEXT,
+    atsym TEXT, edge TEXT, e0 REAL, e_min REAL, e_max REAL, n_points INTEGER);
+CREATE INDEX IF NOT EXISTS groups_path ON groups (path);
+CREATE INDEX IF NOT EXISTS groups_label ON groups (label);
+CREATE INDEX IF NOT EXISTS groups_name ON groups (name);
+CREATE INDEX IF NOT EXISTS groups_e0 ON groups (e0);
+"""
+GROUP_COLUMNS = ('path', 'position', 'name', 'label', 'athena_key', 'atsym', 'edge',
+                 'e0', 'e_min', 'e_max', 'n_points')
+
+
+# index of a project file, the groups are not read if the hash of the
+# file is known_hash (the project has not changed)
+def _index_project(task):
+    path, known_hash = task
+    file_hash = None
+    try:
+        with open(path, 'rb') as prj_file:
+            raw = prj_file.read()
+        file_hash = hashlib.sha256(raw).hexdigest()
+        if file_hash == known_hash:
+            return path, file_hash, None, None
+        _, records = athena_records.project_records(athena_records.project_text(raw))
+        # columns of the groups table (athena_key is the key of the record)
+        groups = [dict({column: record.get(column) for column in GROUP_COLUMNS[2:]},
+                       athena_key=record['key']) for record in records]
+        return path, file_hash, groups, None
+    except Exception as index_error:
+        return path, file_hash, [], str(index_error)
+
+def _connect(catalogue_file):
+    connection = sqlite3.connect(str(catalogue_file))
+    connection.row_factory = sqlite3.Row
+    connection.executescript(_SCHEMA)
+    return connection
+
+ #######################################################
+# |     Create or update the catalogue of projects    | #
+# | root_dir: directory with the athena projects      | #
+# |           (subdirectories included)               | #
+# | catalogue_file: sqlite database (created in       | #
+# |           root_dir if None)                       | #
+# | workers: processes indexing the projects (None    | #
+# |          for all cpus, 1 indexes in this process) | #
+# | pattern: pattern of the project files             | #
+# V returns the number of projects indexed, unchanged V #
+# V and removed                                       V #
+ #######################################################
+def build_catalogue(root_dir, catalogue_file=None, workers=None, pattern=PROJECT_PATTERN):
+    root_dir = Path(root_dir)
+    if catalogue_file is None:
+        catalogue_file = root_dir / CATALOGUE_FILE
+    files = {str(prj_file.resolve()): prj_file.stat()
+             for prj_file in sorted(root_dir.rglob(pattern)) if prj_file.is_file()}
+    with closing(_connect(catalogue_file)) as connection, connection:
+        known = {row['path']: row for row in connection.execute("SELECT * FROM projects")}
+        removed = [path for path in known if path not in files]
+        # projects with the same size and modification time are not read,
+        # the others are read and indexed if their hash changed
+        tasks = []
+        for path, stat in files.items():
+            row = known.get(path)
+            if row is None:
+                tasks.append((path, None))
+            elif row['size'] != stat.st_size or row['mtime'] != stat.st_mtime:
+                tasks.append((path, row['hash']))
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(tasks)))
+        if workers == 1:
+            results = map(_index_project, tasks)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = executor.map(_index_project, tasks, chunksize=max(1, len(tasks) // (4*workers)))
+
+        indexed = 0
+        try:
+            for path, file_hash, groups, index_error in results:
+                stat = files[path]
+                if groups is None:
+                    # same content, only the modification time changed
+                    connection.execute("UPDATE projects SET size=?, mtime=? WHERE path=?",
+                                       (stat.st_size, stat.st_mtime, path))
+                    continue
+                indexed += 1
+                connection.execute("DELETE FROM groups WHERE path=?", (path,))
+                connection.execute("INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?, ?, ?)",
+                                   (path, stat.st_size, stat.st_mtime, file_hash,
+                                    len(groups), index_error))
+                connection.executemany(
+                    "INSERT INTO groups VALUES (" + ', '.join('?'*len(GROUP_COLUMNS)) + ")",
+                    [(path, position) + tuple(a_group[column] for column in GROUP_COLUMNS[2:])
+                     for position, a_group in enumerate(groups)])
+        finally:
+            if workers > 1:
+                executor.shutdown()
+        for path in removed:
+            connection.execute("DELETE FROM groups WHERE path=?", (path,))
+            connection.execute("DELETE FROM projects WHERE path=?", (path,))
+    return indexed, len(files) - len(tasks), len(removed)
+
+ #######################################################
+# |       Find groups in the catalogue of projects    | #
+# | catalogue_file: sqlite database (build_catalogue) | #
+# | label: athena label or group name (as read_athena)| #
+# | atsym, edge: element and edge                     | #
+# | e0_min, e0_max: range of e0                       | #
+# | path: text in the path of the project             | #
+# V returns a list of dictionaries (GROUP_COLUMNS)    V #
+ #######################################################
+def find_groups(catalogue_file, label=None, atsym=None, edge=None, e0_min=None, e0_max=None,
+                path=None):
+    conditions, values = [], []
+    if label is not None:
+        conditions.append("(label = ? OR name = ?)")
+        values += [label, label]
+    for column, value in (('atsym', atsym), ('edge', edge)):
+        if value is not None:
+            conditions.append(column + " = ?")
+            values.append(value)
+    if e0_min is not None:
+        conditions.append("e0 >= ?")
+        values.append(e0_min)
+    if e0_max is not None:
+        conditions.append("e0 <= ?")
+        values.append(e0_max)
+    if path is not None:
+        conditions.append("instr(path, ?) > 0")
+        values.append(path)
+    query = "SELECT * FROM groups"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    with closing(_connect(catalogue_file)) as connection:
+        return [dict(row) for row in
+                connection.execute(query + " ORDER BY path, position", values)]
+
+# groups of a project file (in the order of the project)
+def project_groups(catalogue_file, project_file):
+    with closing(_connect(catalogue_file)) as connection:
+        return [dict(row) for row in connection.execute(
+            "SELECT * FROM groups WHERE path = ? ORDER BY position",
+            (str(Path(project_file).resolve()),))]
+
+# create or update the catalogue of a directory
+if __name__ == '__main__':
+    catalogue_dir = sys.argv[1]
+    db_file = sys.argv[2] if len(sys.argv) > 2 else None
+    n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    print("indexed %i, unchanged %i, removed %i projects" %
+          build_catalogue(catalogue_dir, db_file, n_workers))
@@ -0,0 +1,28 @@
+# Fixtures shared by the tests of the pilot library (lib)
+#
+# The tests use the athena projects of the other workflows in the
+# repository. Run from the PSDI_pilot/Larch directory with:
+#   python -m pytest tests
+
+# File handling
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+PILOT_DIR = Path(__file__).resolve().parent.parent
+REPO_DIR = PILOT_DIR.parent.parent
+PROJECT_FILES = [REPO_DIR / 'basic_workflow' / 'FeS2_01.prj',
+                 REPO_DIR / 'demeter_workflow' / 'FeS2.prj',
+                 REPO_DIR / 'larch_workflow' / 'fes2_larch.prj']
+
+# the library is imported as lib (as the notebook does)
+sys.path.insert(0, str(PILOT_DIR))
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+
+@pytest.fixture(scope='session')
+def project_files():
+    return [str(prj_file) for prj_file in PROJECT_FILES]
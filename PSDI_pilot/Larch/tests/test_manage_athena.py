@@ -0,0 +1,76 @@
+# Reading many athena projects (lib/manage_athena.py read_projects)
+
+import numpy as np
+import pytest
+from larch.io import read_athena
+
+import lib.athena_records as athena_records
+import lib.manage_athena as athenamgr
+
+
+# members of a group (values of the nested groups), without the names
+def group_values(a_group):
+    return {member: group_values(value) if hasattr(value, '__dict__') else value
+            for member, value in vars(a_group).items() if not member.startswith('__')}
+
+# check that two groups read from a project have the same members
+def assert_same_group(group, expected):
+    for member, value in vars(expected).items():
+        if member.startswith('__'):
+            continue
+        assert hasattr(group, member), member
+        if isinstance(value, np.ndarray):
+            np.testing.assert_array_equal(getattr(group, member), value, err_msg=member)
+        elif member == 'athena_params':
+            assert group_values(group.athena_params) == group_values(value)
+        elif not hasattr(value, '__dict__'):
+            assert getattr(group, member) == value, member
+
+@pytest.mark.parametrize('workers, read_threads', [(1, 1), (1, 3), (2, 2)])
+def test_read_projects_matches_read_athena(project_files, workers, read_threads):
+    projects = athenamgr.read_projects(project_files, workers=workers, read_threads=read_threads)
+    assert len(projects) == len(project_files)
+    for prj_file, project in zip(project_files, projects):
+        expected = read_athena(prj_file)
+        assert list(project._athena_groups) == list(expected._athena_groups)
+        for group_name, expected_group in expected._athena_groups.items():
+            assert_same_group(project._athena_groups[group_name], expected_group)
+
+def test_repeated_files_are_copies(project_files):
+    projects = athenamgr.read_projects([project_files[0], project_files[0]], workers=1)
+    first, second = projects
+    assert first is not second
+    group_name = list(first._athena_groups)[0]
+    first._athena_groups[group_name].mu[:] = 0
+    assert second._athena_groups[group_name].mu.any()
+
+def test_projects_are_parsed_from_the_text_read(project_files):
+    # the project is parsed from the text given, not read again from the file
+    text = athenamgr._read_project_text(project_files[1])
+    project = athena_records.read_text(project_files[0], text)
+    expected = read_athena(project_files[1])
+    assert list(project._athena_groups) == list(expected._athena_groups)
+    assert list(read_athena(project_files[0])._athena_groups) != list(expected._athena_groups)
+
+# text of a perl project with the groups of all the projects, in order
+def combined_project(project_files, order):
+    header, tail, blocks = None, None, []
+    for prj_file in project_files:
+        text = athena_records.read_project_text(prj_file)
+        start = text.index('$old_group')
+        end = text.index('\n', text.index('[record]')) + 1
+        if header is None:
+            header, tail = text[:start], text[end:]
+        blocks.append(text[start:end])
+    return header + ''.join(blocks[i_block] for i_block in order) + tail
+
+@pytest.mark.parametrize('order', [(0, 1, 2), (2, 0, 1)])
+def test_groups_of_a_project_keep_their_arrays(project_files, tmp_path, order):
+    prj_file = tmp_path / 'combined.prj'
+    prj_file.write_text(combined_project(project_files, order))
+    expected = read_athena(str(prj_file))
+    project = athenamgr.read_projects([prj_file], workers=1)[0]
+    assert len(expected._athena_groups) == 3
+    assert list(project._athena_groups) == list(expected._athena_groups)
+    for group_name, expected_group in expected._athena_groups.items():
+        assert_same_group(project._athena_groups[group_name], expected_group)
@@ -0,0 +1,97 @@
+# Tests of the catalogue of athena projects (lib/project_catalogue.py)
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from larch.io import read_athena
+
+import lib.project_catalogue as catalogue
+
+
+# directory tree with the repository projects (one in a subdirectory), a
+# project in the json format and a file that is not a project
+@pytest.fixture
+def project_tree(tmp_path, project_files):
+    (tmp_path / 'sub').mkdir()
+    copies = [tmp_path / 'basic.prj', tmp_path / 'sub' / 'demeter.prj', tmp_path / 'larch.prj']
+    for prj_file, copy_file in zip(project_files, copies):
+        shutil.copy(prj_file, copy_file)
+    json_project = {'_____header1': '# Athena project file -- Larch', '_____journal': '',
+                    '_____order': ['abc'],
+                    'abc': {'args': {'label': 'Fe foil', 'atsym': 'Fe', 'edge': 'K',
+                                     'bkg_e0': 7112.0},
+                            'x': [7000.0, 7100.0, 7200.0, 7300.0], 'y': [0.0, 0.1, 1.0, 1.1]}}
+    (tmp_path / 'sub' / 'json.prj').write_text(json.dumps(json_project))
+    (tmp_path / 'broken.prj').write_text('not a project')
+    return tmp_path
+
+def test_groups_match_read_athena(project_tree):
+    catalogue_file = project_tree / 'catalogue.db'
+    assert catalogue.build_catalogue(project_tree, catalogue_file, workers=1) == (5, 0, 0)
+    for prj_file in ('basic.prj', 'sub/demeter.prj', 'larch.prj'):
+        project = read_athena(str(project_tree / prj_file))
+        groups = catalogue.project_groups(catalogue_file, project_tree / prj_file)
+        assert [a_group['name'] for a_group in groups] == list(project._athena_groups.keys())
+        for a_group in groups:
+            athena_group = project._athena_groups[a_group['name']]
+            assert a_group['label'] == athena_group.label
+            assert a_group['athena_key'] == athena_group.athena_params.id
+            assert a_group['n_points'] == len(athena_group.energy)
+            assert np.isclose(a_group['e_min'], athena_group.energy[0])
+            assert np.isclose(a_group['e_max'], athena_group.energy[-1])
+            # e0 written as a number without quotes by Demeter
+            assert np.isclose(a_group['e0'], athena_group.athena_params.bkg.e0)
+
+def test_json_and_invalid_projects(project_tree):
+    catalogue_file = project_tree / 'catalogue.db'
+    catalogue.build_catalogue(project_tree, catalogue_file, workers=1)
+    json_groups = catalogue.project_groups(catalogue_file, project_tree / 'sub' / 'json.prj')
+    assert len(json_groups) == 1
+    assert json_groups[0]['name'] == 'Fe_foil' and json_groups[0]['athena_key'] == 'abc'
+    assert (json_groups[0]['atsym'], json_groups[0]['edge'], json_groups[0]['e0']) == \
+        ('Fe', 'K', 7112.0)
+    assert (json_groups[0]['e_min'], json_groups[0]['e_max'], json_groups[0]['n_points']) == \
+        (7000.0, 7300.0, 4)
+    assert catalogue.project_groups(catalogue_file, project_tree / 'broken.prj') == []
+
+def test_find_groups(project_tree):
+    catalogue_file = project_tree / 'catalogue.db'
+    catalogue.build_catalogue(project_tree, catalogue_file, workers=1)
+    all_groups = catalogue.find_groups(catalogue_file)
+    sn_groups = catalogue.find_groups(catalogue_file, atsym='Sn', edge='K')
+    assert 0 < len(sn_groups) < len(all_groups)
+    assert all(a_group['atsym'] == 'Sn' for a_group in sn_groups)
+    in_range = catalogue.find_groups(catalogue_file, e0_min=7100, e0_max=7130)
+    assert in_range and all(7100 <= a_group['e0'] <= 7130 for a_group in in_range)
+    first = all_groups[0]
+    for label in (first['label'], first['name']):
+        assert first in catalogue.find_groups(catalogue_file, label=label)
+    in_sub = catalogue.find_groups(catalogue_file, path=os.sep + 'sub' + os.sep)
+    assert in_sub and all(os.sep + 'sub' + os.sep in a_group['path'] for a_group in in_sub)
+
+def test_update(project_tree):
+    catalogue_file = project_tree / 'catalogue.db'
+    catalogue.build_catalogue(project_tree, catalogue_file, workers=1)
+    assert catalogue.build_catalogue(project_tree, catalogue_file, workers=1) == (0, 5, 0)
+    # only the modification time changed: the project is not indexed again
+    os.utime(project_tree / 'basic.prj', (1e9, 1e9))
+    assert catalogue.build_catalogue(project_tree, catalogue_file, workers=1) == (0, 4, 0)
+    # changed and removed projects
+    shutil.copy(project_tree / 'larch.prj', project_tree / 'basic.prj')
+    (project_tree / 'sub' / 'demeter.prj').unlink()
+    assert catalogue.build_catalogue(project_tree, catalogue_file, workers=1) == (1, 3, 1)
+    assert catalogue.project_groups(catalogue_file, project_tree / 'sub' / 'demeter.prj') == []
+    basic = catalogue.project_groups(catalogue_file, project_tree / 'basic.prj')
+    larch = catalogue.project_groups(catalogue_file, project_tree / 'larch.prj')
+    assert [a_group['label'] for a_group in basic] == [a_group['label'] for a_group in larch]
+
+def test_workers_give_the_same_catalogue(project_tree):
+    catalogue.build_catalogue(project_tree, project_tree / 'one.db', workers=1)
+    catalogue.build_catalogue(project_tree, project_tree / 'two.db', workers=2)
+    assert catalogue.find_groups(project_tree / 'one.db') == \
+        catalogue.find_groups(project_tree / 'two.db')
@@ -0,0 +1,243 @@
+# Records of the groups of an Athena project
+#
+# read_athena decodes all the arrays of all the groups of a project. The
+# functions in this module split the text of a project in the records of
+# its groups and decode only the arguments used to find a group (label,
+# athena key, element, edge and e0). The energy range of a group is taken
+# from the first and last values of its energy array and the number of
+# values is counted from the separators, so a project can be indexed
+# without decoding the arrays of its groups. The group of a record is read
+# from the text of the header and that record in memory, with the steps of
+# read_athena (read_text), so it is the same group read_athena gives for the
+# whole project.
+#
+# The module is shared with the PSDI pilot library (its lib package also
+# imports the modules of this directory): the project catalogue indexes the
+# records and read_projects builds the projects with read_text.
+#
+# The structure of a record (perl format, as written by Demeter and larch):
+##############################
+# $old_group = 'galkg';
+# @args = ('atsym','Sn','bkg_e0','29188.11','edge','K','label','a.dat',...);
+# @x = ('29000.24','29000.73',...);
+# @y = ('0.115285','0.115128',...);
+# [record] #
+##############################
+# the json format keeps the same arguments and arrays for each athena key.
+#
+# project_text: text of a project from the contents of its file.
+# read_project_text: reads the text of a project file (gzipped or plain).
+# group_name: name of the group of a label (as read_athena).
+# project_records: header and records of the groups of a project, with
+#                  their arguments and energy range.
+# read_text: reads a project from its text (as read_athena).
+# read_record: reads the group of a record with read_athena.
+
+# build the projects as read_athena
+from larch.io.athena_project import (AthenaProject, parse_jsonathena, parse_perlathena,
+                                     clean_bkg_params, clean_fft_params)
+from larch.xafs import pre_edge, autobk, xftf
+# decode the perl lists of a record and name the groups
+from larch.io.athena_project import text2list
+from larch.utils.strutils import fix_varname
+
+# decode the arguments of the records
+import ast
+import gzip
+import json
+
+# arguments of a group used to find it
+RECORD_ARGS = ('label', 'atsym', 'edge', 'bkg_e0')
+
+
+ #######################################################
+# |       Text of an Athena project file              | #
+# | raw: contents of the file (gzipped or plain)      | #
+# V ValueError if it is not an athena project         V #
+ #######################################################
+def project_text(raw, project_file=''):
+    if raw[:2] == b'\x1f\x8b':
+        raw = gzip.decompress(raw)
+    text = raw.decode('utf-8', errors='replace')
+    if "Athena project file -- " not in text[:500]:
+        raise ValueError("invalid Athena project file: " + str(project_file))
+    return text
+
+def read_project_text(project_file):
+    with open(project_file, 'rb') as prj_file:
+        return project_text(prj_file.read(), project_file)
+
+# group name used by read_athena for a label
+def group_name(label):
+    if label.startswith(' '):
+        label = 'd_' + label.strip()
+    name = fix_varname(label)
+    if name.startswith('_'):
+        name = 'd' + name
+    return name
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# values of a perl list ("@args = ('label','a',...);")
+def _perl_list(line):
+    values = ast.literal_eval(text2list(line))
+    return values if isinstance(values, tuple) else (values,)
+
+# first value, last value and number of values of a perl array of numbers
+# ("@x = ('1','2');"), only the first and last values are converted
+def _perl_range(line):
+    values = line[line.index('(') + 1:line.rindex(')')].strip().strip(',')
+    if values.replace("'", '').strip() == '':
+        return None, None, 0
+    first = values.split(',', 1)[0]
+    last = values.rsplit(',', 1)[-1]
+    return _as_float(first.strip(" '")), _as_float(last.strip(" '")), values.count(',') + 1
+
+# record of a group from its key, arguments and energy range
+def _record(key, args, e_min, e_max, n_points, record):
+    label = str(args.get('label', key))
+    return {'key': key, 'label': label, 'name': group_name(label),
+            'atsym': args.get('atsym'), 'edge': args.get('edge'),
+            'e0': _as_float(args.get('bkg_e0')),
+            'e_min': e_min, 'e_max': e_max, 'n_points': n_points, 'record': record}
+
+def _perl_records(text):
+    lines = text.split('\n')
+    header = []
+    for line in lines:
+        if line.startswith('$old_group'):
+            break
+        header.append(line)
+    records = []
+    record = None
+    for line in lines[len(header):]:
+        if line.startswith('$old_group'):
+            record = [line]
+        elif record is None:
+            continue
+        else:
+            record.append(line)
+            if line.startswith('[record]'):
+                key = _perl_list(record[0])[0]
+                args, energy_range = {}, (None, None, 0)
+                for r_line in record:
+                    if r_line.startswith('@args'):
+                        arg_list = _perl_list(r_line)
+                        args = {arg: value for arg, value in zip(arg_list[::2], arg_list[1::2])
+                                if arg in RECORD_ARGS}
+                    elif r_line.startswith('@x '):
+                        energy_range = _perl_range(r_line)
+                records.append(_record(key, args, *energy_range, record))
+                record = None
+    return '\n'.join(header), records
+
+# the arrays of a json project are lists (decoded by json.loads)
+def _json_range(energy):
+    if len(energy) == 0:
+        return None, None, 0
+    return _as_float(energy[0]), _as_float(energy[-1]), len(energy)
+
+def _json_records(text):
+    project = json.loads(text)
+    header = '\n'.join(value for key, value in project.items() if key.startswith('_____head'))
+    return header, [_record(key, project[key].get('args', {}),
+                            *_json_range(project[key].get('x', [])), project[key])
+                    for key in project.get('_____order', [])]
+
+ #######################################################
+# |     Records of the groups of an Athena project    | #
+# | text: text of the project (project_text)          | #
+# V returns the header of the project and a list with V #
+# V the record of each group: key, label, name,       V #
+# V atsym, edge, e0, e_min, e_max, n_points, record   V #
+ #######################################################
+def project_records(text):
+    if '____header' in text[:500]:
+        return _json_records(text)
+    return _perl_records(text)
+
+ #######################################################
+# |      Read a project from its text (read_athena)   | #
+# | project_file: name of the project (for the docs)  | #
+# | text: text of the project (project_text)          | #
+# | do_preedge, do_bkg, do_fft: as read_athena        | #
+# V returns the project as read_athena                V #
+ #######################################################
+# read_athena and AthenaProject.read only read files, this builds the
+# project from the text in memory with the same steps as AthenaProject.read
+def read_text(project_file, text, do_preedge=True, do_bkg=False, do_fft=False):
+    project_file = str(project_file)
+    if "Athena project file -- " not in text[:500]:
+        raise ValueError("invalid Athena project file: " + project_file)
+    data = None
+    if '____header' in text[:500]:
+        try:
+            data = parse_jsonathena(text, project_file)
+        except Exception:
+            pass
+    if data is None:
+        data = parse_perlathena(text, project_file)
+    project = AthenaProject()
+    project.filename = project_file
+    project.header = data.header
+    project.journal = data.journal
+    project.group_names = data.group_names
+    for name in data.group_names:
+        this = getattr(data, name)
+        this.athena_id = this.athena_params.id
+        _process_group(this, do_preedge, do_bkg, do_fft)
+        this.sel = 1
+        project.groups[name] = this
+    return project.as_group()
+
+# pre-edge, background and fourier transform of a group with the parameters
+# of the project, and chi(k) groups with k and chi (as AthenaProject.read)
+def _process_group(this, do_preedge, do_bkg, do_fft):
+    is_xmu = bool(int(getattr(this.athena_params, 'is_xmu', 1.0)))
+    is_chi = bool(int(getattr(this.athena_params, 'is_chi', 0.0)))
+    is_xmu = is_xmu and not is_chi
+    for flag in ('is_xmudat', 'is_bkg', 'is_diff', 'is_proj', 'is_pixel', 'is_rsp'):
+        is_xmu = is_xmu and not bool(int(getattr(this.athena_params, flag, 0.0)))
+    if is_xmu and (do_preedge or do_bkg):
+        pars = clean_bkg_params(this.athena_params.bkg)
+        eshift = getattr(this.athena_params.bkg, 'eshift', None)
+        if eshift is not None:
+            this.energy = this.energy + eshift
+        pre_edge(this, e0=float(pars.e0), pre1=float(pars.pre1), pre2=float(pars.pre2),
+                 norm1=float(pars.nor1), norm2=float(pars.nor2), nnorm=float(pars.nnorm),
+                 make_flat=bool(pars.flatten))
+        if do_bkg and hasattr(pars, 'rbkg'):
+            autobk(this, e0=float(pars.e0), rbkg=float(pars.rbkg), kmin=float(pars.spl1),
+                   kmax=float(pars.spl2), kweight=float(pars.kw), dk=float(pars.dk),
+                   clamp_lo=float(pars.clamp1), clamp_hi=float(pars.clamp2))
+            if do_fft:
+                pars = clean_fft_params(this.athena_params.fft)
+                xftf(this, kmin=float(pars.kmin), kmax=float(pars.kmax),
+                     kweight=float(getattr(pars, 'kw', 2)), window=pars.kwindow,
+                     dk=float(pars.dk))
+    if is_chi:
+        this.k = this.energy*1.0
+        this.chi = this.mu*1.0
+        del this.energy
+        del this.mu
+
+ #######################################################
+# |      Read the group of a record (read_athena)     | #
+# | project_file: file of the project                 | #
+# | header: header of the project (project_records)   | #
+# | record: record of the group (project_records)     | #
+# | read_args: arguments of read_athena (do_bkg...)   | #
+# V returns the group as read_athena                  V #
+ #######################################################
+def read_record(project_file, header, record, **read_args):
+    if isinstance(record['record'], dict):
+        text = json.dumps({'_____header1': header, '_____journal': '',
+                           '_____order': [record['key']], record['key']: record['record']})
+    else:
+        text = '\n'.join([header] + record['record'] + ['', '1;', ''])
+    project = read_text(project_file, text, **read_args)
+    return next(iter(project._athena_groups.values()))
@@ -10,10 +10,6 @@
 # get subprocess to run perl script
 import subprocess
 
-# pymatgen used to generate the feff.inp file 
-from pymatgen.io.cif import CifParser, CifWriter
-from pymatgen.io.feff.inputs import Atoms, Potential, Header
-
 # FEFF to generate scattering paths
 from larch.xafs.feffrunner import feff6l
 
@@ -32,6 +28,10 @@ def run_atoms(crystal_f, feff_dir, feff_inp):
     return result
 
 def inp_from_cif(crystal_f, feff_dir, feff_inp, absorbing,c_radius):
+    # pymatgen used to generate the feff.inp file (imported here because it
+    # is only needed for cif files and is slow to import)
+    from pymatgen.io.cif import CifParser
+    from pymatgen.io.feff.inputs import Atoms, Potential, Header
     crystal_f = Path(crystal_f)
     c_parser = CifParser(crystal_f)
     c_structure = c_parser.get_structures()[0]
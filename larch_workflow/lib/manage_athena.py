@@ -3,6 +3,8 @@ from larch.io import create_athena, read_athena, extract_athenagroup, read_ascii
 
 # calculate pre-edge and post edge for normalisation
 from larch.xafs import pre_edge
+# e0 of groups without one (needed by rebin_xafs)
+from larch.xafs import find_e0
 # perform background removal
 from larch.xafs import autobk
 # calculate fourier transform
@@ -13,6 +15,11 @@ from larch.xafs import rebin_xafs
 
 # math library contants the lcf function 
 from larch import math
+# new groups for the rebinned data
+from larch import Group
+# interpolation and labels of the lcf standards (as lincombo_fit)
+from larch.math import interp
+from larch.math.lincombo_fitting import get_label
 
 # plotting library
 import matplotlib.pyplot as plt
@@ -20,6 +27,8 @@ import matplotlib.pyplot as plt
 # interpolate to produce smoother graphs
 import numpy as np
 from scipy.interpolate import make_interp_spline, BSpline
+# limits of the scans rejected from the merge
+from scipy.stats import norm, t as student_t
 
 # File handling
 from pathlib import Path
@@ -29,6 +38,36 @@ import logging
 
 # create new instances of objects with deepcopy
 import copy
+# medians of the points of the merge grid without scans
+import warnings
+# subsets of the lcf standards
+from itertools import combinations
+# combinatorial lcf in parallel
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+
+# records of the groups of a project (lazy projects), imported from this
+# directory as the module can be loaded with another lib first in the path
+# (benchmarks/bench_workflow.py of nextflow_larch)
+from . import athena_records
+
+# maximum number of points of each curve in the plots (None to plot all)
+PLOT_POINTS = 2000
+
+# groups shared with the rebinned groups (not copied), the other members
+# kept are strings and numbers and the arrays measured on the energy points
+# (i0, itrans, ...), which are rebinned as mu
+SHARED_GROUPS = ('athena_params',)
+# arrays on the energy points that are not rebinned, they are calculated
+# again from the rebinned mu (pre_edge) or dropped (autobk)
+ENERGY_RESULTS = ('energy', 'mu', 'xdat', 'ydat', 'delta_mu', 'norm', 'flat', 'dmude',
+                  'd2mude', 'pre_edge', 'post_edge', 'norm_poly', 'norm_area', 'bkg',
+                  'chie', 'delta_bkg')
+
+# largest number of standards in a non-negative batch lcf (all the
+# subsets of the standards are solved, 2**n - 1)
+LCF_MAX_COMPONENTS = 12
 
  #######################################################
 # | Create an output dir, point to the input file(s)  | #
@@ -86,16 +125,85 @@ def read_text(a_file, use_labels = "energy mu"):
 
  #######################################################
 # |         Read data from Athena project file        | #
+# | lazy: read the groups only when they are used     | #
 # V              returns a project object             V #
  #######################################################
-def read_project(project_file):
+def read_project(project_file, lazy=False):
+    if lazy:
+        return LazyProject(project_file)
     return read_athena(project_file)
 
+# metadata of the groups of a lazy project
+LAZY_METADATA = ('label', 'key', 'atsym', 'edge', 'e0', 'n_points')
+
+ #######################################################
+# |    Athena project read on demand (lazy project)   | #
+# | The file is read once and split in the records of | #
+# | its groups (lib/athena_records.py), only the      | #
+# | labels and a few parameters (metadata) are        | #
+# | decoded, the arrays are not. A group is read with | #
+# | read_athena from its record the first time it is  | #
+# | used and kept.                                    | #
+# | project_file: athena project (.prj)               | #
+# V use as: prj[name] or get_group(prj, name)         V #
+ #######################################################
+class LazyProject:
+    def __init__(self, project_file):
+        self.filename = str(project_file)
+        self._header, records = athena_records.project_records(
+            athena_records.read_project_text(project_file))
+        # records of the groups by group name
+        self._records = {record['name']: record for record in records}
+        self._groups = {}
+
+    # read the group with read_athena and extract it as get_groups (chi(k)
+    # groups are not xas groups, so they are not extracted)
+    def _decode(self, name):
+        a_group = athena_records.read_record(self.filename, self._header,
+                                             self._records[name])
+        if not hasattr(a_group, 'energy'):
+            return a_group
+        return extract_athenagroup(a_group)
+
+    # names of the groups (as read_athena)
+    def labels(self):
+        return list(self._records)
+
+    # label, athena key, atsym, edge, e0 and number of points of a group
+    # (without decoding its arrays)
+    def metadata(self, name):
+        return {item: self._records[name][item] for item in LAZY_METADATA}
+
+    # the group (decoded on first use)
+    def group(self, name):
+        if name not in self._groups:
+            self._groups[name] = self._decode(name)
+        return self._groups[name]
+
+    # release the decoded groups (all if names is None)
+    def forget(self, names=None):
+        for name in (list(self._groups) if names is None else names):
+            self._groups.pop(name, None)
+
+    def __getitem__(self, name):
+        return self.group(name)
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
  #######################################################
 # |          Read groups from Athena project          | #
 # V              returns a list of groups             V #
  #######################################################
 def get_groups(athena_project):
+    if isinstance(athena_project, LazyProject):
+        return [athena_project.group(name) for name in athena_project.labels()]
     athena_groups = []
     group_keys=list(athena_project._athena_groups.keys())
     for group_key in group_keys:
@@ -108,7 +216,10 @@ def get_groups(athena_project):
 # V              returns a list of groups             V #
  #######################################################
 def get_group(athena_project, label):
-    g = extract_athenagroup(athena_project._athena_groups[label])
+    if isinstance(athena_project, LazyProject):
+        g = athena_project.group(label)
+    else:
+        g = extract_athenagroup(athena_project._athena_groups[label])
     g = calc_with_defaults(g)
     return g
 
@@ -119,6 +230,160 @@ def get_group(athena_project, label):
 def merge_readings(groups_list):
     return merge_groups (groups_list)
 
+ #######################################################
+# |     Merge readings one at a time (streaming)      | #
+# | reference: group with the energy grid of the      | #
+# |            merge (first scan added if None)       | #
+# | rejection: None, 'sigma' (points further than     | #
+# |     n_sigma standard deviations of the scans from | #
+# |     the running mean, after min_scans scans, with | #
+# |     the spread of a t distribution) or 'median'   | #
+# |     (n_sigma robust deviations from the median of | #
+# |     the first window scans, the deviations are    | #
+# |     pooled over the neighbouring points)          | #
+# | reject_scan: fraction of rejected points above    | #
+# |     which the whole scan is rejected              | #
+# V use add(group) for each scan, then merged()       V #
+ #######################################################
+class ScanMerge:
+    def __init__(self, reference=None, xarray='energy', yarray='mu', rejection=None,
+                 n_sigma=3.0, min_scans=3, window=5, neighbours=25, reject_scan=0.5):
+        if rejection not in (None, 'sigma', 'median'):
+            raise ValueError("rejection must be None, 'sigma' or 'median'")
+        self.xarray = xarray
+        self.yarray = yarray
+        self.rejection = rejection
+        self.n_sigma = n_sigma
+        self.min_scans = min_scans
+        self.window = window
+        self.neighbours = neighbours
+        self.reject_scan = reject_scan
+        self.n_scans = 0
+        # fraction of rejected points of each scan and scans rejected
+        self.rejected_points = []
+        self.rejected_scans = []
+        self.x = None
+        if reference is not None:
+            self._start(getattr(reference, xarray))
+
+    def _start(self, x):
+        self.x = np.unique(np.asarray(x, dtype=float))
+        self.count = np.zeros(len(self.x))
+        self.mean = np.zeros(len(self.x))
+        self.m2 = np.zeros(len(self.x))
+        # first scans (median rejection) and their median and robust sigma
+        self._held = []
+        self._median = None
+        self._sigma = None
+
+    # running mean and variance (Welford) of the points used
+    def _accumulate(self, y, use):
+        self.count[use] += 1
+        delta = y[use] - self.mean[use]
+        self.mean[use] += delta/self.count[use]
+        self.m2[use] += delta*(y[use] - self.mean[use])
+
+    # points of a scan further than n_sigma from the center (the center is
+    # NaN on the points of the grid without scans)
+    def _outliers(self, y, valid, center, sigma, checked):
+        scale = np.nanmax(np.abs(center), initial=0.0)
+        sigma = np.maximum(sigma, np.finfo(float).eps*scale)
+        return valid & checked & (np.abs(y - center) > self.n_sigma*sigma)
+
+    def _merge_scan(self, scan_idx, y, valid, outliers):
+        n_valid = max(1, valid.sum())
+        fraction = outliers.sum()/n_valid
+        self.rejected_points[scan_idx] = fraction
+        if fraction > self.reject_scan:
+            self.rejected_scans.append(scan_idx)
+            return
+        self._accumulate(y, valid & ~outliers)
+
+    def _merge_held(self):
+        held = np.array([y for _, y in self._held])
+        # points of the grid without scans have no median
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            self._median = np.nanmedian(held, axis=0)
+            self._median_scans = len(held)
+            # sigma from the differences between pairs of scans, which have
+            # the same spread for any number of scans (the deviations from
+            # the median of a few scans underestimate it), pooled over the
+            # neighbouring points as the differences at a single point are
+            # too noisy
+            first, second = np.triu_indices(len(held), k=1)
+            if len(first) == 0:
+                first = second = np.zeros(1, dtype=int)
+            deviation = np.abs(held[first] - held[second])/np.sqrt(2)
+            side = min(self.neighbours, len(self.x) - 1)//2
+            padded = np.pad(deviation, ((0, 0), (side, side)), mode='edge')
+            pooled = np.lib.stride_tricks.sliding_window_view(padded, 2*side + 1, axis=1)
+            self._sigma = 1.4826*np.nanmedian(pooled, axis=(0, 2))
+        checked = np.isfinite(self._median)
+        for scan_idx, y in self._held:
+            valid = np.isfinite(y)
+            self._merge_scan(scan_idx, y, valid,
+                             self._outliers(y, valid, self._median, self._sigma, checked))
+        self._held = []
+
+    # add a scan to the merge (interpolated on the energy grid, points
+    # outside the scan are not used)
+    def add(self, a_group):
+        x = getattr(a_group, self.xarray)
+        if self.x is None:
+            self._start(x)
+        y = np.interp(self.x, x, getattr(a_group, self.yarray), left=np.nan, right=np.nan)
+        valid = np.isfinite(y)
+        scan_idx = self.n_scans
+        self.n_scans += 1
+        self.rejected_points.append(0.0)
+        if self.rejection == 'median':
+            if self._median is None:
+                self._held.append((scan_idx, y))
+                if len(self._held) >= self.window:
+                    self._merge_held()
+                return
+            # the later scans also differ from the median by its own error
+            # (variance pi/2 sigma**2/n for n scans)
+            sigma = self._sigma*np.sqrt(1 + np.pi/(2*self._median_scans))
+            outliers = self._outliers(y, valid, self._median, sigma, np.isfinite(self._median))
+        elif self.rejection == 'sigma':
+            # prediction interval of a new scan from the mean and sample
+            # variance of n scans: the n_sigma limit of a normal distribution
+            # becomes the one of a t distribution with n - 1 degrees of freedom
+            checked = self.count >= max(self.min_scans, 2)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                sigma = np.sqrt(self.m2/(self.count - 1)*(1 + 1/self.count))
+                sigma *= student_t.ppf(norm.cdf(self.n_sigma), self.count - 1)/self.n_sigma
+            outliers = self._outliers(y, valid, self.mean, sigma, checked)
+        else:
+            outliers = np.zeros(len(y), dtype=bool)
+        self._merge_scan(scan_idx, y, valid, outliers)
+
+    # merged group with the mean, standard deviation and number of scans
+    # used at each point (points without scans are removed)
+    def merged(self):
+        if self._held:
+            self._merge_held()
+        used = self.count > 0
+        merged_group = Group(name='merge')
+        setattr(merged_group, self.xarray, self.x[used])
+        setattr(merged_group, self.yarray, self.mean[used])
+        setattr(merged_group, self.yarray + '_std', np.sqrt(self.m2[used]/self.count[used]))
+        setattr(merged_group, self.yarray + '_count', self.count[used].astype(int))
+        merged_group.n_scans = self.n_scans
+        merged_group.rejected_scans = list(self.rejected_scans)
+        merged_group.rejected_points = list(self.rejected_points)
+        return merged_group
+
+# merge the scans from a list or a generator (for example reading each
+# file when it is needed) holding only the running mean and variance
+def merge_readings_streaming(groups, reference=None, rejection=None, n_sigma=3.0, **merge_args):
+    merge = ScanMerge(reference, rejection=rejection, n_sigma=n_sigma, **merge_args)
+    for a_group in groups:
+        merge.add(a_group)
+    return merge.merged()
+
  #######################################################
 # |                Recalibrate energy                 | #
 # V             move E0 to match standard             V #
@@ -128,20 +393,220 @@ def recalibrate_energy(a_group, recalibrate_to):
     a_group.e0 = recalibrate_to
     return a_group
 
+# indices of the groups measured on the same energy points, as a list of
+# (energy, [indices]), so their arrays can be processed together
+def same_energy_groups(groups_list):
+    same_energy = []
+    for g_idx, a_group in enumerate(groups_list):
+        for source_energy, indices in same_energy:
+            if np.array_equal(source_energy, a_group.energy):
+                indices.append(g_idx)
+                break
+        else:
+            same_energy.append((a_group.energy, [g_idx]))
+    return same_energy
+
+# linear interpolation of a stack of spectra measured on the same energy
+# points (one row each) to a new energy array
+def interp_stack(energy, mu_stack, new_energy):
+    right = np.clip(np.searchsorted(energy, new_energy), 1, len(energy) - 1)
+    weight = (new_energy - energy[right - 1])/(energy[right] - energy[right - 1])
+    return mu_stack[:, right - 1]*(1 - weight) + mu_stack[:, right]*weight
+
+# derivative of the spectra on a uniform grid, without offset and scaled
+# to unit norm (for the cross-correlation), the reference is also tapered
+# at the ends
+def _aligned_derivative(mu_grid, taper=False):
+    deriv = np.gradient(mu_grid, axis=1)
+    deriv -= deriv.mean(axis=1, keepdims=True)
+    if taper:
+        deriv *= np.hanning(mu_grid.shape[1])
+    norm = np.sqrt((deriv**2).sum(axis=1, keepdims=True))
+    return deriv/np.where(norm > 0, norm, 1)
+
+# lag (in grid steps) of the peak of the cross-correlation of each
+# derivative with the reference (conjugate of its fft)
+def _correlation_peaks(deriv, ref_fft, max_lag):
+    n_fft = 2*(ref_fft.shape[1] - 1)
+    corr = np.fft.irfft(np.fft.rfft(deriv, n_fft, axis=1)*ref_fft, n_fft, axis=1)
+    # correlation at the lags searched, from -max_lag to max_lag
+    corr = np.concatenate((corr[:, n_fft - max_lag:], corr[:, :max_lag + 1]), axis=1)
+    peak = np.clip(np.argmax(corr, axis=1), 1, 2*max_lag - 1)
+    # sub-step position of the peak from a parabola through 3 points
+    rows = np.arange(len(corr))
+    before = corr[rows, peak - 1]
+    at = corr[rows, peak]
+    after = corr[rows, peak + 1]
+    curvature = before - 2*at + after
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(curvature < 0, 0.5*(before - after)/curvature, 0.0)
+    return peak - max_lag + np.clip(offset, -0.5, 0.5)
+
+ #######################################################
+# |     Align the energy of many scans to a reference | #
+# | groups_list: groups to align (changed in place)   | #
+# | reference: group with the reference spectrum      | #
+# |            (for example the reference foil)       | #
+# | e_range: energy range compared, relative to the   | #
+# |          e0 of the reference (all the reference   | #
+# |          energy range if it has no e0)            | #
+# | step: energy step of the cross-correlation        | #
+# | max_shift: largest shift searched (eV)            | #
+# | smooth: width of the gaussian smoothing of the    | #
+# |         derivatives (eV)                          | #
+# | chunk_size: scans correlated at once              | #
+# V returns the array of shifts (eV)                  V #
+ #######################################################
+def align_energies(groups_list, reference, e_range=(-20, 50), step=0.05, max_shift=10.0,
+                   smooth=1.0, chunk_size=500):
+    ref_energy = reference.energy
+    if getattr(reference, 'e0', None) is not None:
+        e_low = max(ref_energy.min(), reference.e0 + e_range[0])
+        e_high = min(ref_energy.max(), reference.e0 + e_range[1])
+    else:
+        e_low, e_high = ref_energy.min(), ref_energy.max()
+    grid = np.arange(e_low, e_high, step)
+    max_lag = min(int(max_shift/step), len(grid) - 2)
+    # the scans are compared on the range of the reference extended by the
+    # largest shift, so the reference always overlaps them
+    scan_grid = grid[0] + step*np.arange(-max_lag, len(grid) + max_lag)
+    n_fft = 1 << int(np.ceil(np.log2(2*len(scan_grid))))
+    ref_deriv = np.zeros((1, len(scan_grid)))
+    ref_deriv[:, max_lag:max_lag + len(grid)] = _aligned_derivative(
+        np.interp(grid, ref_energy, reference.mu)[np.newaxis, :], taper=True)
+    # the derivatives are smoothed with a gaussian of width smooth (eV),
+    # applied to the cross-spectrum
+    freq = np.fft.rfftfreq(n_fft, d=step)
+    ref_fft = np.conj(np.fft.rfft(ref_deriv, n_fft))*np.exp(-(2*np.pi*freq*smooth)**2)
+    # the peak of the reference compared with itself is not exactly at 0
+    # (only the reference is tapered), it is removed from all the shifts
+    bias = _correlation_peaks(_aligned_derivative(
+        np.interp(scan_grid, ref_energy, reference.mu)[np.newaxis, :]), ref_fft, max_lag)[0]
+
+    shifts = np.empty(len(groups_list))
+    for start in range(0, len(groups_list), chunk_size):
+        chunk = groups_list[start:start + chunk_size]
+        # scans measured on the same energy points are interpolated together
+        mu_grid = np.empty((len(chunk), len(scan_grid)))
+        for source_energy, indices in same_energy_groups(chunk):
+            mu_stack = np.array([chunk[g_idx].mu for g_idx in indices])
+            mu_grid[indices] = interp_stack(source_energy, mu_stack, scan_grid)
+        peaks = _correlation_peaks(_aligned_derivative(mu_grid), ref_fft, max_lag)
+        shifts[start:start + chunk_size] = (peaks - bias)*step
+
+    reference_name = getattr(reference, 'filename', getattr(reference, '__name__', ''))
+    for a_group, shift in zip(groups_list, shifts):
+        a_group.energy = a_group.energy - shift
+        if getattr(a_group, 'e0', None) is not None:
+            a_group.e0 = a_group.e0 - shift
+        a_group.energy_shift = getattr(a_group, 'energy_shift', 0.0) + shift
+        a_group.align_reference = reference_name
+    return shifts
+
  #######################################################
 # |                Rebin signal with                  | #
 # V                     defaults                      V #
  #######################################################
 def rebin_group(a_group):
-    xr = copy.deepcopy(a_group)
-    rebin_xafs(xr)#,group=xr,exafs1=50,xanes_step =0.5)
-    xr.energy = copy.deepcopy(xr.rebinned.energy) 
-    xr.mu = copy.deepcopy(xr.rebinned.mu)
-    xr.e0 = copy.deepcopy(xr.rebinned.e0)
-    xr.filename += " Rebinned"
+    # the rebinned arrays are written to an empty group, so the data
+    # group is neither copied nor changed
+    rebin_out = Group()
+    rebin_xafs(a_group.energy, mu=a_group.mu, group=rebin_out, e0=group_e0(a_group))#,exafs1=50,xanes_step =0.5)
+    xr = rebinned_group(a_group, rebin_out.rebinned.energy, rebin_out.rebinned.mu,
+                        rebin_out.rebinned.e0)
+    xr.delta_mu = rebin_out.rebinned.delta_mu
     xr = fit_pre_post_edge(xr)
     return xr
 
+# e0 of a group, found from mu if the group does not have one
+def group_e0(a_group):
+    e0 = getattr(a_group, 'e0', None)
+    if e0 is None:
+        e0 = find_e0(a_group.energy, mu=a_group.mu)
+    return e0
+
+# names of the arrays measured on the energy points of a group (other
+# than energy and mu)
+def channel_names(a_group):
+    energy = np.asarray(a_group.energy)
+    return [member for member, value in vars(a_group).items()
+            if not member.startswith('__') and member not in ENERGY_RESULTS
+            and isinstance(value, np.ndarray) and value.shape == energy.shape]
+
+# new group with the rebinned energy and mu, sharing the metadata of the
+# original group (name, labels, athena parameters), the other arrays
+# measured on the energy points are rebinned to the new energy
+def rebinned_group(a_group, energy, mu, e0):
+    xr = Group(name=getattr(a_group, '__name__', 'group') + '_rebinned')
+    for member, value in vars(a_group).items():
+        if member.startswith('__'):
+            continue
+        if member in SHARED_GROUPS or isinstance(value, (str, int, float)):
+            setattr(xr, member, value)
+    channels = channel_names(a_group)
+    if channels:
+        channel_stack = np.array([getattr(a_group, member) for member in channels])
+        for member, values in zip(channels, bin_means(np.asarray(a_group.energy),
+                                                      channel_stack, energy)):
+            setattr(xr, member, values)
+    xr.energy = energy
+    xr.mu = mu
+    xr.e0 = e0
+    xr.filename = getattr(a_group, 'filename', '') + " Rebinned"
+    return xr
+
+# mean of mu in the bins around each point of the new energy grid, for a
+# stack of spectra measured on the same energy points (one row each),
+# bins with fewer than 3 points are interpolated
+def bin_means(energy, mu_stack, new_energy):
+    half_steps = np.diff(new_energy)/2
+    lower = new_energy - np.concatenate(([half_steps[0]], half_steps))
+    upper = new_energy + np.concatenate((half_steps, [half_steps[-1]]))
+    starts = np.searchsorted(energy, lower)
+    ends = np.searchsorted(energy, upper)
+    counts = ends - starts
+    sums = np.zeros((len(mu_stack), len(energy) + 1))
+    np.cumsum(mu_stack, axis=1, out=sums[:, 1:])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (sums[:, ends] - sums[:, starts])/counts
+    sparse = counts < 3
+    if sparse.any():
+        means[:, sparse] = interp_stack(energy, mu_stack, new_energy[sparse])
+    return means
+
+ #######################################################
+# |        Rebin many groups on a common grid         | #
+# | groups_list: groups to rebin                      | #
+# | energy: common energy grid (the rebin_xafs grid   | #
+# |         of the first group if None), limited to   | #
+# |         the energy range of all the groups        | #
+# V returns a list of rebinned groups (ValueError if  V #
+# V the groups do not share an energy range)          V #
+ #######################################################
+def rebin_groups(groups_list, energy=None):
+    if energy is None:
+        grid_out = Group()
+        rebin_xafs(groups_list[0].energy, mu=groups_list[0].mu, group=grid_out,
+                   e0=group_e0(groups_list[0]))
+        energy = grid_out.rebinned.energy
+    energy = np.asarray(energy, dtype=float)
+    low = max(a_group.energy.min() for a_group in groups_list)
+    high = min(a_group.energy.max() for a_group in groups_list)
+    energy = energy[(energy >= low) & (energy <= high)]
+    if len(energy) < 2:
+        raise ValueError("the groups do not share an energy range to rebin them together "
+                         "(%.2f to %.2f eV)" % (low, high))
+    # groups measured on the same energy points are rebinned together
+    mu_grid = np.empty((len(groups_list), len(energy)))
+    for source_energy, indices in same_energy_groups(groups_list):
+        mu_stack = np.array([groups_list[g_idx].mu for g_idx in indices])
+        mu_grid[indices] = bin_means(source_energy, mu_stack, energy)
+    rebinned = []
+    for g_idx, a_group in enumerate(groups_list):
+        xr = rebinned_group(a_group, energy, mu_grid[g_idx], getattr(a_group, 'e0', None))
+        rebinned.append(fit_pre_post_edge(xr))
+    return rebinned
+
 
  #######################################################
 # |             Lineal Combination Fitting            | #
@@ -169,6 +634,273 @@ def lcf_group(a_group, lcf_components=[]):
     
     return lcfr
 
+# basis matrix of the lcf standards, one row for each standard with its
+# array interpolated to the energy points of the spectra
+def lcf_basis(lcf_components, energy, arrayname='norm'):
+    return np.array([interp(a_comp.energy, getattr(a_comp, arrayname), energy, kind='cubic')
+                     for a_comp in lcf_components])
+
+# least squares weights of the standards in each combination (one row of
+# combos each, as indices of the gram matrix) for all the spectra, from the
+# gram matrix of the standards, the projections of the spectra on them and
+# the sum of squares of the spectra. Returns the weights, their unscaled
+# variances and the chi-square (combination, spectrum) and which weights
+# are not 0.
+def _lcf_combinations(gram, projections, sum_squares, combos, sum_to_one=True,
+                      non_negative=True):
+    n_combos, size = combos.shape
+    n_spectra = len(sum_squares)
+    weights = np.zeros((n_combos, n_spectra, size))
+    variances = np.zeros((n_combos, n_spectra, size))
+    active = np.zeros((n_combos, n_spectra, size), dtype=bool)
+    # without sum to one all weights 0 is also a solution
+    best = np.empty((n_combos, n_spectra))
+    best[:] = np.inf if sum_to_one else sum_squares
+    # the solution is the best of the least squares solutions on each
+    # subset of the standards (the other weights are 0) that has no
+    # negative weight, solved for all combinations and spectra at once
+    if non_negative:
+        subsets = [list(subset) for sub_size in range(1, size + 1)
+                   for subset in combinations(range(size), sub_size)]
+    else:
+        subsets = [list(range(size))]
+    for subset in subsets:
+        members = combos[:, subset]
+        n_sub = len(subset)
+        # normal equations, with a lagrange multiplier for the sum to one
+        n_eqs = n_sub + 1 if sum_to_one else n_sub
+        system = np.zeros((n_combos, n_eqs, n_eqs))
+        system[:, :n_sub, :n_sub] = gram[members[:, :, np.newaxis], members[:, np.newaxis, :]]
+        rhs = np.empty((n_combos, n_spectra, n_eqs))
+        rhs[:, :, :n_sub] = projections[:, members].transpose(1, 0, 2)
+        if sum_to_one:
+            system[:, :n_sub, n_sub] = 1
+            system[:, n_sub, :n_sub] = 1
+            rhs[:, :, n_sub] = 1
+        try:
+            inverse = np.linalg.inv(system)
+        except np.linalg.LinAlgError:
+            # standards that are linear combinations of the others
+            inverse = np.linalg.pinv(system)
+        sub_weights = (rhs @ inverse.transpose(0, 2, 1))[:, :, :n_sub]
+        chisqr = (sum_squares - 2*(sub_weights*rhs[:, :, :n_sub]).sum(axis=2) +
+                  (sub_weights*(sub_weights @ system[:, :n_sub, :n_sub])).sum(axis=2))
+        better = chisqr < best
+        if non_negative:
+            better &= (sub_weights >= -1e-12).all(axis=2)
+        best[better] = chisqr[better]
+        # the weights of the other standards are 0
+        placed = np.zeros((n_combos, n_spectra, size))
+        placed[:, :, subset] = sub_weights
+        weights[better] = placed[better]
+        # covariance of the weights (unscaled) is the first block of the
+        # inverse of the normal equations
+        placed[:, :, subset] = np.diagonal(inverse, axis1=1, axis2=2)[:, np.newaxis, :n_sub]
+        variances[better] = placed[better]
+        active[better] = np.isin(np.arange(size), subset)
+    if non_negative:
+        weights = np.clip(weights, 0, None)
+    return weights, np.clip(variances, 0, None), np.clip(best, 0, None), active
+
+# degrees of freedom of a fit with n_weights standards (as lincombo_fit,
+# one weight less with sum to one)
+def _lcf_free(n_points, n_weights, sum_to_one):
+    return np.maximum(1, n_points - (n_weights - 1 if sum_to_one else n_weights))
+
+# gram matrix of the standards, projections of the spectra on them and
+# sum of squares of the spectra
+def _lcf_products(basis, spectra):
+    return basis @ basis.T, spectra @ basis.T, (spectra**2).sum(axis=1)
+
+ #######################################################
+# |  Linear combination of a basis for many spectra   | #
+# | basis: standards (one row each, lcf_basis)        | #
+# | spectra: spectra to fit (one row each) on the     | #
+# |          same points as the basis                 | #
+# | sum_to_one: the weights of each spectrum add to 1 | #
+# | non_negative: the weights are 0 or more           | #
+# V returns a group with the arrays of the results    V #
+ #######################################################
+def lcf_solve(basis, spectra, sum_to_one=True, non_negative=True):
+    n_comps, n_points = basis.shape
+    spectra = np.atleast_2d(spectra)
+    if non_negative and n_comps > LCF_MAX_COMPONENTS:
+        raise ValueError("non-negative lcf is limited to " + str(LCF_MAX_COMPONENTS) +
+                         " standards, " + str(n_comps) + " given")
+    gram, projections, sum_squares = _lcf_products(basis, spectra)
+    weights, variances, _, _ = _lcf_combinations(gram, projections, sum_squares,
+                                                 np.arange(n_comps)[np.newaxis, :],
+                                                 sum_to_one, non_negative)
+    weights = weights[0]
+    yfit = weights @ basis
+    residual = spectra - yfit
+    chisqr = (residual**2).sum(axis=1)
+    redchi = chisqr/_lcf_free(n_points, n_comps, sum_to_one)
+    return Group(weights=weights, stderr=np.sqrt(variances[0]*redchi[:, np.newaxis]),
+                 yfit=yfit, residual=residual, chisqr=chisqr, redchi=redchi,
+                 rfactor=chisqr/np.where(sum_squares > 0, sum_squares, 1))
+
+# energy in the fit range, basis matrix of the standards and spectra of
+# the groups on the same energy points
+def _lcf_arrays(groups_list, lcf_components, arrayname, xmin, xmax):
+    # the energy points of the first group in the fit range, the standards
+    # are interpolated once to them (the other groups only if measured on
+    # different points)
+    first_energy = groups_list[0].energy
+    in_range = (first_energy >= xmin) & (first_energy <= xmax)
+    energy = first_energy[in_range]
+    basis = lcf_basis(lcf_components, energy, arrayname)
+    spectra = np.empty((len(groups_list), len(energy)))
+    for source_energy, indices in same_energy_groups(groups_list):
+        y_stack = np.array([getattr(groups_list[g_idx], arrayname) for g_idx in indices])
+        if np.array_equal(source_energy, first_energy):
+            spectra[indices] = y_stack[:, in_range]
+        else:
+            spectra[indices] = interp_stack(source_energy, y_stack, energy)
+    return energy, basis, spectra
+
+ #######################################################
+# |    Lineal Combination Fitting of many groups      | #
+# | groups_list: groups to fit                        | #
+# | lcf_components: standards (groups)                | #
+# | arrayname: array fitted (norm, mu, dmude...)      | #
+# | xmin, xmax: energy range of the fit               | #
+# | sum_to_one, non_negative: constraints (lcf_solve) | #
+# V returns the lcf_solve group with energy, labels   V #
+ #######################################################
+def lcf_groups(groups_list, lcf_components, arrayname='norm', xmin=-np.inf, xmax=np.inf,
+               sum_to_one=True, non_negative=True):
+    energy, basis, spectra = _lcf_arrays(groups_list, lcf_components, arrayname, xmin, xmax)
+    lcf_out = lcf_solve(basis, spectra, sum_to_one, non_negative)
+    lcf_out.energy = energy
+    lcf_out.spectra = spectra
+    lcf_out.labels = [get_label(a_comp) for a_comp in lcf_components]
+    lcf_out.arrayname = arrayname
+    return lcf_out
+
+# best combinations of a chunk of combinations (all of the same size) for
+# each spectrum ranked by reduced chi-square (as lincombo_fitall), as the
+# chi-squares (rank, spectrum) and the weights, variances and standards
+# used (rank, spectrum, standard in the library). The products of the
+# standards and spectra (_lcf_products) are sent with each chunk.
+def _best_combinations(gram, projections, sum_squares, n_points, top, sum_to_one,
+                       non_negative, combos):
+    weights, variances, chisqr, active = _lcf_combinations(
+        gram, projections, sum_squares, combos, sum_to_one, non_negative)
+    # a combination with a weight 0 is the fit of a smaller combination
+    chisqr[~active.all(axis=2)] = np.inf
+    redchi = chisqr/_lcf_free(n_points, combos.shape[1], sum_to_one)
+    top = min(top, len(combos))
+    if top < len(combos):
+        ranks = np.argpartition(redchi, top - 1, axis=0)[:top]
+    else:
+        ranks = np.broadcast_to(np.arange(top)[:, np.newaxis], chisqr.shape)
+    spectra = np.arange(chisqr.shape[1])
+    n_library = len(gram)
+    best = {'redchi': redchi[ranks, spectra], 'chisqr': chisqr[ranks, spectra],
+            'weights': np.zeros(ranks.shape + (n_library,)),
+            'variances': np.zeros(ranks.shape + (n_library,)),
+            'in_combination': np.zeros(ranks.shape + (n_library,), dtype=bool)}
+    for r_idx in range(top):
+        members = combos[ranks[r_idx]]
+        best['weights'][r_idx, spectra[:, np.newaxis], members] = weights[ranks[r_idx], spectra]
+        best['variances'][r_idx, spectra[:, np.newaxis], members] = variances[ranks[r_idx], spectra]
+        best['in_combination'][r_idx, spectra[:, np.newaxis], members] = True
+    return best
+
+# products of the standards and spectra, set once in each worker of
+# lcf_combinatorial by the pool initializer
+_lcf_worker_solve = None
+
+def _init_lcf_worker(*solve_args):
+    global _lcf_worker_solve
+    _lcf_worker_solve = partial(_best_combinations, *solve_args)
+
+# best combinations of a chunk solved by a worker of lcf_combinatorial
+def _solve_lcf_chunk(chunk):
+    return _lcf_worker_solve(chunk)
+
+# keep the best ranks of two sets of best combinations
+def _merge_best(best, new_best, top):
+    if best is None:
+        merged = new_best
+    else:
+        merged = {key: np.concatenate((best[key], new_best[key])) for key in best}
+    order = np.argsort(merged['redchi'], axis=0, kind='stable')[:top]
+    spectra = np.arange(order.shape[1])
+    return {key: values[order, spectra] for key, values in merged.items()}
+
+ #######################################################
+# |      Combinatorial Lineal Combination Fitting     | #
+# | groups_list: groups to fit                        | #
+# | library: standards (groups) to combine            | #
+# | n_standards: standards in each combination (or a  | #
+# |              list of sizes to search)             | #
+# | top: best combinations kept for each group        | #
+# | workers: processes (None for all cpus, 1 runs in  | #
+# |          this process)                            | #
+# | arrayname, xmin, xmax, sum_to_one, non_negative:  | #
+# |          as lcf_groups                            | #
+# | chunk_size: combinations solved at once (chosen   | #
+# |             from the number of groups if None)    | #
+# V returns a group with the combinations ranked by   V #
+# V reduced chi-square (best first)                   V #
+ #######################################################
+def lcf_combinatorial(groups_list, library, n_standards=2, top=10, workers=None,
+                      arrayname='norm', xmin=-np.inf, xmax=np.inf, sum_to_one=True,
+                      non_negative=True, chunk_size=None):
+    energy, basis, spectra = _lcf_arrays(groups_list, library, arrayname, xmin, xmax)
+    gram, projections, sum_squares = _lcf_products(basis, spectra)
+    sizes = [n_standards] if np.isscalar(n_standards) else list(n_standards)
+    all_combos = []
+    for size in sizes:
+        if size < 1 or size > len(library):
+            raise ValueError("combinations of " + str(size) + " standards from a library of " +
+                             str(len(library)))
+        all_combos.append(np.array(list(combinations(range(len(library)), size))))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_size is None:
+        # about 10**6 weights solved at once, and several chunks for each
+        # worker
+        n_combos = sum(len(size_combos) for size_combos in all_combos)
+        chunk_size = max(1, min(10**6 // (len(groups_list)*max(sizes)),
+                                -(-n_combos // (4*workers))))
+    chunks = [size_combos[start:start + chunk_size] for size_combos in all_combos
+              for start in range(0, len(size_combos), chunk_size)]
+    workers = max(1, min(workers, len(chunks)))
+    solve_args = (gram, projections, sum_squares, len(energy), top, sum_to_one, non_negative)
+    best = None
+    if workers == 1:
+        solve_chunk = partial(_best_combinations, *solve_args)
+        for chunk in chunks:
+            best = _merge_best(best, solve_chunk(chunk), top)
+    else:
+        # the products are sent once to each worker, the tasks only carry
+        # their combinations
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_lcf_worker,
+                                 initargs=solve_args) as executor:
+            for chunk_best in executor.map(_solve_lcf_chunk, chunks):
+                best = _merge_best(best, chunk_best, top)
+
+    # results with the spectra first (spectrum, rank, ...)
+    chisqr = best['chisqr'].T
+    found = np.isfinite(chisqr)
+    redchi = np.where(found, best['redchi'].T, np.nan)
+    labels = [get_label(a_comp) for a_comp in library]
+    combos_labels = [[[labels[s_idx] for s_idx in np.nonzero(in_comb)[0]]
+                      for in_comb, valid in zip(spectrum_comb, spectrum_found) if valid]
+                     for spectrum_comb, spectrum_found in
+                     zip(best['in_combination'].transpose(1, 0, 2), found)]
+    return Group(energy=energy, labels=labels, combinations=combos_labels,
+                 in_combination=best['in_combination'].transpose(1, 0, 2),
+                 weights=best['weights'].transpose(1, 0, 2),
+                 stderr=np.sqrt(best['variances'].transpose(1, 0, 2)*redchi[:, :, np.newaxis]),
+                 chisqr=np.where(found, chisqr, np.nan), redchi=redchi,
+                 rfactor=np.where(found, chisqr, np.nan)/
+                 np.where(sum_squares > 0, sum_squares, 1)[:, np.newaxis],
+                 arrayname=arrayname)
+
  #######################################################
 # |         Athena recalculates everything so we      | #
 # |      need to create a function that calculates    | #
@@ -223,13 +955,48 @@ def save_groups(xas_groups, out_file):
         xas_project.add_group(xas_data)
     xas_project.save() 
     
-    
+
+ #######################################################
+# |   Downsample a curve for plotting, keeping its    | #
+# |   shape (largest triangle three buckets, LTTB)    | #
+# | x, y: arrays of the curve (x sorted)              | #
+# | max_points: number of points to keep (all the     | #
+# |             points if None or more than the data) | #
+# V returns the indices of the points to plot         V #
+ #######################################################
+def lttb_indices(x, y, max_points = PLOT_POINTS):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n_points = len(x)
+    if max_points is None or max_points >= n_points or max_points < 3:
+        return np.arange(n_points)
+    # first and last points are kept, the others are split in buckets
+    # and the point of each bucket forming the largest triangle with the
+    # point kept before and the average of the next bucket is kept
+    starts = np.linspace(1, n_points - 1, max_points - 1).astype(int)
+    sizes = np.diff(np.append(starts, n_points))
+    # average of the next bucket (the last point for the last bucket)
+    next_x = (np.add.reduceat(x, starts)/sizes)[1:]
+    next_y = (np.add.reduceat(y, starts)/sizes)[1:]
+    indices = np.empty(max_points, dtype=int)
+    indices[0] = 0
+    indices[-1] = n_points - 1
+    kept = 0
+    for bucket in range(max_points - 2):
+        start, end = starts[bucket], starts[bucket + 1]
+        area = np.abs((x[kept] - next_x[bucket])*(y[start:end] - y[kept]) -
+                      (x[kept] - x[start:end])*(next_y[bucket] - y[kept]))
+        kept = start + int(np.argmax(area))
+        indices[bucket + 1] = kept
+    return indices
+
  #######################################################
 # |              Plot mu on energy                    | #
 # V                                                   V #
  #######################################################
-def plot_mu(xafs_group, plot_title = ""):
-    plt.plot(xafs_group.energy, xafs_group.mu, label=xafs_group.filename) # plot mu in blue
+def plot_mu(xafs_group, plot_title = "", max_points = PLOT_POINTS):
+    shown = lttb_indices(xafs_group.energy, xafs_group.mu, max_points)
+    plt.plot(xafs_group.energy[shown], xafs_group.mu[shown], label=xafs_group.filename) # plot mu in blue
     plt.grid(color='black', linestyle=':', linewidth=1) #show and format grid
     plt.xlabel('Energy (eV)') # label y graph
     plt.ylabel('x$\mu$(E)') # label y axis
@@ -259,8 +1026,9 @@ def plot_edge_fit(xafs_group):
  #######################################################      
     
 # show plot of normalised data
-def plot_normalised(xafs_group):
-    plt.plot(xafs_group.energy, xafs_group.norm, label=xafs_group.filename)
+def plot_normalised(xafs_group, max_points = PLOT_POINTS):
+    shown = lttb_indices(xafs_group.energy, xafs_group.norm, max_points)
+    plt.plot(xafs_group.energy[shown], xafs_group.norm[shown], label=xafs_group.filename)
     plt.grid(color='r', linestyle=':', linewidth=1) #show and format grid
     plt.xlabel('Energy (eV)') # label y graph
     plt.ylabel('x$\mu$(E)') # label y axis
@@ -274,8 +1042,9 @@ def plot_normalised(xafs_group):
  #######################################################      
     
 # show plot of normalised data
-def plot_derivative(xafs_group):
-    plt.plot(xafs_group.energy, xafs_group.dmude, label=xafs_group.filename)
+def plot_derivative(xafs_group, max_points = PLOT_POINTS):
+    shown = lttb_indices(xafs_group.energy, xafs_group.dmude, max_points)
+    plt.plot(xafs_group.energy[shown], xafs_group.dmude[shown], label=xafs_group.filename)
     plt.grid(color='r', linestyle=':', linewidth=1) #show and format grid
     plt.xlabel('Energy (eV)') # label y graph
     plt.ylabel('Deriv normalised x$\mu$(E)') # label y axis
@@ -0,0 +1,36 @@
+# Fixtures shared by the tests of the notebooks library (lib)
+#
+# The tests use the data files of the FeS2 example in this directory and
+# the athena projects of the other workflows in the repository. Run from
+# the larch_workflow directory with:
+#   python -m pytest tests
+
+# File handling
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+WORKFLOW_DIR = Path(__file__).resolve().parent.parent
+REPO_DIR = WORKFLOW_DIR.parent
+PROJECT_FILES = [REPO_DIR / 'basic_workflow' / 'FeS2_01.prj',
+                 REPO_DIR / 'demeter_workflow' / 'FeS2.prj',
+                 WORKFLOW_DIR / 'fes2_larch.prj']
+
+# the library is imported as lib (as the notebooks do)
+sys.path.insert(0, str(WORKFLOW_DIR))
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+
+@pytest.fixture(scope='session')
+def project_files():
+    return [str(prj_file) for prj_file in PROJECT_FILES]
+
+# first group of each repository project (as read_athena)
+@pytest.fixture
+def project_groups(project_files):
+    import lib.manage_athena as athenamgr
+    return [athenamgr.get_groups(athenamgr.read_project(prj_file))[0]
+            for prj_file in project_files]
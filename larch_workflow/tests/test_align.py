@@ -0,0 +1,52 @@
+# Tests of the energy alignment of scans to a reference (align_energies)
+
+import numpy as np
+import pytest
+
+from larch import Group
+
+import lib.manage_athena as athenamgr
+
+
+SHIFTS = [-4.3, -1.0, 0.0, 0.35, 2.5, 7.8]
+
+@pytest.fixture
+def reference(project_groups):
+    return athenamgr.calc_with_defaults(project_groups[0])
+
+# scans of the reference moved by the given shifts (eV), on the energy
+# points of the reference or on their own points
+def _shifted_scans(reference, shifts, own_points=False, noise=0.0):
+    rng = np.random.default_rng(0)
+    scans = []
+    for shift in shifts:
+        energy = np.array(reference.energy)
+        if own_points:
+            energy = np.sort(energy + rng.uniform(-0.2, 0.2, len(energy)))
+        mu = np.interp(energy - shift, reference.energy, reference.mu)
+        scans.append(Group(energy=energy, mu=mu + noise*rng.normal(size=len(mu))))
+    return scans
+
+def test_shifts_recovered(reference):
+    scans = _shifted_scans(reference, SHIFTS)
+    shifts = athenamgr.align_energies(scans, reference)
+    assert np.allclose(shifts, SHIFTS, atol=0.1)
+    # the energies are changed in place
+    for scan, shift in zip(scans, shifts):
+        assert np.allclose(scan.energy, reference.energy - shift)
+        assert scan.align_reference == reference.filename
+
+def test_noisy_scans_on_own_points(reference):
+    scans = _shifted_scans(reference, SHIFTS, own_points=True, noise=0.005)
+    shifts = athenamgr.align_energies(scans, reference)
+    assert np.allclose(shifts, SHIFTS, atol=0.2)
+
+def test_chunks_give_the_same_shifts(reference):
+    shifts = athenamgr.align_energies(_shifted_scans(reference, SHIFTS), reference)
+    chunked = athenamgr.align_energies(_shifted_scans(reference, SHIFTS), reference,
+                                       chunk_size=4)
+    assert np.allclose(shifts, chunked)
+
+def test_reference_not_shifted(reference):
+    scan = Group(energy=np.array(reference.energy), mu=np.array(reference.mu))
+    assert abs(athenamgr.align_energies([scan], reference)[0]) < 0.02
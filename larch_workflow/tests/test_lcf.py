@@ -0,0 +1,89 @@
+# Tests of the batch linear combination fitting (lcf_solve, lcf_groups)
+
+import numpy as np
+import pytest
+from scipy.optimize import nnls
+
+from larch import Group
+from larch.math import lincombo_fit
+
+import lib.manage_athena as athenamgr
+
+
+# standards made from the normalised spectrum of the example: the spectrum,
+# the spectrum moved by 4 eV and the spectrum broadened
+@pytest.fixture
+def standards(project_groups):
+    group = athenamgr.calc_with_defaults(project_groups[0])
+    energy = np.array(group.energy)
+    moved = np.interp(energy - 4.0, energy, group.norm)
+    kernel = np.exp(-0.5*(np.arange(-7, 8)/3.0)**2)
+    broad = np.convolve(np.pad(group.norm, 7, mode='edge'), kernel/kernel.sum(), mode='valid')
+    return [Group(energy=energy, norm=np.array(norm), filename=name)
+            for norm, name in ((group.norm, 'FeS2'), (moved, 'moved'), (broad, 'broad'))]
+
+# groups with known weights of the standards (and noise)
+def _mixtures(standards, weights_list, noise=0.002):
+    rng = np.random.default_rng(1)
+    basis = np.array([standard.norm for standard in standards])
+    return [Group(energy=standards[0].energy,
+                  norm=np.asarray(weights) @ basis + noise*rng.normal(size=basis.shape[1]),
+                  filename='mix%i' % m_idx)
+            for m_idx, weights in enumerate(weights_list)]
+
+WEIGHTS = [[0.6, 0.4, 0.0], [0.2, 0.3, 0.5], [0.0, 0.0, 1.0], [0.5, 0.1, 0.4]]
+
+def test_known_weights(standards):
+    lcf_out = athenamgr.lcf_groups(_mixtures(standards, WEIGHTS, noise=0), standards)
+    assert np.allclose(lcf_out.weights, WEIGHTS, atol=1e-6)
+    assert np.allclose(lcf_out.chisqr, 0, atol=1e-10)
+    assert lcf_out.labels == ['FeS2', 'moved', 'broad']
+
+def test_matches_lincombo_fit(standards):
+    groups = _mixtures(standards, WEIGHTS[1:2] + WEIGHTS[3:])
+    lcf_out = athenamgr.lcf_groups(groups, standards, xmin=7080, xmax=7200)
+    for g_idx, group in enumerate(groups):
+        larch_out = lincombo_fit(group, standards, minvals=[0, 0, 0], xmin=7080, xmax=7200)
+        larch_weights = [larch_out.weights[label] for label in lcf_out.labels]
+        assert np.allclose(lcf_out.weights[g_idx], larch_weights, atol=1e-4)
+        # the exact solution is at least as good as the one of lmfit
+        assert lcf_out.chisqr[g_idx] <= larch_out.chisqr*(1 + 1e-9)
+        assert np.isclose(lcf_out.chisqr[g_idx], larch_out.chisqr, rtol=1e-2)
+
+def test_non_negative_matches_nnls():
+    rng = np.random.default_rng(2)
+    basis = rng.normal(size=(5, 60))
+    spectra = rng.normal(size=(20, 60))
+    lcf_out = athenamgr.lcf_solve(basis, spectra, sum_to_one=False)
+    for s_idx, spectrum in enumerate(spectra):
+        weights, _ = nnls(basis.T, spectrum)
+        assert np.allclose(lcf_out.weights[s_idx], weights, atol=1e-8)
+
+def test_non_negative_sum_to_one():
+    rng = np.random.default_rng(3)
+    basis = rng.normal(size=(4, 50))
+    spectra = rng.normal(size=(10, 50))
+    lcf_out = athenamgr.lcf_solve(basis, spectra)
+    assert np.allclose(lcf_out.weights.sum(axis=1), 1)
+    assert (lcf_out.weights >= 0).all()
+    # the sum to one is a heavily weighted extra row for nnls
+    scale = 1e4
+    for s_idx, spectrum in enumerate(spectra):
+        weights, _ = nnls(np.vstack((basis.T, scale*np.ones(4))), np.append(spectrum, scale))
+        assert np.allclose(lcf_out.weights[s_idx], weights, atol=1e-5)
+
+def test_unconstrained_matches_lstsq():
+    rng = np.random.default_rng(4)
+    basis = rng.normal(size=(3, 40))
+    spectra = rng.normal(size=(6, 40))
+    lcf_out = athenamgr.lcf_solve(basis, spectra, sum_to_one=False, non_negative=False)
+    weights = np.linalg.lstsq(basis.T, spectra.T, rcond=None)[0].T
+    assert np.allclose(lcf_out.weights, weights)
+    assert np.allclose(lcf_out.residual, spectra - weights @ basis)
+    # standard errors as the covariance of a linear least squares fit
+    covariance = np.linalg.inv(basis @ basis.T)
+    assert np.allclose(lcf_out.stderr, np.sqrt(np.diag(covariance)*lcf_out.redchi[:, np.newaxis]))
+
+def test_too_many_standards():
+    with pytest.raises(ValueError):
+        athenamgr.lcf_solve(np.eye(athenamgr.LCF_MAX_COMPONENTS + 1), np.ones(13))
@@ -0,0 +1,89 @@
+# Tests of the combinatorial linear combination fit (lcf_combinatorial)
+
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from larch import Group
+
+import lib.manage_athena as athenamgr
+
+
+# library of standards made from the example spectrum moved and broadened,
+# and groups that are mixtures of two of them
+@pytest.fixture
+def library(project_groups):
+    group = athenamgr.calc_with_defaults(project_groups[0])
+    energy = np.array(group.energy)
+    standards = []
+    for s_idx, (shift, width) in enumerate([(0, 0), (3, 0), (-3, 0), (0, 3), (6, 2), (-2, 5)]):
+        norm = np.interp(energy - shift, energy, group.norm)
+        if width > 0:
+            kernel = np.exp(-0.5*(np.arange(-12, 13)/width)**2)
+            norm = np.convolve(np.pad(norm, 12, mode='edge'), kernel/kernel.sum(), mode='valid')
+        standards.append(Group(energy=energy, norm=norm, filename='std%i' % s_idx))
+    return standards
+
+@pytest.fixture
+def mixtures(library):
+    rng = np.random.default_rng(5)
+    groups = []
+    for m_idx, (first, second, weight) in enumerate([(0, 1, 0.7), (2, 4, 0.4), (3, 5, 0.5)]):
+        norm = weight*library[first].norm + (1 - weight)*library[second].norm
+        groups.append(Group(energy=library[0].energy,
+                            norm=norm + 0.001*rng.normal(size=len(norm)),
+                            filename='mix%i' % m_idx))
+    return groups
+
+# every combination fitted with lcf_groups, ranked by reduced chi-square
+# (as lincombo_fitall)
+def _brute_force(groups, library, sizes):
+    results = []
+    for size in sizes:
+        for combo in combinations(range(len(library)), size):
+            lcf_out = athenamgr.lcf_groups(groups, [library[i] for i in combo])
+            results.append((combo, lcf_out))
+    ranked = []
+    for g_idx in range(len(groups)):
+        # combinations with a weight 0 are fits of smaller combinations
+        valid = [(lcf_out.redchi[g_idx], combo, lcf_out.weights[g_idx], lcf_out.chisqr[g_idx])
+                 for combo, lcf_out in results if (lcf_out.weights[g_idx] > 0).all()]
+        ranked.append(sorted(valid, key=lambda result: result[0]))
+    return ranked
+
+@pytest.mark.parametrize('sizes', [[2], [1, 2, 3]])
+def test_matches_brute_force(library, mixtures, sizes):
+    comb_out = athenamgr.lcf_combinatorial(mixtures, library, n_standards=sizes, top=5,
+                                           workers=1)
+    ranked = _brute_force(mixtures, library, sizes)
+    for g_idx in range(len(mixtures)):
+        n_found = min(5, len(ranked[g_idx]))
+        assert np.allclose(comb_out.redchi[g_idx, :n_found],
+                           [result[0] for result in ranked[g_idx][:n_found]])
+        assert np.allclose(comb_out.chisqr[g_idx, :n_found],
+                           [result[3] for result in ranked[g_idx][:n_found]])
+        for rank in range(n_found):
+            combo, weights = ranked[g_idx][rank][1:3]
+            assert comb_out.combinations[g_idx][rank] == ['std%i' % i for i in combo]
+            assert np.allclose(comb_out.weights[g_idx, rank, list(combo)], weights, atol=1e-8)
+
+def test_best_combination_found(library, mixtures):
+    comb_out = athenamgr.lcf_combinatorial(mixtures, library, n_standards=2, top=3, workers=1)
+    assert comb_out.combinations[0][0] == ['std0', 'std1']
+    assert comb_out.combinations[1][0] == ['std2', 'std4']
+    assert comb_out.combinations[2][0] == ['std3', 'std5']
+    assert np.allclose(comb_out.weights[0, 0, :2], [0.7, 0.3], atol=0.01)
+
+def test_workers_and_chunks_give_the_same_ranks(library, mixtures):
+    single = athenamgr.lcf_combinatorial(mixtures, library, n_standards=[2, 3], top=4, workers=1)
+    for options in ({'workers': 2}, {'workers': 1, 'chunk_size': 3}):
+        other = athenamgr.lcf_combinatorial(mixtures, library, n_standards=[2, 3], top=4,
+                                            **options)
+        assert other.combinations == single.combinations
+        assert np.allclose(other.chisqr, single.chisqr, equal_nan=True)
+        assert np.allclose(other.weights, single.weights)
+
+def test_invalid_number_of_standards(library, mixtures):
+    with pytest.raises(ValueError):
+        athenamgr.lcf_combinatorial(mixtures, library, n_standards=len(library) + 1)
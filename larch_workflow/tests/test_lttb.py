@@ -0,0 +1,51 @@
+# Tests of the downsampling of the plotted curves (lttb_indices)
+
+import numpy as np
+import pytest
+
+import lib.manage_athena as athenamgr
+
+
+# largest triangle three buckets written point by point, with the same
+# buckets as lttb_indices
+def _lttb_reference(x, y, max_points):
+    n_points = len(x)
+    starts = list(np.linspace(1, n_points - 1, max_points - 1).astype(int)) + [n_points]
+    kept = [0]
+    for bucket in range(max_points - 2):
+        start, end = starts[bucket], starts[bucket + 1]
+        next_end = starts[bucket + 2]
+        avg_x = np.mean(x[end:next_end])
+        avg_y = np.mean(y[end:next_end])
+        best, best_area = start, -1.0
+        for i in range(start, end):
+            area = abs((x[kept[-1]] - avg_x)*(y[i] - y[kept[-1]]) -
+                       (x[kept[-1]] - x[i])*(avg_y - y[kept[-1]]))
+            if area > best_area:
+                best, best_area = i, area
+        kept.append(best)
+    return np.array(kept + [n_points - 1])
+
+@pytest.mark.parametrize('max_points', [3, 50, 400])
+def test_matches_reference(max_points):
+    rng = np.random.default_rng(0)
+    x = np.sort(rng.uniform(0, 100, 3000))
+    y = np.sin(x/3) + 0.1*rng.normal(size=x.size)
+    shown = athenamgr.lttb_indices(x, y, max_points)
+    assert len(shown) == max_points
+    assert np.array_equal(shown, _lttb_reference(x, y, max_points))
+
+def test_keeps_ends_and_peaks(project_groups):
+    group = project_groups[0]
+    shown = athenamgr.lttb_indices(group.energy, group.mu, 100)
+    assert shown[0] == 0 and shown[-1] == len(group.energy) - 1
+    assert np.all(np.diff(shown) > 0)
+    # a spike is always kept
+    mu = np.array(group.mu, dtype=float)
+    mu[len(mu)//3] += 10
+    assert len(mu)//3 in athenamgr.lttb_indices(group.energy, mu, 100)
+
+@pytest.mark.parametrize('max_points', [None, 2, 10000])
+def test_all_points_kept(max_points):
+    x = np.linspace(0, 1, 500)
+    assert np.array_equal(athenamgr.lttb_indices(x, x**2, max_points), np.arange(500))
@@ -0,0 +1,79 @@
+# Tests of the rebinning of groups (rebin_group, bin_means, rebin_groups)
+
+import copy
+
+import numpy as np
+import pytest
+
+import lib.manage_athena as athenamgr
+
+
+# mean of the points in each bin written bin by bin
+def _bin_means_reference(energy, mu, new_energy):
+    means = []
+    for e_idx, center in enumerate(new_energy):
+        lower = center - (new_energy[max(e_idx, 1)] - new_energy[max(e_idx, 1) - 1])/2
+        upper = center + (new_energy[min(e_idx + 1, len(new_energy) - 1)] -
+                          new_energy[min(e_idx + 1, len(new_energy) - 1) - 1])/2
+        in_bin = (energy >= lower) & (energy < upper)
+        if in_bin.sum() < 3:
+            means.append(np.interp(center, energy, mu))
+        else:
+            means.append(mu[in_bin].mean())
+    return np.array(means)
+
+def test_bin_means_matches_reference():
+    energy = np.linspace(7000, 7500, 2001)
+    mu_stack = np.array([np.tanh((energy - 7112)/5), np.sin(energy/7)])
+    new_energy = np.concatenate((np.arange(7010, 7100, 5.0), np.arange(7100, 7130, 0.2),
+                                 np.arange(7130, 7490, 2.0)))
+    means = athenamgr.bin_means(energy, mu_stack, new_energy)
+    for mu, mu_means in zip(mu_stack, means):
+        assert np.allclose(mu_means, _bin_means_reference(energy, mu, new_energy))
+
+def test_rebin_group_keeps_the_data(project_groups):
+    group = athenamgr.calc_with_defaults(project_groups[0])
+    group.i0 = np.linspace(1.0, 2.0, len(group.energy))
+    before = copy.deepcopy(vars(group))
+    rebinned = athenamgr.rebin_group(group)
+    # the data group is not changed
+    for member, value in before.items():
+        if isinstance(value, np.ndarray):
+            assert np.array_equal(getattr(group, member), value)
+    assert rebinned.athena_params is group.athena_params
+    # e0 is found again from the rebinned mu (pre_edge)
+    assert abs(rebinned.e0 - group.e0) < 1.0
+    assert rebinned.energy.min() >= group.energy.min()
+    assert rebinned.energy.max() <= group.energy.max()
+    # the channels are rebinned to the new energy
+    assert len(rebinned.i0) == len(rebinned.energy)
+    assert np.allclose(rebinned.i0, np.interp(rebinned.energy, group.energy, group.i0), atol=1e-3)
+    assert len(rebinned.norm) == len(rebinned.energy)
+
+def test_rebin_group_without_e0(project_groups):
+    # read_athena of newer larch versions runs pre_edge, which sets e0
+    group = copy.copy(project_groups[0])
+    if hasattr(group, 'e0'):
+        del group.e0
+    rebinned = athenamgr.rebin_group(group)
+    assert abs(rebinned.e0 - athenamgr.find_e0(group.energy, mu=group.mu)) < 1.0
+    assert np.isfinite(rebinned.norm).all()
+
+def test_rebin_groups_on_common_grid(project_groups):
+    # the Fe K edge groups, one of them on shifted energy points
+    groups = [athenamgr.calc_with_defaults(group) for group in project_groups[:2]]
+    groups[1].energy = groups[1].energy + 1.5
+    rebinned = athenamgr.rebin_groups(groups)
+    energy = rebinned[0].energy
+    low = max(group.energy.min() for group in groups)
+    high = min(group.energy.max() for group in groups)
+    assert energy.min() >= low and energy.max() <= high
+    for group, group_rebinned in zip(groups, rebinned):
+        assert np.array_equal(group_rebinned.energy, energy)
+        expected = athenamgr.bin_means(group.energy, np.array([group.mu]), energy)[0]
+        assert np.allclose(group_rebinned.mu, expected)
+
+def test_rebin_groups_without_common_range(project_groups):
+    # Fe and Sn K edges
+    with pytest.raises(ValueError, match='energy range'):
+        athenamgr.rebin_groups([project_groups[0], project_groups[2]])
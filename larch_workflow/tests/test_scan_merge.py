@@ -0,0 +1,92 @@
+# Tests of the streaming merge of scans (ScanMerge, merge_readings_streaming)
+
+import numpy as np
+import pytest
+
+from larch import Group
+
+import lib.manage_athena as athenamgr
+
+
+# noisy scans of a measured spectrum, on its energy points
+def _scans(group, n_scans, noise=0.01, seed=0):
+    rng = np.random.default_rng(seed)
+    return [Group(energy=np.array(group.energy), mu=group.mu + noise*rng.normal(size=len(group.mu)))
+            for _ in range(n_scans)]
+
+def test_mean_and_std(project_groups):
+    scans = _scans(project_groups[0], 8)
+    merged = athenamgr.merge_readings_streaming(scan for scan in scans)
+    mu_stack = np.array([scan.mu for scan in scans])
+    assert np.allclose(merged.mu, mu_stack.mean(axis=0))
+    assert np.allclose(merged.mu_std, mu_stack.std(axis=0))
+    assert np.all(merged.mu_count == 8)
+    assert merged.n_scans == 8 and merged.rejected_scans == []
+
+def test_matches_merge_groups(project_groups):
+    scans = _scans(project_groups[0], 4)
+    merged = athenamgr.merge_readings_streaming(scans)
+    larch_merged = athenamgr.merge_readings(scans)
+    # merge_groups leaves out the last energy point
+    n_points = len(larch_merged.energy)
+    assert np.allclose(merged.energy[:n_points], larch_merged.energy)
+    assert np.allclose(merged.mu[:n_points], larch_merged.mu)
+
+def test_scan_on_part_of_the_grid(project_groups):
+    scans = _scans(project_groups[0], 3)
+    half = len(scans[2].energy)//2
+    scans[2] = Group(energy=scans[2].energy[:half], mu=scans[2].mu[:half])
+    merged = athenamgr.merge_readings_streaming(scans)
+    assert len(merged.energy) == len(scans[0].energy)
+    assert np.all(merged.mu_count[:half] == 3)
+    assert np.all(merged.mu_count[half:] == 2)
+    assert np.allclose(merged.mu[half:], (scans[0].mu[half:] + scans[1].mu[half:])/2)
+
+@pytest.mark.parametrize('rejection', ['sigma', 'median'])
+def test_glitch_rejected(project_groups, rejection):
+    scans = _scans(project_groups[0], 8)
+    clean = np.mean([scan.mu for scan in scans], axis=0)
+    glitch = len(clean)//2
+    glitch_scan = 1 if rejection == 'median' else 6
+    scans[glitch_scan].mu[glitch] += 5.0
+    merged = athenamgr.merge_readings_streaming(scans, rejection=rejection)
+    assert merged.mu_count[glitch] == 7
+    assert abs(merged.mu[glitch] - clean[glitch]) < 0.05
+    assert merged.rejected_points[glitch_scan] > 0
+    assert merged.rejected_scans == []
+
+# reference grid wider than the scans: no median or mean outside the scans
+@pytest.mark.parametrize('rejection', ['sigma', 'median'])
+def test_glitch_rejected_on_wider_grid(rejection):
+    rng = np.random.default_rng(1)
+    energy = np.linspace(10, 100, 181)
+    scans = [Group(energy=energy, mu=np.tanh(energy/20) + 0.01*rng.normal(size=len(energy)))
+             for _ in range(6)]
+    glitch_scan = 1 if rejection == 'median' else 5
+    scans[glitch_scan].mu[90] += 5.0
+    reference = Group(energy=np.linspace(0, 100, 201))
+    merged = athenamgr.merge_readings_streaming(scans, reference=reference, rejection=rejection)
+    assert merged.rejected_points[glitch_scan] > 0
+    assert merged.mu_count[np.argmin(np.abs(merged.energy - energy[90]))] == 5
+    assert merged.energy[0] == 10
+
+@pytest.mark.parametrize('rejection', ['sigma', 'median'])
+def test_bad_scan_rejected(project_groups, rejection):
+    scans = _scans(project_groups[0], 8)
+    scans[4].mu = scans[4].mu + 1.0
+    merged = athenamgr.merge_readings_streaming(scans, rejection=rejection)
+    assert merged.rejected_scans == [4]
+    good = [scan.mu for s_idx, scan in enumerate(scans) if s_idx != 4]
+    # a few points of the good scans can be rejected as well
+    assert np.abs(merged.mu - np.mean(good, axis=0)).max() < 0.02
+
+def test_unknown_rejection():
+    with pytest.raises(ValueError):
+        athenamgr.ScanMerge(rejection='mean')
+
+def test_few_false_rejections(project_groups):
+    # scans with only gaussian noise: few points beyond 3 sigma
+    scans = _scans(project_groups[0], 12, seed=3)
+    for rejection in ('sigma', 'median'):
+        merged = athenamgr.merge_readings_streaming(scans, rejection=rejection, min_scans=5)
+        assert np.mean(merged.rejected_points) < 0.02
@@ -0,0 +1,389 @@
+# Benchmarks for the workflow
+#
+# Times the main steps of the workflow with the sample data included in the
+# repository (larch_workflow: fes2_rt01_mar02.xmu, fes2_larch.prj, FeS2.inp,
+# FeS2_gds.csv, FeS2_sp.csv, and py_inputs: C12O12Rh4_nd.inp,
+# rh4co40_gds.csv, rh4co40_sp_nd.csv):
+#   - the library functions (read_text, calc_with_defaults, run_feff,
+#     read_selected_paths_list, run_fit, save_fit_report), repeated and
+#     timed in this process (run_feff, read_selected_paths_list and run_fit
+#     for the fes2 and rh4co inputs, the rh4co paths are fitted to the
+#     sample spectrum as there is no rh4co spectrum in the repository),
+#   - the fits for a batch of N synthetic spectra (copies of the sample
+#     spectrum with noise and a small energy shift),
+#   - the task scripts end to end (xas01_athena.py, xas02.01_feff.py,
+#     xas02.02_fit.py for each spectrum, as nextflow runs them, and
+#     larch_task02.py), for the same N spectra,
+#   - the start up of xas02.02_fit.py in headless mode (imports and
+#     definitions), checked against STARTUP_BUDGET.
+# The results are saved to a json file, and two results files can be
+# compared to find the benchmarks that became slower.
+#
+# Usage (from the nextflow_larch directory):
+#   python benchmarks/bench_workflow.py run results.json [n_list] [repeat]
+#       n_list: comma separated numbers of synthetic spectra (default 1,4)
+#       repeat: repetitions of the library benchmarks (default 5)
+#       exits with status 1 if the start up budget is exceeded
+#   python benchmarks/bench_workflow.py compare baseline.json results.json [tolerance]
+#       tolerance: relative increase of the median time reported as a
+#       regression (default 0.25), exits with status 1 if there are any
+#
+# time_call: times a function, returns the statistics.
+# startup_check: times the start up of xas02.02_fit.py and checks its budget.
+# make_synthetic: writes N synthetic spectra (text files and athena projects).
+# run_benchmarks: runs all the benchmarks, returns the results.
+# compare_results: compares results with a baseline, returns the regressions.
+
+# File handling
+from pathlib import Path
+import shutil
+import tempfile
+import os
+import sys
+# load read_text from the larch_workflow library
+import importlib.util
+# environment of the results
+import platform
+import json
+import time
+# run the task scripts
+import subprocess
+import logging
+
+import numpy as np
+
+# directories with the library, scripts and sample data
+NEXTFLOW_DIR = Path(__file__).resolve().parent.parent
+SAMPLE_DIR = NEXTFLOW_DIR.parent / "larch_workflow"
+INPUTS_DIR = NEXTFLOW_DIR / "py_inputs"
+sys.path.insert(0, str(NEXTFLOW_DIR))
+
+from larch import Interpreter
+from larch.io import read_athena, extract_athenagroup, create_athena
+import larch
+
+# Library with the functions that handle athena files
+import lib.manage_athena as athenamgr
+# Library with the functions that execute Atoms and FEFF
+import lib.atoms_feff as feff_runner
+# library containign functions tho manage fit
+import lib.manage_fit as fit_manager
+
+# fit variables used for the benchmarks (as in py_inputs/t2_nd.ini)
+FIT_VARS = {'fitspace': 'r', 'kmin': 3, 'kmax': 14, 'kw': 2, 'dk': 1,
+            'window': 'hanning', 'rmin': 1.4, 'rmax': 3.0}
+
+# sample inputs: crystal file, gds parameters and selected paths
+FES2 = {'crystal': SAMPLE_DIR / "FeS2.inp",
+        'gds': SAMPLE_DIR / "FeS2_gds.csv",
+        'sp': SAMPLE_DIR / "FeS2_sp.csv"}
+RH4CO = {'crystal': INPUTS_DIR / "C12O12Rh4_nd.inp",
+         'gds': INPUTS_DIR / "rh4co40_gds.csv",
+         'sp': INPUTS_DIR / "rh4co40_sp_nd.csv"}
+SAMPLE_XMU = SAMPLE_DIR / "fes2_rt01_mar02.xmu"
+SAMPLE_PRJ = SAMPLE_DIR / "fes2_larch.prj"
+
+# start up budget of xas02.02_fit.py in headless mode: time (s) to run its
+# imports and definitions after larch has been imported, and modules for
+# interactive use or plotting that must not be loaded at start up
+STARTUP_BUDGET = 0.5
+HEADLESS_MODULES = ('ipysheet', 'matplotlib.pyplot')
+
+# run in a new process: import larch, then the task script (without
+# running it), print the times and the interactive modules loaded
+STARTUP_CODE = '''
+import json, runpy, sys, time
+start = time.perf_counter()
+import larch, larch.io, larch.xafs
+larch_time = time.perf_counter() - start
+runpy.run_path(sys.argv[1], run_name='startup')
+script_time = time.perf_counter() - start - larch_time
+print(json.dumps({'larch': larch_time, 'script': script_time,
+                  'loaded': [name for name in sys.argv[2:] if name in sys.modules]}))
+'''
+
+
+# read_text is only defined in the larch_workflow library (also named lib),
+# which is loaded as the package larch_workflow_lib so its modules import
+# each other from its directory
+def load_read_text():
+    lib_dir = SAMPLE_DIR / "lib"
+    if "larch_workflow_lib" not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            "larch_workflow_lib", lib_dir / "__init__.py",
+            submodule_search_locations=[str(lib_dir)])
+        package = importlib.util.module_from_spec(spec)
+        sys.modules["larch_workflow_lib"] = package
+        spec.loader.exec_module(package)
+    return importlib.import_module("larch_workflow_lib.manage_athena").read_text
+
+ #######################################################
+# |                  Time a function                  | #
+# | func: function without arguments                  | #
+# | repeat: number of times to call it                | #
+# | n_items: items processed by each call (used for   | #
+# |     the time per item)                            | #
+# V returns a dictionary with the timing statistics   V #
+ #######################################################
+def time_call(func, repeat=1, n_items=1):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return time_stats(times, n_items)
+
+# statistics for the times (s) of the repetitions of a benchmark
+def time_stats(times, n_items=1):
+    return {'n': n_items,
+            'repeat': len(times),
+            'times': times,
+            'min': min(times),
+            'median': float(np.median(times)),
+            'mean': float(np.mean(times)),
+            'per_item': float(np.median(times)) / n_items}
+
+# time a task script run in the working directory (the script output is
+# discarded), the benchmark fails if the script returns an error
+def time_script(script, args, work_dir, n_items=1):
+    def run_script():
+        subprocess.run([sys.executable, str(NEXTFLOW_DIR / script)] + [str(arg) for arg in args],
+                       cwd=work_dir, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time_call(run_script, 1, n_items)
+
+# time the start up of xas02.02_fit.py in headless mode (new process each
+# time, without a display), returns the timing statistics and the check
+# against the budget
+def startup_check(repeat=5):
+    env = dict(os.environ, MPLBACKEND='Agg')
+    env.pop('DISPLAY', None)
+    runs = []
+    def start_script():
+        proc = subprocess.run([sys.executable, '-c', STARTUP_CODE,
+                               str(NEXTFLOW_DIR / "xas02.02_fit.py")] + list(HEADLESS_MODULES),
+                              cwd=NEXTFLOW_DIR, env=env, check=True,
+                              capture_output=True, text=True)
+        runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    total = time_call(start_script, repeat)
+    overhead = time_stats([run['script'] for run in runs])
+    loaded = sorted(set(name for run in runs for name in run['loaded']))
+    check = {'budget': STARTUP_BUDGET,
+             'script': overhead['median'],
+             'larch': float(np.median([run['larch'] for run in runs])),
+             'loaded': loaded,
+             'passed': overhead['median'] <= STARTUP_BUDGET and not loaded}
+    return total, overhead, check
+
+ #######################################################
+# |            Write N synthetic spectra              | #
+# | copies of the sample spectrum with noise and an   | #
+# | energy shift (fixed seed), written as text files  | #
+# V (dat_dir) and athena projects (prj_dir)           V #
+ #######################################################
+def make_synthetic(n_spectra, dat_dir, prj_dir, seed=0):
+    rng = np.random.default_rng(seed)
+    dat_dir.mkdir(parents=True, exist_ok=True)
+    prj_dir.mkdir(parents=True, exist_ok=True)
+    sample_prj = read_athena(SAMPLE_PRJ)
+    group_key = list(sample_prj._athena_groups.keys())[0]
+    prj_files = []
+    for i_spec in range(n_spectra):
+        a_group = extract_athenagroup(sample_prj._athena_groups[group_key])
+        shift = rng.normal(0, 0.5)
+        a_group.energy = a_group.energy + shift
+        a_group.mu = a_group.mu + rng.normal(0, 2.e-4, len(a_group.mu))
+        # text file without header (columns read as col1 and col2)
+        np.savetxt(dat_dir / ("synth_%05i.dat" % (i_spec + 1)),
+                   np.column_stack((a_group.energy, a_group.mu)), fmt='%.6f')
+        a_group.filename = "synth_%05i" % (i_spec + 1)
+        prj_file = prj_dir / ("synth_%05i.prj" % (i_spec + 1))
+        xas_project = create_athena(prj_file)
+        xas_project.add_group(a_group)
+        xas_project.save()
+        prj_files.append(prj_file)
+    return prj_files
+
+# ini file for the task scripts
+def write_ini(ini_file, data_dir, f_prefix, inputs, top_count):
+    lines = ['[DEFAULT]',
+             'data_path = ' + str(data_dir),
+             'file_pattern = *.prj',
+             'f_prefix = ' + f_prefix,
+             'crystal_files = ' + repr([inputs['crystal'].name]),
+             'gds_parms_f = ' + inputs['gds'].name,
+             'sel_paths_f = ' + inputs['sp'].name,
+             'top_count = ' + str(top_count)]
+    lines += ['%s = %s' % (name, value) for name, value in FIT_VARS.items()]
+    Path(ini_file).write_text('\n'.join(lines) + '\n')
+
+# copy the inputs to the working directory (the selected paths files use
+# paths relative to it)
+def copy_inputs(work_dir):
+    for inputs in (FES2, RH4CO):
+        for input_file in inputs.values():
+            shutil.copy(input_file, work_dir)
+    shutil.copy(SAMPLE_XMU, work_dir)
+
+ #######################################################
+# |               Run all the benchmarks              | #
+# | n_list: numbers of synthetic spectra for the      | #
+# |     batch and end to end benchmarks               | #
+# | repeat: repetitions of the library benchmarks     | #
+# V returns a dictionary with the results             V #
+ #######################################################
+def run_benchmarks(n_list=(1, 4), repeat=5):
+    results = {}
+    session = Interpreter()
+    read_text = load_read_text()
+    start_dir = os.getcwd()
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_larch_"))
+    try:
+        os.chdir(work_dir)
+        copy_inputs(work_dir)
+
+        # start up of the fit task
+        results['startup.xas02.02_fit'], results['startup.xas02.02_fit.script'], \
+            startup = startup_check(repeat)
+
+        # library functions
+        results['read_text'] = time_call(lambda: read_text(SAMPLE_XMU.name, "energy mu i0"), repeat)
+        sample_prj = read_athena(SAMPLE_PRJ)
+        group_key = list(sample_prj._athena_groups.keys())[0]
+        results['calc_with_defaults'] = time_call(
+            lambda: athenamgr.calc_with_defaults(
+                extract_athenagroup(sample_prj._athena_groups[group_key])), repeat)
+        for name, inputs in (('fes2', FES2), ('rh4co', RH4CO)):
+            results['run_feff.' + name] = time_call(
+                lambda: feff_runner.run_feff([inputs['crystal'].name]), 1)
+            results['read_selected_paths_list.' + name] = time_call(
+                lambda: fit_manager.read_selected_paths_list(inputs['sp'].name, session), repeat)
+
+        data_group = athenamgr.calc_with_defaults(
+            extract_athenagroup(sample_prj._athena_groups[group_key]))
+        fit_out = {}
+        for name, inputs in (('rh4co', RH4CO), ('fes2', FES2)):
+            selected_paths = fit_manager.read_selected_paths_list(inputs['sp'].name, session)
+            def fit_once():
+                gds = fit_manager.read_gds(inputs['gds'].name, session)
+                fit_out['out'] = fit_manager.run_fit(data_group, gds, selected_paths,
+                                                     FIT_VARS, session)[2]
+            results['run_fit.' + name] = time_call(fit_once, repeat)
+        # report of the fes2 fit (the last one), the batch uses its paths
+        report_file = work_dir / "bench_fit_rep.txt"
+        def save_report():
+            report_file.unlink(missing_ok=True)
+            fit_manager.save_fit_report(fit_out['out'], report_file, session)
+        results['save_fit_report'] = time_call(save_report, repeat)
+
+        results['xas02.01_feff'] = time_script("xas02.01_feff.py", [FES2['crystal'].name],
+                                               work_dir)
+
+        # batch of synthetic spectra and the task scripts end to end
+        for n_spectra in n_list:
+            n_dir = work_dir / ("n%i" % n_spectra)
+            prj_files = make_synthetic(n_spectra, n_dir / "dat", n_dir / "prj")
+            def fit_batch():
+                for prj_file in prj_files:
+                    a_prj = read_athena(prj_file)
+                    a_key = list(a_prj._athena_groups.keys())[0]
+                    a_group = athenamgr.calc_with_defaults(
+                        extract_athenagroup(a_prj._athena_groups[a_key]))
+                    gds = fit_manager.read_gds(FES2['gds'].name, session)
+                    fit_manager.run_fit(a_group, gds, selected_paths, FIT_VARS, session)
+            results['batch_fit.n%i' % n_spectra] = time_call(fit_batch, 1, n_spectra)
+
+            results['xas01_athena.n%i' % n_spectra] = time_script(
+                "xas01_athena.py", [str(n_dir / "dat") + "/*.dat", "synth"], n_dir, n_spectra)
+            ini_file = n_dir / "bench.ini"
+            write_ini(ini_file, n_dir / "prj", "bench_n%i" % n_spectra, FES2, n_spectra)
+            def fit_scripts():
+                for prj_file in prj_files:
+                    subprocess.run([sys.executable, str(NEXTFLOW_DIR / "xas02.02_fit.py"),
+                                    str(ini_file), str(prj_file), "bench_n%i" % n_spectra,
+                                    FES2['gds'].name, FES2['sp'].name],
+                                   cwd=work_dir, check=True,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            results['xas02.02_fit.n%i' % n_spectra] = time_call(fit_scripts, 1, n_spectra)
+            results['larch_task02.n%i' % n_spectra] = time_script(
+                "larch_task02.py", [ini_file], work_dir, n_spectra)
+    finally:
+        os.chdir(start_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'larch': larch.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'startup': startup,
+            'results': results}
+
+ #######################################################
+# |        Compare results with a baseline            | #
+# | tolerance: relative increase of the median time   | #
+# |     reported as a regression                      | #
+# V returns the names of the slower benchmarks        V #
+ #######################################################
+def compare_results(baseline, current, tolerance=0.25):
+    regressions = []
+    print("%-36s %12s %12s %8s" % ("benchmark", "baseline(s)", "current(s)", "ratio"))
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            print("%-36s %12s %12.4f %8s" % (name, "-", result['median'], "new"))
+            continue
+        base_time = baseline['results'][name]['median']
+        ratio = result['median'] / base_time if base_time > 0 else np.inf
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1/(1 + tolerance):
+            flag = 'faster'
+        print("%-36s %12.4f %12.4f %8.2f %s" % (name, base_time, result['median'], ratio, flag))
+    for name in baseline['results']:
+        if name not in current['results']:
+            print("%-36s missing from current results" % name)
+    return regressions
+
+def read_results(results_file):
+    with open(results_file, encoding="utf8") as in_file:
+        return json.load(in_file)
+
+def save_results(results, results_file):
+    with open(results_file, 'w', encoding="utf8") as out_file:
+        json.dump(results, out_file, indent=2)
+
+
+# do not run if only importing function(s)
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('run', 'compare'):
+        print("usage: bench_workflow.py run results.json [n_list] [repeat]")
+        print("       bench_workflow.py compare baseline.json results.json [tolerance]")
+        sys.exit(2)
+    # keep the larch warnings out of the timings output
+    logging.getLogger().setLevel(logging.ERROR)
+    if sys.argv[1] == 'run':
+        n_list = [int(n) for n in sys.argv[3].split(',')] if len(sys.argv) > 3 else [1, 4]
+        repeat = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+        results_file = Path(sys.argv[2]).resolve()
+        results = run_benchmarks(n_list, repeat)
+        save_results(results, results_file)
+        for name, result in results['results'].items():
+            print("%-36s median %10.4f s  per item %10.4f s" % (name, result['median'],
+                                                                 result['per_item']))
+        startup = results['startup']
+        print("start up of xas02.02_fit.py: %.3f s after importing larch (%.3f s), budget %.3f s: %s"
+              % (startup['script'], startup['larch'], startup['budget'],
+                 'passed' if startup['passed'] else 'FAILED'))
+        if startup['loaded']:
+            print("modules loaded at start up: " + ', '.join(startup['loaded']))
+        if not startup['passed']:
+            sys.exit(1)
+    else:
+        tolerance = float(sys.argv[4]) if len(sys.argv) > 4 else 0.25
+        regressions = compare_results(read_results(sys.argv[2]), read_results(sys.argv[3]),
+                                      tolerance)
+        if regressions:
+            print("regressions: " + ', '.join(regressions))
+            sys.exit(1)
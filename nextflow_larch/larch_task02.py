@@ -14,15 +14,17 @@ from larch import Interpreter
 
 # File handling
 from pathlib import Path
+# journal entry recorded when the plots of a fit are saved
+import functools
 
-#plotting library
-import matplotlib.pyplot as plt
 
 # subprocess library used to run perl script
 import subprocess
 
 #library for writing to log
 import logging
+# queue based log file shared with the worker processes
+import lib.batch_logging as batch_logging
 
 
 # Library with the functions that handle athena files
@@ -37,6 +39,21 @@ import lib.atoms_feff as feff_runner
 # GDS parameters, and scattering paths. 
 import lib.manage_fit as fit_manager  
 
+# journal of completed fits for resuming interrupted batches
+import lib.fit_journal as fit_journal
+# status codes of the fits
+import lib.fit_budget as fit_budget
+# cheap checks of the spectra before the fits
+import lib.prescreen as prescreen
+# timing of the stages (LARCH_TRACE=trace.json)
+import lib.tracing as tracing
+# plots to save
+import lib.plot_canvas as plot_canvas
+# rendering of the plots in a separate process
+import lib.plot_pool as plot_pool
+# arrays of the fits for the batch QA report
+import lib.qa_report as qa_report
+
 # managing parameters
 import sys
 
@@ -50,23 +67,9 @@ import configparser
 #
 # Functions (methods) for processing XAS files.
 #
-# set_logger: intialises the logging.
 # get_files_list: returns a list of files in the directory matching the given file pattern.
-
- #######################################################
-# |                Initialise log file                | #
-# V  provide the path and name of the log file to use V #
- #######################################################
-    
-def set_logger(log_file):
-    logger = logging.getLogger()
-    fhandler = logging.FileHandler(filename=log_file, mode='a')
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fhandler.setFormatter(formatter)
-    logger.addHandler(fhandler)
-    # prevent matplotlib font manager from writing to log
-    logging.getLogger('matplotlib.font_manager').disabled = True
-    logger.setLevel(logging.DEBUG)
+# read_data_group: reads the first group of an athena file and recalculates it with defaults.
+# record_with_plots: records a fit in the journal once its plots are saved.
 
  #######################################################
 # |                  Get a list of files              | #
@@ -82,12 +85,48 @@ def get_files_list(source_dir, f_pattern):
         files_list.append(filepath)
     return files_list
 
+ #######################################################
+# |       Read the data group from an athena file     | #
+# V    returns the group name and the data group      V #
+ #######################################################
+
+def read_data_group(a_file):
+    data_prj = athenamgr.read_project(a_file)
+    group_keys = list(data_prj._athena_groups.keys())
+    athena_group = extract_athenagroup(data_prj._athena_groups[group_keys[0]])
+    # recalculate norm, background removal and fourier transform 
+    # with defaults
+    return group_keys[0], athenamgr.calc_with_defaults(athena_group)
+
+# name of the outputs of a file (<name>_fit_rep.txt, plots...): the name of
+# its first group, or the file name (stem) when the file cannot be read, as
+# its groups are not known. The journal records the input file with its
+# outputs either way.
+def output_name(a_file, group_name=None):
+    return Path(a_file).stem if group_name is None else group_name
+
+# record a file that cannot be read as failed, with a failure report
+# named after the file (output_name)
+def record_read_failure(journal_file, base_path, a_file, file_hash, read_error, resume=False):
+    fit_file = Path("./",base_path,output_name(a_file)+"_fit_rep.txt")
+    if resume:
+        fit_file.unlink(missing_ok=True)
+    fit_manager.save_fit_failure(read_error, fit_file)
+    fit_journal.record_fit(journal_file, a_file, file_hash, [fit_file], fit_budget.FIT_FAILED)
+    return fit_file
+
+# record a completed fit in the journal with the files of its plots
+def record_with_plots(journal_file, a_file, file_hash, fit_outputs, status, plot_files):
+    fit_journal.record_fit(journal_file, a_file, file_hash, fit_outputs + list(plot_files), status)
 
 # session object
 session = Interpreter()
 
+# argv: ini file name and optional --resume flag to skip the files
+#       already fitted (recorded in the journal) with the same inputs
 def start_task(argv):
     print('Argument List:', argv)
+    resume = '--resume' in argv[1:]
     try:
         if len (argv) < 1:
             print ("Need to provide configuration file name")
@@ -109,6 +148,14 @@ def start_task(argv):
                 sel_paths_f = fit_config['DEFAULT']["sel_paths_f"]
                 top_count = int(fit_config['DEFAULT']["top_count"])
                 show_graph = False # False to prevent showing graphs
+                # optional plots saved for each fit: nme, rmr, chikr, all or none (default)
+                plots = plot_canvas.plot_selection(fit_config['DEFAULT'].get("plots", "none"))
+                # optional processes rendering the plots (0 renders them in the task)
+                plot_workers = fit_config['DEFAULT'].getint("plot_workers", 1)
+                # optional arrays of the fits for the batch QA report (lib/qa_report.py)
+                qa_data = fit_config['DEFAULT'].getboolean("qa_data", False)
+                # optional number of files read and pre-screened together
+                prescreen_chunk = fit_config['DEFAULT'].getint("prescreen_chunk", prescreen.PRESCREEN_CHUNK)
                 
                 # read variables for fit from config file
                 fit_vars = {}
@@ -120,6 +167,22 @@ def start_task(argv):
                 fit_vars['window']=fit_config['DEFAULT']["window"]
                 fit_vars['rmin']=float(fit_config['DEFAULT']["rmin"])
                 fit_vars['rmax']=float(fit_config['DEFAULT']["rmax"])
+                # optional fit backend: feffit (default) or basis
+                fit_vars['engine']=fit_config['DEFAULT'].get("fit_engine", "feffit")
+                # optional analytic jacobian for the basis engine
+                fit_vars['jacobian']=fit_config['DEFAULT'].get("fit_jacobian", None)
+                # optional limits for each fit: evaluations and time in seconds
+                fit_vars['max_nfev']=fit_config['DEFAULT'].getint("fit_max_nfev", None)
+                fit_vars['timeout']=fit_config['DEFAULT'].getfloat("fit_timeout", None)
+                # optional bootstrap uncertainties: number of replicas and processes
+                fit_vars['bootstrap']=fit_config['DEFAULT'].getint("bootstrap", 0)
+                fit_vars['bootstrap_workers']=fit_config['DEFAULT'].getint("bootstrap_workers", None)
+                # optional pre-screen of the spectra: off (default), flag or skip
+                fit_vars['prescreen']=fit_config['DEFAULT'].get("prescreen", "off")
+                fit_vars['prescreen_max_noise']=fit_config['DEFAULT'].getfloat("prescreen_max_noise", None)
+                fit_vars['prescreen_min_edge_step']=fit_config['DEFAULT'].getfloat("prescreen_min_edge_step", None)
+                fit_vars['prescreen_max_edge_step']=fit_config['DEFAULT'].getfloat("prescreen_max_edge_step", None)
+                fit_vars['prescreen_max_rfactor']=fit_config['DEFAULT'].getfloat("prescreen_max_rfactor", None)
             else:
                 print("invalid or non existent ini file")
     except:
@@ -132,7 +195,9 @@ def start_task(argv):
     log_file = Path("./",base_path,"process.log")
     print(log_file)
     # set path for log
-    set_logger(log_file)
+    batch_logging.set_logger(log_file)
+    # the trace of the batch starts without the events of previous batches
+    tracing.start_batch_trace()
 
     # get the list of files to process
     source_path = Path(data_path)
@@ -158,56 +223,173 @@ def start_task(argv):
     logging.info("\twindow  = " + str(fit_vars['window']))
     logging.info("\trmin  = " + str(fit_vars['rmin']))
     logging.info("\trmax  = " + str(fit_vars['rmax']))
+    logging.info("\tresume  = " + str(resume))
+    logging.info("\tprescreen  = " + str(fit_vars['prescreen']))
+    logging.info("\tplots  = " + ', '.join(plots))
+
+    # journal of completed fits, the hash of each file's inputs includes
+    # the gds parameters, selected paths, crystal files and fit variables
+    journal_file = Path("./",base_path,"fit_journal.jsonl")
+    completed = fit_journal.read_journal(journal_file) if resume else {}
+    common_hash = fit_journal.inputs_hash([gds_parms_f, sel_paths_f] + crystal_files, fit_vars)
 
     # run feff on crystal file to generate scattering paths
     feff_runner.run_feff(crystal_files)
     logging.info("Completed FEFF")
-    
-    # counter for break
-    i_count = 0
-    for a_file in files_list:
-        # read the gds parameters from input file
+
+    # pre-screen the files to fit in chunks of prescreen_chunk files, only
+    # the results are kept and the groups are read again for the fits. The
+    # files that cannot be read are not pre-screened (their fit fails)
+    screened = {}
+    if fit_vars['prescreen'] != prescreen.PRESCREEN_OFF:
         gds = fit_manager.read_gds(gds_parms_f, session)
-        logging.info("GDS Parameters read OK")
-        project_name = a_file.name
-        data_prj = read_athena(a_file)
-        group_keys = list(data_prj._athena_groups.keys())
-        athena_group = extract_athenagroup(data_prj._athena_groups[group_keys[0]])
-        # recalculate norm, background removal and fourier transform 
-        # with defaults
-        data_group = athenamgr.calc_with_defaults(athena_group)
-
-        # read the selected paths list to access relevant paths 
-        # generated from FEFF
         selected_paths = fit_manager.read_selected_paths_list(sel_paths_f, session)
-        logging.info("Selected Paths read from " + sel_paths_f + " OK")
-        # run fit
-        trans, dset, out = fit_manager.run_fit(data_group, gds, selected_paths, fit_vars, session)
-
-        if show_graph:    
-            # plot normalised mu on energy
-            # plot mu vs flat normalised mu for selected groups
-            plt = athenamgr.plot_normalised(data_group)
-            plt.show()
-            # overlapped chi(k) and chi(R) plots (similar to Demeter's Rmr plot)
-            rmr_p = fit_manager.plot_rmr(dset,fit_vars['rmin'],fit_vars['rmax'])
-            rmr_p.show()
-            # separate chi(k) and chi(R) plots
-            chikr_p = fit_manager.plot_chikr(dset,fit_vars['rmin'],fit_vars['rmax'],fit_vars['kmin'],fit_vars['kmax'])
-            chikr_p.show()
-            
-        #save the fit report to a text file
-        fit_file = Path("./",base_path,group_keys[0]+"_fit_rep.txt")
-        fit_manager.save_fit_report(out, fit_file, session)
+        batch = files_list[:top_count] if top_count > 0 else files_list
+        to_screen = [a_file for a_file in batch if not fit_journal.is_completed(
+            completed, a_file, fit_journal.inputs_hash([a_file], prefix=common_hash))]
+        results = []
+        with tracing.span('prescreen', 'task', files=len(to_screen)):
+            for chunk_start in range(0, len(to_screen), max(1, prescreen_chunk)):
+                chunk_files, chunk_names, chunk_groups = [], [], []
+                for a_file in to_screen[chunk_start:chunk_start + max(1, prescreen_chunk)]:
+                    try:
+                        group_name, data_group = read_data_group(a_file)
+                    except Exception as read_error:
+                        logging.error("Pre-screen could not read " + str(a_file) + ": " +
+                                      str(read_error))
+                        continue
+                    chunk_files.append(a_file)
+                    chunk_names.append(group_name)
+                    chunk_groups.append(data_group)
+                if len(chunk_groups) == 0:
+                    continue
+                chunk_results = prescreen.prescreen_groups(chunk_groups, gds, selected_paths,
+                                                           fit_vars, session, names=chunk_names)
+                screened.update(zip(chunk_files, chunk_results))
+                results += chunk_results
+        prescreen.save_prescreen(results, Path("./",base_path,"prescreen.csv"))
+        logging.info("Pre-screen: " + str(sum(result['passed'] for result in results)) +
+                     " of " + str(len(results)) + " files passed")
+
+    # the plots of each file are rendered while the next files are fitted
+    with plot_pool.PlotPool(plots, plot_workers) as pool:
+        # counter for break
+        i_count = 0
+        for a_file in files_list:
+            batch_logging.set_log_context(file=a_file.name, stage='read')
+            file_hash = fit_journal.inputs_hash([a_file], prefix=common_hash)
+            if fit_journal.is_completed(completed, a_file, file_hash):
+                i_count +=1
+                logging.info("Skipped completed file: "+ str(i_count) +" " + str(a_file))
+                if i_count == top_count:
+                    break
+                continue
+            # read the gds parameters from input file
+            gds = fit_manager.read_gds(gds_parms_f, session)
+            logging.info("GDS Parameters read OK")
+            project_name = a_file.name
+            try:
+                group_name, data_group = read_data_group(a_file)
+            except Exception as read_error:
+                # an unreadable file is recorded as failed and the batch moves on
+                logging.error("Could not read " + str(a_file) + ": " + str(read_error))
+                record_read_failure(journal_file, base_path, a_file, file_hash, read_error,
+                                    resume)
+                i_count +=1
+                if i_count == top_count:
+                    break
+                continue
+            group_keys = [group_name]
 
-        i_count +=1
+            # read the selected paths list to access relevant paths 
+            # generated from FEFF
+            selected_paths = fit_manager.read_selected_paths_list(sel_paths_f, session)
+            logging.info("Selected Paths read from " + sel_paths_f + " OK")
+            fit_file = Path("./",base_path,output_name(a_file, group_keys[0])+"_fit_rep.txt")
+            boot_file = Path("./",base_path,output_name(a_file, group_keys[0])+"_bootstrap.csv")
+            if resume:
+                # remove partial outputs of a fit that was interrupted
+                fit_file.unlink(missing_ok=True)
+                boot_file.unlink(missing_ok=True)
+            screen = screened.get(a_file, None)
+            if screen is not None and not screen['passed']:
+                logging.warning("Pre-screen flags for " + group_keys[0] + ": " + '; '.join(screen['flags']))
+                if fit_vars['prescreen'] == prescreen.PRESCREEN_SKIP:
+                    # the spectrum is not fitted, only its pre-screen is reported
+                    with open(fit_file, "a") as f:
+                        f.write(prescreen.screen_report(screen))
+                    fit_journal.record_fit(journal_file, a_file, file_hash, [fit_file],
+                                           fit_budget.FIT_SKIPPED)
+                    i_count +=1
+                    logging.info("Skipped file: "+ str(i_count) +" " + group_keys[0])
+                    if i_count == top_count:
+                        break
+                    continue
+            # run fit, a fit that fails is recorded and the batch moves on
+            batch_logging.set_log_context(stage='fit')
+            try:
+                trans, dset, out = fit_manager.run_fit(data_group, gds, selected_paths, fit_vars, session)
+            except Exception as fit_error:
+                logging.error("Fit failed for " + group_keys[0] + ": " + str(fit_error))
+                fit_manager.save_fit_failure(fit_error, fit_file)
+                fit_journal.record_fit(journal_file, a_file, file_hash, [fit_file],
+                                       fit_budget.FIT_FAILED)
+                i_count +=1
+                if i_count == top_count:
+                    break
+                continue
+            logging.info("Fit status: " + out.fit_status_message)
+
+            if show_graph:    
+                # plot normalised mu on energy
+                # plot mu vs flat normalised mu for selected groups
+                plt = athenamgr.plot_normalised(data_group)
+                plt.show()
+                # overlapped chi(k) and chi(R) plots (similar to Demeter's Rmr plot)
+                rmr_p = fit_manager.plot_rmr(dset,fit_vars['rmin'],fit_vars['rmax'])
+                rmr_p.show()
+                # separate chi(k) and chi(R) plots
+                chikr_p = fit_manager.plot_chikr(dset,fit_vars['rmin'],fit_vars['rmax'],fit_vars['kmin'],fit_vars['kmax'])
+                chikr_p.show()
+            if len(plots) > 0 or qa_data:
+                plot_data = plot_pool.fit_plot_data(data_group, dset, fit_vars)
+
+            #save the fit report to a text file
+            batch_logging.set_log_context(stage='report')
+            fit_manager.save_fit_report(out, fit_file, session)
+            if screen is not None and not screen['passed']:
+                with open(fit_file, "a") as f:
+                    f.write(prescreen.screen_report(screen))
+            fit_outputs = [fit_file]
+            if qa_data:
+                qa_file = Path("./",base_path,output_name(a_file, group_keys[0])+qa_report.QA_SUFFIX)
+                fit_outputs.append(qa_report.save_qa_data(plot_data, out,
+                                                          output_name(a_file, group_keys[0]),
+                                                          qa_file))
+            if hasattr(out, 'bootstrap'):
+                fit_manager.save_bootstrap(out, boot_file)
+                fit_outputs.append(boot_file)
+            # the fit is recorded in the journal with its plots, once they are
+            # rendered (a fit whose plots are not finished is done again on resume)
+            record_done = functools.partial(record_with_plots, journal_file, a_file, file_hash,
+                                            fit_outputs, out.fit_status)
+            if len(plots) > 0:
+                batch_logging.set_log_context(stage='plot')
+                pool.submit(plot_data, base_path, group_keys[0], done=record_done)
+            else:
+                record_done([])
+
+            i_count +=1
         
-        logging.info("Processed file: "+ str(i_count) +" " + group_keys[0])
+            logging.info("Processed file: "+ str(i_count) +" " + group_keys[0])
         
-        if i_count == top_count:
-            break
-       
+            if i_count == top_count:
+                break
+
+        batch_logging.set_log_context(file=None, stage=None)
     logging.info("Finished processing")            
+    # stage timings of all the processes of the batch (when tracing is on)
+    tracing.finish_batch_trace()
 
         
 # To avoid running if the intention was only to import a function
@@ -17,6 +17,9 @@ from larch.xafs.feffrunner import feff6l
 from pathlib import Path
 import shutil
 
+# timing of the stages
+import lib.tracing as tracing
+
 
 def run_atoms(crystal_f, feff_dir, feff_inp):  
     result = False
@@ -51,6 +54,7 @@ def run_feff(input_files):
             atoms_ok = copy_to_feff_dir(crystal_f, Path(feff_dir, feff_inp))
         if atoms_ok:
             # run feff to generate the scattering paths 
-            feff6l(folder = feff_dir, feffinp=feff_inp)
+            with tracing.span('feff', 'feff', file=crystal_f.name):
+                feff6l(folder = feff_dir, feffinp=feff_inp)
             feff_dir_list.append(feff_dir)
     return feff_dir_list
@@ -0,0 +1,141 @@
+# Logging for batch runs
+#
+# The log records are put on a queue by the tasks (and by the worker
+# processes of the fits), and written to the log file by a single listener
+# thread, so the tasks do not wait for the file and the processes do not
+# write to the same file at the same time. Setting the logger again for
+# the same file does not add more handlers (no duplicated lines).
+#
+# Each record includes the context where it was logged: the worker
+# (process name) and the file and stage set with log_context.
+#
+# set_logger: starts the listener for the log file and sends the records
+#             of the root logger to it.
+# worker_logging_args: queue, level and context to pass to the workers.
+# init_worker_logging: sends the records of a worker process to the queue
+#                      (initializer of the process pools).
+# log_context: sets the file and stage added to the records in a block.
+# set_log_context: sets the file and stage for the records that follow.
+# stop_logging: writes the records left on the queue and stops the listener.
+
+# the listener is stopped at exit
+import atexit
+import contextvars
+from contextlib import contextmanager
+import logging
+import logging.handlers
+# queue shared with the worker processes
+import multiprocessing
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(worker)s%(context)s] %(message)s'
+
+# context of the records (file and stage)
+_context = contextvars.ContextVar('log_context', default={})
+# queue, listener and log file of this process
+_logging = {'queue': None, 'listener': None, 'handler': None, 'file': None}
+
+
+# adds the worker and context to the records (before they are queued)
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.worker = multiprocessing.current_process().name
+        context = _context.get()
+        record.context = ''.join(' %s=%s' % (key, value) for key, value in context.items())
+        return True
+
+def _queue_handler(queue, level):
+    handler = logging.handlers.QueueHandler(queue)
+    handler.addFilter(ContextFilter())
+    handler.setLevel(level)
+    return handler
+
+# remove the queue handler added before (only the one set here)
+def _remove_handler(logger):
+    if _logging['handler'] is not None:
+        logger.removeHandler(_logging['handler'])
+        _logging['handler'] = None
+
+ #######################################################
+# |                Initialise log file                | #
+# | log_file: path and name of the log file to use    | #
+# | level: level of the records written               | #
+# V (calling it again with the same file does nothing) V #
+ #######################################################
+def set_logger(log_file, level=logging.DEBUG):
+    logger = logging.getLogger()
+    log_file = str(log_file)
+    if _logging['file'] == log_file and _logging['listener'] is not None:
+        logger.setLevel(level)
+        return _logging['queue']
+    stop_logging()
+    if _logging['queue'] is None:
+        _logging['queue'] = multiprocessing.Queue(-1)
+    fhandler = logging.FileHandler(filename=log_file, mode='a')
+    fhandler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(_logging['queue'], fhandler,
+                                              respect_handler_level=True)
+    listener.start()
+    _logging['listener'] = listener
+    _logging['file'] = log_file
+    _logging['handler'] = _queue_handler(_logging['queue'], logging.NOTSET)
+    logger.addHandler(_logging['handler'])
+    # prevent matplotlib font manager from writing to log
+    logging.getLogger('matplotlib.font_manager').disabled = True
+    logger.setLevel(level)
+    return _logging['queue']
+
+# arguments for init_worker_logging in the worker processes: the queue
+# (None if set_logger has not been called), level and current context
+def worker_logging_args():
+    return (_logging['queue'], logging.getLogger().level, dict(_context.get()))
+
+# send the records of a worker process to the queue of the main process
+# (the handlers inherited from the main process are removed)
+def init_worker_logging(queue, level=logging.DEBUG, context=None):
+    if queue is None:
+        return
+    if context:
+        _context.set(dict(context))
+    # the listener belongs to the main process (inherited when forked)
+    _logging['listener'] = None
+    _logging['file'] = None
+    _logging['queue'] = queue
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    _logging['handler'] = _queue_handler(queue, logging.NOTSET)
+    logger.addHandler(_logging['handler'])
+    logging.getLogger('matplotlib.font_manager').disabled = True
+    logger.setLevel(level)
+
+# context added to the records logged inside the block, for example
+#   with log_context(file=group_name, stage='fit'): ...
+@contextmanager
+def log_context(**fields):
+    context = dict(_context.get())
+    context.update(fields)
+    token = _context.set(context)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+# set the context for the records that follow (for example at the start
+# of each file in a loop), fields set to None are removed
+def set_log_context(**fields):
+    context = dict(_context.get())
+    context.update(fields)
+    _context.set({key: value for key, value in context.items() if value is not None})
+
+# write the records left on the queue and stop the listener
+def stop_logging():
+    if _logging['listener'] is None:
+        return
+    _remove_handler(logging.getLogger())
+    _logging['listener'].stop()
+    for handler in _logging['listener'].handlers:
+        handler.close()
+    _logging['listener'] = None
+    _logging['file'] = None
+
+atexit.register(stop_logging)
@@ -0,0 +1,138 @@
+# Bootstrap (Monte-Carlo) uncertainties for fits
+#
+# The uncertainties reported by feffit come from the covariance matrix at
+# the minimum. The functions in this module estimate them by refitting
+# replicas of the data: chi(k) is perturbed with random noise of the size
+# estimated by larch (epsilon_k) and each replica is refitted with the path
+# basis engine and analytic jacobian, starting from the values of the base
+# fit. The replicas are distributed over a pool of processes.
+#
+# bootstrap_fit: runs the replicas for a fit and returns the distributions
+#                of the variables, their statistics and confidence intervals.
+# bootstrap_report: text lines with the bootstrap statistics.
+# save_bootstrap: writes the value of the variables for each replica to csv.
+
+import os
+# copy the fit parameters before changing them
+from copy import deepcopy
+
+import numpy as np
+from lmfit import Minimizer, Parameters
+
+# library containign functions that read and write to csv files
+import lib.handle_csv as csvhandler
+# fast residual engine and analytic jacobian
+import lib.path_basis as path_basis
+# evaluation budget for each replica
+import lib.fit_budget as fit_budget
+# run the replicas in parallel
+import lib.worker_pool as worker_pool
+
+
+# basis shared by the replicas in a worker process
+def _setup_worker(portable, var_values, var_bounds, max_nfev, seed):
+    return {'basis': path_basis.restore_basis(portable), 'values': var_values,
+            'bounds': var_bounds, 'max_nfev': max_nfev, 'seed': seed}
+
+# refit one replica of the data, returns the values of the variables
+# (None if the fit did not converge within the budget)
+def _replica_fit(replica):
+    worker = worker_pool.worker_state()
+    basis = dict(worker['basis'])
+    # the seed of each replica is independent of the worker running it
+    rng = np.random.default_rng([worker['seed'], replica])
+    noise = basis['eps_k'] * rng.standard_normal(len(basis['k']))
+    basis['chi'] = basis['chi'] + noise
+
+    # warm start from the values of the base fit
+    params = Parameters()
+    for name in basis['graph']['variables']:
+        var_min, var_max = worker['bounds'][name]
+        params.add(name, value=worker['values'][name], min=var_min, max=var_max)
+    budget = fit_budget.FitBudget(max_nfev=worker['max_nfev'])
+    fit = Minimizer(path_basis.basis_residual, params, fcn_args=(basis,), iter_cb=budget)
+    try:
+        result = fit.leastsq(Dfun=path_basis.basis_jacobian, col_deriv=True)
+    except fit_budget.FitStopped:
+        return None
+    if not result.success:
+        return None
+    return [result.params[name].value for name in basis['graph']['variables']]
+
+ #######################################################
+# |  Bootstrap uncertainties for the results of a fit | #
+# | out: results from run_fit (feffit group)          | #
+# | dset: the feffit data set used in the fit         | #
+# | graph: compiled gds parameters (lib/gds_graph.py) | #
+# | n_replicas: number of refitted replicas           | #
+# | workers: number of processes (None for all cpus)  | #
+# | confidence: level for the confidence intervals    | #
+# | max_nfev: evaluation limit for each replica       | #
+# V returns a dictionary with the distributions       V #
+ #######################################################
+def bootstrap_fit(out, dset, graph, n_replicas=100, workers=None, confidence=0.95,
+                  max_nfev=None, seed=0):
+    # the variables not used by any path are fixed, as in the base fit
+    # (feffit has already fixed them in out.params)
+    params = deepcopy(out.params)
+    for name in graph['variables']:
+        params[name].vary = True
+    graph = path_basis.fix_unused_variables(graph, params)
+    basis = path_basis.build_path_basis(dset, graph)
+    variables = graph['variables']
+    var_values = {name: out.params[name].value for name in variables}
+    var_bounds = {name: (out.params[name].min, out.params[name].max) for name in variables}
+    if max_nfev is None:
+        max_nfev = 200*(len(variables) + 1)
+    setup_args = (path_basis.portable_basis(basis), var_values, var_bounds, max_nfev, seed)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, n_replicas))
+    # a single worker fits the replicas in this process
+    with worker_pool.WorkerPool(_setup_worker, setup_args,
+                                workers if workers > 1 else 0) as pool:
+        fits = pool.map(_replica_fit, range(n_replicas))
+
+    converged = np.array([fit for fit in fits if fit is not None]).reshape(-1, len(variables))
+    boot = {'variables': list(variables),
+            'base': var_values,
+            'n_replicas': n_replicas,
+            'n_failed': n_replicas - len(converged),
+            'confidence': confidence,
+            'values': {}, 'mean': {}, 'std': {}, 'median': {}, 'ci': {}}
+    tail = 100*(1 - confidence)/2
+    for i_var, name in enumerate(variables):
+        values = converged[:, i_var]
+        boot['values'][name] = values
+        if len(values) == 0:
+            boot['mean'][name] = boot['std'][name] = boot['median'][name] = np.nan
+            boot['ci'][name] = (np.nan, np.nan)
+            continue
+        boot['mean'][name] = values.mean()
+        boot['std'][name] = values.std(ddof=1) if len(values) > 1 else np.nan
+        boot['median'][name] = np.median(values)
+        boot['ci'][name] = tuple(np.percentile(values, [tail, 100 - tail]))
+    return boot
+
+# text lines with the bootstrap statistics
+def bootstrap_report(boot):
+    lines = ['[[Bootstrap]]',
+             '   replicas           = %i (%i failed)' % (boot['n_replicas'], boot['n_failed']),
+             '   %12s   %12s %12s %12s   %s' % ('variable', 'fit', 'mean', 'std',
+                                                 '%g%% interval' % (100*boot['confidence']))]
+    for name in boot['variables']:
+        lines.append('   %12s = %12.6g %12.6g %12.6g   [%.6g, %.6g]' %
+                     (name, boot['base'][name], boot['mean'][name], boot['std'][name],
+                      boot['ci'][name][0], boot['ci'][name][1]))
+    return '\n'.join(lines) + '\n'
+
+# write the values of the variables for each converged replica to csv
+def save_bootstrap(boot, file_name):
+    rows = {}
+    n_values = len(boot['values'][boot['variables'][0]]) if boot['variables'] else 0
+    for i_rep in range(n_values):
+        rows[i_rep + 1] = {'id': i_rep + 1}
+        for name in boot['variables']:
+            rows[i_rep + 1][name] = boot['values'][name][i_rep]
+    csvhandler.write_csv_data(rows, file_name)
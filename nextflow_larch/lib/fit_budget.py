@@ -0,0 +1,227 @@
+# Evaluation budgets and timeouts for fits
+#
+# A fit that does not converge can keep running for a very long time. The
+# FitBudget defined here is passed to the minimiser as iteration callback,
+# counts the residual evaluations, checks the wall-clock time and keeps the
+# best parameters found so far. When a limit is reached the fit is stopped
+# (FitStopped is raised) and the results are calculated at the best
+# parameters, so the usual feffit outputs (report, arrays, statistics) are
+# always available.
+#
+# FitBudget: iteration callback with the limits, best values and status
+#            (remaining gives the budget left for a later stage of the fit).
+# budget_feffit: runs feffit within a budget and records the status.
+# feffit_at_values: feffit outputs for the given values without fitting.
+# finish_at_best: feffit outputs at the best values of a stopped fit.
+# set_fit_status: adds the status and best values to the fit results.
+# status_report: text lines describing the status of the fit.
+# failure_report: text lines for a fit that raised an error.
+
+# copy the gds group before changing it
+from copy import deepcopy
+# variables used by the path expressions
+import ast
+# feffit options of the installed larch
+import inspect
+# wall-clock time
+import time
+
+import numpy as np
+from larch import Group
+from larch.fitting import group2params, params2group
+from larch.xafs import feffit
+
+# status codes for fits
+FIT_CONVERGED = 0
+FIT_MAX_NFEV = 1
+FIT_TIMEOUT = 2
+FIT_FAILED = 3
+FIT_SKIPPED = 4
+FIT_NOT_CONVERGED = 5
+
+# newer larch versions fix the variables not used by any path in feffit
+FIX_UNUSED = 'fix_unused_variables' in inspect.signature(feffit).parameters
+
+STATUS_MESSAGES = {FIT_CONVERGED: 'converged',
+                   FIT_MAX_NFEV: 'stopped: maximum number of evaluations reached',
+                   FIT_TIMEOUT: 'stopped: time limit reached',
+                   FIT_FAILED: 'failed',
+                   FIT_SKIPPED: 'skipped: did not pass the pre-screen',
+                   FIT_NOT_CONVERGED: 'finished without convergence'}
+
+
+# raised by FitBudget to stop the minimiser (lmfit can not calculate the
+# statistics of a fit aborted from the callback)
+class FitStopped(Exception):
+    pass
+
+# iteration callback for lmfit Minimizer (iter_cb), raises FitStopped when
+# a limit is reached.
+# max_nfev: maximum number of residual evaluations (None for no limit)
+# timeout: maximum wall-clock time in seconds (None for no limit)
+class FitBudget:
+    def __init__(self, max_nfev=None, timeout=None):
+        self.max_nfev = max_nfev
+        self.timeout = timeout
+        self.nfev = 0
+        self.status = FIT_CONVERGED
+        self.best_chi2 = None
+        self.best_values = {}
+        self.start_time = time.monotonic()
+
+    def __call__(self, params, iteration, resid, *args, **kws):
+        self.nfev += 1
+        chi2 = float((np.abs(np.asarray(resid))**2).sum())
+        if np.isfinite(chi2) and (self.best_chi2 is None or chi2 < self.best_chi2):
+            self.best_chi2 = chi2
+            self.best_values = {name: par.value for name, par in params.items()
+                                if par.vary}
+        if self.max_nfev is not None and self.nfev >= self.max_nfev:
+            self.status = FIT_MAX_NFEV
+        elif self.timeout is not None and self.elapsed() >= self.timeout:
+            self.status = FIT_TIMEOUT
+        if self.status != FIT_CONVERGED:
+            raise FitStopped(self.message)
+        return False
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    # budget with the evaluations (at most max_nfev) and time left, for a
+    # later stage of the fit. It is already stopped when nothing is left
+    def remaining(self, max_nfev=None):
+        if self.max_nfev is not None:
+            nfev_left = self.max_nfev - self.nfev
+            max_nfev = nfev_left if max_nfev is None else min(max_nfev, nfev_left)
+        timeout = None if self.timeout is None else self.timeout - self.elapsed()
+        stage = FitBudget(max_nfev=max_nfev, timeout=timeout)
+        if timeout is not None and timeout <= 0:
+            stage.status = FIT_TIMEOUT
+        elif max_nfev is not None and max_nfev <= 0:
+            stage.status = FIT_MAX_NFEV
+        return stage
+
+    # status after a later stage (from remaining): the limits of the fit
+    # reached by the stage stop the fit
+    def update_from(self, stage):
+        if stage.status == FIT_TIMEOUT:
+            self.status = FIT_TIMEOUT
+        elif stage.status == FIT_MAX_NFEV and self.max_nfev is not None and \
+                self.nfev + stage.nfev >= self.max_nfev:
+            self.status = FIT_MAX_NFEV
+
+    @property
+    def stopped(self):
+        return self.status != FIT_CONVERGED
+
+    @property
+    def message(self):
+        return STATUS_MESSAGES[self.status]
+
+# gds group (copy) with the given parameter values
+def gds_with_values(gds, values):
+    # a deepcopy is a plain Group, and group2params reads the parameters
+    # from its attributes
+    fit_gds = deepcopy(gds)
+    for name, value in values.items():
+        if hasattr(fit_gds, name):
+            getattr(fit_gds, name).value = value
+    return fit_gds
+
+# variables not used by the expressions of the other parameters (as feffit)
+def unused_variables(params):
+    unused = [name for name, par in params.items() if par.vary]
+    for par in params.values():
+        if not par.vary and par.expr is not None:
+            for node in ast.walk(ast.parse(par.expr)):
+                if isinstance(node, ast.Name) and node.id in unused:
+                    unused.remove(node.id)
+    return unused
+
+# feffit outputs without fitting, for the values in the gds group updated
+# with values (dictionary, the gds values are kept as initial values).
+# The statistics are calculated as in feffit (no uncertainties)
+def feffit_at_values(gds, dset, session, values=None, rmax_out=10, path_outputs=True):
+    init_values = {name: par.value for name, par in group2params(deepcopy(gds)).items()}
+    work_gds = gds_with_values(gds, values or {})
+    params = group2params(work_gds)
+    dset.prepare_fit(params=params)
+    if FIX_UNUSED:
+        for name in unused_variables(params):
+            params[name].vary = False
+    params.update_constraints()
+    params2group(params, work_gds)
+    resid = dset._residual(work_gds)
+    dat = dset._residual(work_gds, data_only=True)
+
+    var_names = [name for name, par in params.items() if par.vary]
+    for name in var_names:
+        params[name].init_value = init_values.get(name, params[name].value)
+    nvarys = len(var_names)
+    ndata = len(resid)
+    n_idp = dset.n_idp
+    chi_square = (resid**2).sum() * n_idp*1.0 / ndata
+    chi2_reduced = chi_square/(n_idp*1.0 - nvarys)
+    rfactor = (resid**2).sum() / (dat**2).sum()
+    neg2_loglikel = n_idp * np.log(chi_square / n_idp)
+    aic = neg2_loglikel + 2 * nvarys
+    bic = neg2_loglikel + np.log(n_idp) * nvarys
+
+    dset.save_ffts(rmax_out=rmax_out, path_outputs=path_outputs)
+    out = Group(name='feffit results', paramgroup=work_gds, datasets=[dset],
+                fit_details=None, chi_square=chi_square,
+                n_independent=n_idp, chi2_reduced=chi2_reduced,
+                rfactor=rfactor, aic=aic, bic=bic, covar=None,
+                params=params, nvarys=nvarys, nfree=ndata - nvarys,
+                ndata=ndata, var_names=var_names, nfev=1, success=False,
+                errorbars=False, message='Fit stopped.', lmdif_message='')
+    return out
+
+# feffit outputs at the best values found by a stopped fit
+def finish_at_best(gds, dset, session, budget, **kws):
+    return feffit_at_values(gds, dset, session, values=budget.best_values, **kws)
+
+# run feffit within the budget
+def budget_feffit(gds, dset, session, budget, **kws):
+    try:
+        out = feffit(gds, dset, _larch=session, iter_cb=budget, **kws)
+    except FitStopped:
+        out = finish_at_best(gds, dset, session, budget, **kws)
+    set_fit_status(out, budget)
+    return out
+
+# record the status of the fit in the results, a fit that was not stopped
+# by the budget but did not succeed (success: out.success if None) is
+# recorded as finished without convergence
+def set_fit_status(out, budget, success=None):
+    if success is None:
+        success = getattr(out, 'success', True)
+    status = budget.status
+    if status == FIT_CONVERGED and not success:
+        status = FIT_NOT_CONVERGED
+    out.fit_status = status
+    out.fit_status_message = STATUS_MESSAGES[status]
+    out.fit_nfev = budget.nfev
+    out.fit_time = budget.elapsed()
+    out.best_values = dict(budget.best_values)
+
+# text lines describing the status of the fit
+def status_report(out):
+    status = getattr(out, 'fit_status', None)
+    if status is None:
+        return ''
+    lines = ['[[Fit Status]]',
+             '   status             = %i (%s)' % (status, out.fit_status_message),
+             '   evaluations        = %i' % out.fit_nfev,
+             '   time (s)           = %.3f' % out.fit_time]
+    if status != FIT_CONVERGED:
+        lines.append('   best values found before stopping:')
+        for name, value in out.best_values.items():
+            lines.append('      %-16s = %.7g' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+# text lines for a fit that raised an error
+def failure_report(error):
+    return '\n'.join(['[[Fit Status]]',
+                      '   status             = %i (%s)' % (FIT_FAILED, STATUS_MESSAGES[FIT_FAILED]),
+                      '   error              = %s: %s' % (type(error).__name__, error)]) + '\n'
@@ -0,0 +1,71 @@
+# Checkpoint journal for batch fits
+#
+# Each completed fit is recorded as one line (json) appended to a journal
+# file, with the hash of its inputs and the location of its outputs. When a
+# batch is restarted with resume, the files with an entry for the same
+# inputs (and existing outputs) are skipped, so an interrupted batch
+# continues from the first file that was not completed.
+#
+# inputs_hash: hash of the input files and the fit variables.
+# read_journal: reads the entries recorded in the journal.
+# is_completed: checks if a file was completed with the same inputs.
+# record_fit: appends the entry for a completed fit to the journal.
+
+# hash the inputs
+import hashlib
+# journal entries
+import json
+import os
+import time
+# File handling
+from pathlib import Path
+
+
+# hash of the contents of the given files, the fit variables (dictionary)
+# and the hash of other inputs (prefix)
+def inputs_hash(file_names, fit_vars=None, prefix=''):
+    inputs = hashlib.sha256(prefix.encode())
+    for file_name in file_names:
+        with open(file_name, 'rb') as in_file:
+            for chunk in iter(lambda: in_file.read(1 << 20), b''):
+                inputs.update(chunk)
+    if fit_vars is not None:
+        inputs.update(json.dumps(fit_vars, sort_keys=True, default=str).encode())
+    return inputs.hexdigest()
+
+# read the journal, returns a dictionary with the last entry for each file
+def read_journal(journal_file):
+    entries = {}
+    if not Path(journal_file).exists():
+        return entries
+    with open(journal_file, encoding="utf8") as journal:
+        for a_line in journal:
+            try:
+                entry = json.loads(a_line)
+            except ValueError:
+                # incomplete last line of an interrupted batch
+                continue
+            entries[entry['file']] = entry
+    return entries
+
+# check if the file has an entry with the same inputs and its output exists
+def is_completed(entries, file_name, file_hash):
+    entry = entries.get(str(file_name), None)
+    if entry is None or entry['hash'] != file_hash:
+        return False
+    return all(Path(output).exists() for output in entry['outputs'])
+
+# append the entry for a completed fit to the journal
+# file_name: input file, file_hash: hash of the inputs (inputs_hash),
+# outputs: list of files written, status: status code of the fit
+def record_fit(journal_file, file_name, file_hash, outputs, status):
+    entry = {'file': str(file_name),
+             'hash': file_hash,
+             'outputs': [str(output) for output in outputs],
+             'status': status,
+             'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(journal_file, 'a', encoding="utf8") as journal:
+        journal.write(json.dumps(entry) + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
+    return entry
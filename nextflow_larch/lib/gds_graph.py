@@ -0,0 +1,304 @@
+# Compiled GDS expression graph
+#
+# The gds parameters read from csv become lmfit parameters whose expressions
+# are re-evaluated by the asteval interpreter on every step of the minimiser.
+# The functions in this module compile the gds data once into a graph with
+# the expressions in dependency order. evaluate_gds then runs all of them
+# in a single pass, as one compiled block of assignments (instead of one
+# asteval call per expression), from the values of the variables, which
+# can be numbers, arrays or Duals (derivatives).
+#
+# The graph is used by the basis engine (lib/path_basis.py) and by the
+# bootstrap (lib/fit_bootstrap.py), which minimise over the variables only.
+# The default feffit engine still evaluates the gds expressions with
+# asteval through the larch parameters (see run_fit in lib/manage_fit.py).
+#
+# The structure of the gds data is the same used by dict_to_gds:
+##############################
+# id,name,value,expr,vary
+# 1,alpha,1e-07,,True
+# 2,ss2,0.003,,True
+# 3,ss3,0.003,ss2,False
+# 4,ssfe,0.003,,True
+##############################
+# expr_names: names used in an expression (only arithmetic, numbers, names
+#             and calls to the functions in EXPR_SYMBOLS are allowed).
+# compile_gds: builds the graph from the gds dictionary (checks references
+#              and circular definitions).
+# read_gds_graph: reads the gds csv file and compiles it.
+# evaluate_gds: evaluates all parameters from the values of the variables.
+# graph_params: lmfit parameters for the variables only.
+
+# library containign functions that read and write to csv files
+import lib.handle_csv as csvhandler
+# parse the expressions
+import ast
+import keyword
+# compiled blocks of the graphs
+from functools import lru_cache
+
+import numpy as np
+from lmfit import Parameters
+
+
+# Forward mode derivatives for gds and path parameter expressions.
+# A Dual holds a value and its gradient with respect to the fit variables,
+# so evaluating the graph with Duals applies the chain rule. The gradient
+# has an extra last axis (one entry per variable) so values can be arrays.
+class Dual:
+    __slots__ = ('val', 'der')
+
+    def __init__(self, val, der):
+        self.val = val
+        self.der = der
+
+    def __repr__(self):
+        return 'Dual(%r, %r)' % (self.val, self.der)
+
+    def __pos__(self):
+        return self
+
+    def __neg__(self):
+        return Dual(-self.val, -self.der)
+
+    def __add__(self, other):
+        if isinstance(other, Dual):
+            return Dual(self.val + other.val, self.der + other.der)
+        return Dual(self.val + other, self.der)
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return (-self) + other
+
+    def __mul__(self, other):
+        if isinstance(other, Dual):
+            return Dual(self.val*other.val,
+                        self.der*_col(other.val) + _col(self.val)*other.der)
+        return Dual(self.val*other, self.der*_col(other))
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, Dual):
+            return Dual(self.val/other.val,
+                        (self.der*_col(other.val) - _col(self.val)*other.der)/_col(other.val**2))
+        return Dual(self.val/other, self.der/_col(other))
+
+    def __rtruediv__(self, other):
+        return Dual(other/self.val, -self.der*_col(other/self.val**2))
+
+    def __pow__(self, other):
+        if isinstance(other, Dual):
+            val = self.val**other.val
+            return Dual(val, _col(val)*(other.der*_col(np.log(self.val)) +
+                                        self.der*_col(other.val/self.val)))
+        return Dual(self.val**other, self.der*_col(other*self.val**(other - 1)))
+
+    def __rpow__(self, other):
+        val = other**self.val
+        return Dual(val, self.der*_col(val*np.log(other)))
+
+# value as a column so it broadcasts against the gradient axis
+def _col(val):
+    return np.asarray(val)[..., None]
+
+# wrap a numpy function so that it also accepts Duals
+def dual_func(func, deriv):
+    def wrapped(x):
+        if isinstance(x, Dual):
+            return Dual(func(x.val), x.der*_col(deriv(x.val)))
+        return func(x)
+    return wrapped
+
+# value of a Dual (or number) used to compare them
+def _dual_value(x):
+    return x.val if isinstance(x, Dual) else x
+
+# max and min as the asteval builtins (several values or one sequence),
+# the derivative is the one of the value chosen
+def dual_max(*args):
+    return max(args if len(args) > 1 else args[0], key=_dual_value)
+
+def dual_min(*args):
+    return min(args if len(args) > 1 else args[0], key=_dual_value)
+
+# functions and constants that can be used in the expressions
+EXPR_SYMBOLS = {'sqrt': dual_func(np.sqrt, lambda x: 0.5/np.sqrt(x)),
+                'exp': dual_func(np.exp, np.exp),
+                'log': dual_func(np.log, lambda x: 1.0/x),
+                'log10': dual_func(np.log10, lambda x: 1.0/(x*np.log(10))),
+                'sin': dual_func(np.sin, np.cos),
+                'cos': dual_func(np.cos, lambda x: -np.sin(x)),
+                'tan': dual_func(np.tan, lambda x: 1.0/np.cos(x)**2),
+                'arcsin': dual_func(np.arcsin, lambda x: 1.0/np.sqrt(1 - x*x)),
+                'arccos': dual_func(np.arccos, lambda x: -1.0/np.sqrt(1 - x*x)),
+                'arctan': dual_func(np.arctan, lambda x: 1.0/(1 + x*x)),
+                'sinh': dual_func(np.sinh, np.cosh),
+                'cosh': dual_func(np.cosh, np.sinh),
+                'tanh': dual_func(np.tanh, lambda x: 1.0/np.cosh(x)**2),
+                'abs': dual_func(np.abs, np.sign),
+                'max': dual_max,
+                'min': dual_min,
+                'pi': np.pi}
+
+
+# operators and nodes allowed in the expressions, anything else (attributes,
+# subscripts, lambdas, comprehensions...) could reach python internals
+EXPR_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.UAdd, ast.USub)
+EXPR_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Constant,
+              ast.Load) + EXPR_OPERATORS
+
+# description of a node that is not allowed in the expressions (None if allowed)
+def _forbidden(node):
+    if not isinstance(node, EXPR_NODES):
+        return type(node).__name__
+    if isinstance(node, ast.Name) and node.id.startswith('__'):
+        return "the name " + node.id
+    if isinstance(node, ast.Constant) and (isinstance(node.value, bool) or
+                                           not isinstance(node.value, (int, float))):
+        return "the constant %r" % (node.value,)
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name):
+            return "a call to " + type(node.func).__name__
+        if not callable(EXPR_SYMBOLS.get(node.func.id)):
+            return "a call to " + node.func.id
+        if node.keywords:
+            return "keyword arguments"
+    return None
+
+# get the names used in an expression
+# (raises ValueError for anything but arithmetic, numbers, names and calls
+# to the functions in EXPR_SYMBOLS)
+def expr_names(expr):
+    tree = ast.parse(expr, mode='eval')
+    for node in ast.walk(tree):
+        forbidden = _forbidden(node)
+        if forbidden is not None:
+            raise ValueError("expression '%s' uses %s, only arithmetic, numbers, names and "
+                             "the functions %s are allowed" %
+                             (expr, forbidden, ', '.join(name for name in EXPR_SYMBOLS
+                                                         if callable(EXPR_SYMBOLS[name]))))
+    return set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+
+# compile an expression checking that it only uses the given names
+# (plus the functions in EXPR_SYMBOLS)
+def compile_expr(label, expr, known_names):
+    try:
+        used = expr_names(expr)
+    except SyntaxError:
+        raise ValueError("invalid expression for %s: '%s'" % (label, expr))
+    except ValueError as expr_error:
+        raise ValueError("%s: %s" % (label, expr_error))
+    unknown = used - set(known_names) - set(EXPR_SYMBOLS)
+    if unknown:
+        raise ValueError("expression for %s: '%s' uses undefined names: %s" %
+                         (label, expr, ', '.join(sorted(unknown))))
+    return compile(expr, '<%s>' % label, 'eval'), used
+
+ #######################################################
+# |      Compile gds parameters into a graph          | #
+# V    returns a dictionary describing the graph      V #
+ #######################################################
+def compile_gds(data_dict):
+    graph = {'names': [], 'values': {}, 'variables': [], 'fixed': [], 'exprs': []}
+    exprs = {}
+    for par_idx in data_dict:
+        gds_name = str(data_dict[par_idx]['name']).strip()
+        if gds_name in graph['values']:
+            raise ValueError("gds parameter defined twice: " + gds_name)
+        try:
+            gds_val = float(data_dict[par_idx]['value'])
+        except (TypeError, ValueError):
+            gds_val = 0.00
+        gds_expr = data_dict[par_idx]['expr']
+        gds_vary = True if str(data_dict[par_idx]['vary']).strip().capitalize() =='True' else False
+        graph['names'].append(gds_name)
+        graph['values'][gds_name] = gds_val
+        if gds_expr not in (None, '') and str(gds_expr).strip() != '':
+            exprs[gds_name] = str(gds_expr).strip()
+        elif gds_vary:
+            graph['variables'].append(gds_name)
+        else:
+            graph['fixed'].append(gds_name)
+
+    # compile and check references (the parameters with an expression are
+    # assigned in the block run by evaluate_gds)
+    compiled = {}
+    for gds_name, gds_expr in exprs.items():
+        if not gds_name.isidentifier() or keyword.iskeyword(gds_name):
+            raise ValueError("gds parameter with an expression must have a valid name: " +
+                             gds_name)
+        compiled[gds_name] = compile_expr('gds:' + gds_name, gds_expr, graph['names'])
+
+    # order the expressions so each one comes after the ones it uses
+    ordered = []
+    def visit(gds_name, stack):
+        if gds_name in ordered:
+            return
+        if gds_name in stack:
+            cycle = stack[stack.index(gds_name):] + [gds_name]
+            raise ValueError("circular gds expressions: " + ' -> '.join(cycle))
+        for used in sorted(compiled[gds_name][1]):
+            if used in compiled:
+                visit(used, stack + [gds_name])
+        ordered.append(gds_name)
+    for gds_name in compiled:
+        visit(gds_name, [])
+    graph['exprs'] = [[gds_name, exprs[gds_name], compiled[gds_name][0]]
+                      for gds_name in ordered]
+    return graph
+
+# read gds parameters from csv file and compile them
+def read_gds_graph(gds_file):
+    gds_pars, _ = csvhandler.read_csv_data(gds_file)
+    return compile_gds(gds_pars)
+
+ #######################################################
+# |   Evaluate all the parameters in the graph        | #
+# | var_values: values for the variables (numbers,     | #
+# |   arrays or Duals), missing ones use the graph     | #
+# V   values. returns a dictionary with all values    V #
+ #######################################################
+def evaluate_gds(graph, var_values=None):
+    symbols = dict(EXPR_SYMBOLS)
+    symbols.update(graph['values'])
+    if var_values is not None:
+        symbols.update(var_values)
+    exec(_graph_block(tuple((gds_name, expr) for gds_name, expr, _ in graph['exprs'])),
+         {'__builtins__': {}}, symbols)
+    return {gds_name: symbols[gds_name] for gds_name in graph['names']}
+
+# the expressions of a graph (checked by compile_gds, in dependency order)
+# compiled once as a block of assignments, also for the graphs copied to
+# other processes without their compiled expressions
+@lru_cache(maxsize=64)
+def _graph_block(exprs):
+    return compile('\n'.join('%s = (%s)' % (gds_name, expr) for gds_name, expr in exprs),
+                   '<gds graph>', 'exec')
+
+# values of the variables seeded for derivatives (one gradient entry each)
+def dual_values(graph, var_values):
+    nvar = len(graph['variables'])
+    duals = {}
+    for i_var, gds_name in enumerate(graph['variables']):
+        der = np.zeros(nvar)
+        der[i_var] = 1.0
+        duals[gds_name] = Dual(var_values[gds_name], der)
+    return duals
+
+ #######################################################
+# |     lmfit parameters for the graph variables      | #
+# | bounds are taken from params (lmfit Parameters)   | #
+# V   when given                                      V #
+ #######################################################
+def graph_params(graph, params=None):
+    var_params = Parameters()
+    for gds_name in graph['variables']:
+        if params is not None and gds_name in params:
+            par = params[gds_name]
+            var_params.add(gds_name, value=par.value, vary=True, min=par.min, max=par.max)
+        else:
+            var_params.add(gds_name, value=graph['values'][gds_name], vary=True)
+    return var_params
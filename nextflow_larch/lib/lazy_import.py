@@ -0,0 +1,40 @@
+# Lazy import of interactive and plotting libraries
+#
+# The batch tasks (one python process for each file in nextflow) only fit
+# the data, but importing ipysheet and matplotlib.pyplot with the library
+# modules adds to the start up time of every process. lazy_module returns
+# a placeholder that imports the module the first time one of its
+# attributes is used, so the modules are only loaded by the tasks that
+# show spreadsheets or plot.
+#
+# lazy_module: placeholder for a module imported on first use.
+
+import importlib
+import sys
+
+
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return "<lazy module '%s' (%s)>" % (self._name, state)
+
+# placeholder for the module (the module itself if it was already imported)
+def lazy_module(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -8,15 +8,26 @@ from larch.xafs import autobk
 # calculate fourier transform
 from larch.xafs import xftf
 
-# plotting library
-import matplotlib.pyplot as plt
+# plotting library (loaded on first use)
+import lib.lazy_import as lazy_import
+plt = lazy_import.lazy_module('matplotlib.pyplot')
+
+# timing of the stages
+import lib.tracing as tracing
+
+# downsample the plotted curves
+import numpy as np
+
+# maximum number of points of each curve in the plots (None to plot all)
+PLOT_POINTS = 2000
 
  #######################################################
 # |         Read data from Athena project file        | #
 # V              returns a project object             V #
  #######################################################
 def read_project(project_file):
-    return read_athena(project_file)
+    with tracing.span('read', 'athena', file=project_file):
+        return read_athena(project_file)
 
  #######################################################
 # |         Extract groups from Athena project        | #
@@ -30,6 +41,40 @@ def get_groups(athena_project):
         athena_groups.append(gr_0)
     return athena_groups
 
+ #######################################################
+# |   Downsample a curve for plotting, keeping its    | #
+# |   shape (largest triangle three buckets, LTTB)    | #
+# | x, y: arrays of the curve (x sorted)              | #
+# | max_points: number of points to keep (all the     | #
+# |             points if None or more than the data) | #
+# V returns the indices of the points to plot         V #
+ #######################################################
+def lttb_indices(x, y, max_points = PLOT_POINTS):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n_points = len(x)
+    if max_points is None or max_points >= n_points or max_points < 3:
+        return np.arange(n_points)
+    # first and last points are kept, the others are split in buckets
+    # and the point of each bucket forming the largest triangle with the
+    # point kept before and the average of the next bucket is kept
+    starts = np.linspace(1, n_points - 1, max_points - 1).astype(int)
+    sizes = np.diff(np.append(starts, n_points))
+    # average of the next bucket (the last point for the last bucket)
+    next_x = (np.add.reduceat(x, starts)/sizes)[1:]
+    next_y = (np.add.reduceat(y, starts)/sizes)[1:]
+    indices = np.empty(max_points, dtype=int)
+    indices[0] = 0
+    indices[-1] = n_points - 1
+    kept = 0
+    for bucket in range(max_points - 2):
+        start, end = starts[bucket], starts[bucket + 1]
+        area = np.abs((x[kept] - next_x[bucket])*(y[start:end] - y[kept]) -
+                      (x[kept] - x[start:end])*(next_y[bucket] - y[kept]))
+        kept = start + int(np.argmax(area))
+        indices[bucket + 1] = kept
+    return indices
+
  #######################################################
 # |         Athena recalculates everything so we      | #
 # |      need to create a function that calculates    | #
@@ -43,12 +88,15 @@ def calc_with_defaults(xafs_group):
     # calculate pre-edge and post edge and add them to group
     # need to read parameters for pre-edge before background calculation with  
     # defaul values undo the work of previous step (setting pre-edge limits).
-    pre_edge(xafs_group, pre1=xafs_group.athena_params.bkg.pre1, pre2=xafs_group.athena_params.bkg.pre2)
+    with tracing.span('normalise', 'athena'):
+        pre_edge(xafs_group, pre1=xafs_group.athena_params.bkg.pre1, pre2=xafs_group.athena_params.bkg.pre2)
     #pre_edge(xafs_group)
     # perform background removal
-    autobk(xafs_group) # using defaults so no additional parameters are passed
+    with tracing.span('background', 'athena'):
+        autobk(xafs_group) # using defaults so no additional parameters are passed
     # calculate fourier transform
-    xftf(xafs_group)#, kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
+    with tracing.span('ft', 'athena'):
+        xftf(xafs_group)#, kweight=0.5, kmin=3.0, kmax=12.871, dk=1, kwindow='Hanning')
     return xafs_group
 
  #######################################################
@@ -56,14 +104,21 @@ def calc_with_defaults(xafs_group):
 # |   so it is useful to have a plotting function     | #
 # V            to reduce duplicated code              V #
  #######################################################
-def plot_normalised(xafs_group):
-        plt.plot(xafs_group.energy, xafs_group.mu, label=xafs_group.filename) # plot mu in blue
-        plt.grid(color='r', linestyle=':', linewidth=1) #show and format grid
-        plt.xlabel('Energy (eV)') # label y graph
-        plt.ylabel('x$\mu$(E)') # label y axis
-        plt.title("pre-edge and post_edge fitting to $\mu$")
-        plt.legend() # show legend
+def plot_normalised(xafs_group, max_points = PLOT_POINTS):
+        draw_normalised(plt.gca(), xafs_group, max_points)
         return plt
+
+# draw mu on energy on the given axes (pyplot or reused figures), with at
+# most max_points points (lttb_indices)
+def draw_normalised(ax, xafs_group, max_points = PLOT_POINTS):
+        shown = lttb_indices(xafs_group.energy, xafs_group.mu, max_points)
+        ax.plot(xafs_group.energy[shown], xafs_group.mu[shown], label=xafs_group.filename) # plot mu in blue
+        ax.grid(color='r', linestyle=':', linewidth=1) #show and format grid
+        ax.set_xlabel('Energy (eV)') # label y graph
+        ax.set_ylabel('x$\mu$(E)') # label y axis
+        ax.set_title("pre-edge and post_edge fitting to $\mu$")
+        ax.legend() # show legend
+        return ax
     
  #######################################################
 # |       The code for plotting Nmu vs E repeats      | #
@@ -4,8 +4,10 @@
 import lib.handle_csv as csvhandler
 # regular expression matching
 import re
+# libraries loaded on first use (not needed by the batch tasks)
+import lib.lazy_import as lazy_import
 # display editable spreadsheet
-import ipysheet
+ipysheet = lazy_import.lazy_module('ipysheet')
 # File handling
 from pathlib import Path
 #library for writing to log
@@ -13,9 +15,19 @@ import logging
 # Changes from removing lp
 from larch import ParameterGroup, fitting
 from larch.xafs import TransformGroup, FeffitDataSet, feffit, feffit_report, FeffPathGroup
+# fast residual engine for feffit
+import lib.path_basis as path_basis
+# compiled gds expressions for the basis engine
+import lib.gds_graph as gds_graph
+# evaluation budget and status of the fit
+import lib.fit_budget as fit_budget
+# bootstrap uncertainties
+import lib.fit_bootstrap as fit_bootstrap
+# timing of the stages
+import lib.tracing as tracing
 
 # plotting library
-import matplotlib.pyplot as plt
+plt = lazy_import.lazy_module('matplotlib.pyplot')
 
 # read parameters from csv file
 # each line contains a parameter defined as follows
@@ -26,6 +38,7 @@ import matplotlib.pyplot as plt
 # 3,ss3,0.003,ss2,False
 # 4,ssfe,0.003,,True
 ##############################
+@tracing.traced('read', 'fit')
 def read_gds(gds_file, session):
     gds_pars, _ = csvhandler.read_csv_data(gds_file)
     dgs_group = dict_to_gds(gds_pars, session)
@@ -271,6 +284,7 @@ def save_selected_paths_list(sp_sheet, file_name):
     csvhandler.write_csv_data(sp_list,file_name)
 
 # read selected paths from file
+@tracing.traced('read', 'fit')
 def read_selected_paths_list(file_name, session):
     sp_dict, _ = csvhandler.read_csv_data(file_name)
     sp_list=[]
@@ -285,13 +299,9 @@ def read_selected_paths_list(file_name, session):
         sp_list.append(new_path)
     return sp_list
 
-# run fit
-# data_group: the data group extracted from the athena file
-# gds: list of defined parameters defined
-# selected_paths: paths selected for the fit
-# fv: dictionary with the fit varialbes
-# session: current larch session
-def run_fit(data_group, gds, selected_paths, fv, session):
+# create the transform group and feffit data set for a fit
+# (same arguments as run_fit)
+def fit_dataset(data_group, selected_paths, fv, session):
     # create the transform grup (prepare the fit space).
     trans = TransformGroup(fitspace=fv['fitspace'],kmin=fv['kmin'],
                            kmax=fv['kmax'],kw=fv['kw'], dk=fv['dk'], 
@@ -299,29 +309,113 @@ def run_fit(data_group, gds, selected_paths, fv, session):
                            rmax=fv['rmax'], _larch=session)
 
     dset = FeffitDataSet(data=data_group, pathlist=selected_paths, transform=trans, _larch=session)
+    return trans, dset
+
+# run fit
+# data_group: the data group extracted from the athena file
+# gds: list of defined parameters defined
+# selected_paths: paths selected for the fit
+# fv: dictionary with the fit varialbes
+#     fv['engine'] (optional) selects the fit backend:
+#       'feffit' (default) larch feffit
+#       'basis'  precomputed path basis (see lib/path_basis.py)
+#     fv['jacobian'] (optional, basis engine only) 'analytic' to use the
+#       analytic derivatives of the EXAFS equation instead of finite differences
+#     fv['max_nfev'] (optional) maximum number of residual evaluations
+#     fv['timeout'] (optional) maximum time for the fit in seconds
+#     fv['bootstrap'] (optional) number of replicas for bootstrap
+#       uncertainties (out.bootstrap, see lib/fit_bootstrap.py), 0 for none
+#     fv['bootstrap_workers'] (optional) processes for the replicas
+# session: current larch session
+@tracing.traced('fit', 'fit')
+def run_fit(data_group, gds, selected_paths, fv, session):
+    trans, dset = fit_dataset(data_group, selected_paths, fv, session)
 
-    out = feffit(gds, dset, _larch=session)
+    engine = fv.get('engine', 'feffit')
+    jacobian = fv.get('jacobian', None)
+    # optional limits: the fit stops when one is reached and the results
+    # are those of the best parameters found (see out.fit_status)
+    budget = fit_budget.FitBudget(max_nfev=fv.get('max_nfev', None),
+                                  timeout=fv.get('timeout', None))
+    n_replicas = fv.get('bootstrap', 0) or 0
+    # the compiled graph is only used by the basis engine and the
+    # bootstrap, the feffit engine evaluates the gds expressions with
+    # asteval on every step (lib/gds_graph.py)
+    graph = None
+    if engine == 'basis' or n_replicas > 0:
+        try:
+            graph = gds_graph.compile_gds(gds_to_dict(gds))
+        except ValueError as graph_error:
+            if engine == 'basis':
+                logging.warning("The basis engine cannot use the gds parameters (" +
+                                str(graph_error) + "), using the feffit engine")
+                engine = 'feffit'
+                jacobian = None
+            if n_replicas > 0:
+                logging.warning("Bootstrap skipped, the gds parameters cannot be compiled (" +
+                                str(graph_error) + ")")
+                n_replicas = 0
+    # fit spaces and path expressions the basis does not support
+    if graph is not None:
+        try:
+            path_basis.check_basis(dset, graph)
+        except ValueError as basis_error:
+            if engine == 'basis':
+                logging.warning("The basis engine cannot fit the data set (" +
+                                str(basis_error) + "), using the feffit engine")
+                engine = 'feffit'
+                jacobian = None
+            if n_replicas > 0:
+                logging.warning("Bootstrap skipped, the basis cannot be built (" +
+                                str(basis_error) + ")")
+                n_replicas = 0
+    if engine == 'basis':
+        out = path_basis.basis_fit(gds, graph, dset, session, jacobian=jacobian,
+                                   budget=budget)
+    elif engine == 'feffit':
+        if jacobian is not None:
+            raise ValueError("jacobian option needs the basis fit engine")
+        out = fit_budget.budget_feffit(gds, dset, session, budget)
+    else:
+        raise ValueError("unknown fit engine: " + str(engine))
+    if budget.stopped:
+        logging.warning("Fit " + budget.message + " after " + str(budget.nfev) +
+                        " evaluations (" + "%.1f" % budget.elapsed() + " s)")
+    if n_replicas > 0:
+        with tracing.span('bootstrap', 'fit', replicas=n_replicas):
+            out.bootstrap = fit_bootstrap.bootstrap_fit(out, dset, graph, n_replicas,
+                                                        workers=fv.get('bootstrap_workers', None))
     return trans, dset, out
 
 #Overlap plot k-weighted χ(k) and χ(R) for fit to feffit dataset
 
 def plot_rmr(data_set,rmin,rmax):
     fig = plt.figure()
-    plt.plot(data_set.data.r, data_set.data.chir_mag, color='b')
-    plt.plot(data_set.data.r, data_set.data.chir_re, color='b', label='expt.')
-    plt.plot(data_set.model.r, data_set.model.chir_mag, color='r')
-    plt.plot(data_set.model.r, data_set.model.chir_re, color='r', label='fit')
-    plt.ylabel("Magnitude of Fourier Transform of $k^2 \cdot \chi$/$\mathrm{\AA}^{-3}$")
-    plt.xlabel("Radial distance/$\mathrm{\AA}$")
-    plt.xlim(0, 5)
-
-    plt.fill([rmin, rmin, rmax, rmax],[-rmax, rmax, rmax, -rmax], color='g',alpha=0.1)
-    plt.text(rmax-0.65, -rmax+0.5, 'fit range')
-    plt.legend()
+    draw_rmr(fig.add_subplot(111), data_set, rmin, rmax)
     return plt
 
+# draw the Rmr plot on the given axes (pyplot or reused figures)
+def draw_rmr(ax, data_set, rmin, rmax):
+    ax.plot(data_set.data.r, data_set.data.chir_mag, color='b')
+    ax.plot(data_set.data.r, data_set.data.chir_re, color='b', label='expt.')
+    ax.plot(data_set.model.r, data_set.model.chir_mag, color='r')
+    ax.plot(data_set.model.r, data_set.model.chir_re, color='r', label='fit')
+    ax.set_ylabel("Magnitude of Fourier Transform of $k^2 \cdot \chi$/$\mathrm{\AA}^{-3}$")
+    ax.set_xlabel("Radial distance/$\mathrm{\AA}$")
+    ax.set_xlim(0, 5)
+
+    ax.fill([rmin, rmin, rmax, rmax],[-rmax, rmax, rmax, -rmax], color='g',alpha=0.1)
+    ax.text(rmax-0.65, -rmax+0.5, 'fit range')
+    ax.legend()
+    return ax
+
 def plot_chikr(data_set,rmin,rmax,kmin,kmax):
     fig = plt.figure(figsize=(16, 4))
+    draw_chikr(fig, data_set, rmin, rmax, kmin, kmax)
+    return plt
+
+# draw the chi(k) and chi(R) plots side by side on the given figure
+def draw_chikr(fig, data_set, rmin, rmax, kmin, kmax):
     ax1 = fig.add_subplot(121)
     ax2 = fig.add_subplot(122)
     # Creating the chifit plot from scratch
@@ -346,15 +440,29 @@ def plot_chikr(data_set,rmin,rmax,kmin,kmax):
     
     ax2.fill([rmin, rmin, rmax, rmax],[-rmax, rmax, rmax, -rmax], color='g',alpha=0.1)
     ax2.text(rmax-0.65, -rmax+0.5, 'fit range')
-    return plt
+    return fig
 
 
 
 def get_fit_report(fit_out, session):
     return feffit_report(fit_out, _larch=session)
 
+@tracing.traced('report', 'fit')
 def save_fit_report(fit_out, file_name, session):
     fit_report = feffit_report(fit_out, _larch=session)
+    fit_report += '\n' + fit_budget.status_report(fit_out)
+    if hasattr(fit_out, 'bootstrap'):
+        fit_report += fit_bootstrap.bootstrap_report(fit_out.bootstrap)
     f = open(file_name, "a")
     f.write(fit_report)
-    f.close()
\ No newline at end of file
+    f.close()
+
+# save the bootstrap replicas of a fit to a csv file
+def save_bootstrap(fit_out, file_name):
+    fit_bootstrap.save_bootstrap(fit_out.bootstrap, file_name)
+
+# save the status of a fit that raised an error instead of a report
+def save_fit_failure(error, file_name):
+    f = open(file_name, "a")
+    f.write(fit_budget.failure_report(error))
+    f.close()
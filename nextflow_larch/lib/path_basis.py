@@ -0,0 +1,499 @@
+# Fast residual engine for feffit
+#
+# feffit recalculates chi(k) for each path on every evaluation of the
+# residual, rebuilding the path parameters and re-evaluating the splines
+# for the feffNNNN.dat amplitude and phase one path at a time.
+# The functions in this module read the path data once into a "path basis"
+# and evaluate the EXAFS equation for all the selected paths together
+# using numpy arrays.
+#
+# build_path_basis: collects the spline tables of all paths, the data on
+#                   the fit k-grid and the cached window/transform.
+# path_blocks: spline tables of paths that share the same feff k grid.
+# basis_params: evaluates the path parameters (s02, e0, sigma2, ...) for
+#               all paths from the current gds values.
+# basis_chi: calculates chi(k) for all paths at once.
+# basis_residual: residual equivalent to FeffitDataSet._residual.
+# basis_jacobian: analytic derivatives of the residual with respect to the
+#                 fit variables (chain rule through gds and path expressions).
+# subset_basis: basis restricted to some of the paths, fitting only the
+#               variables used by them.
+# portable_basis / restore_basis: copy of the basis without code objects
+#                 that can be sent to worker processes, and back.
+# fix_unused_variables: fixes the variables not used by any path (feffit).
+# basis_fit: runs the fit with the basis residual and finishes with a
+#            feffit call from the optimised values to produce the usual
+#            fit results (statistics, uncertainties, report and arrays).
+
+# copy the gds group before changing it
+from copy import deepcopy
+
+import numpy as np
+from scipy.interpolate import BSpline
+
+from lmfit import Minimizer
+from larch.fitting import group2params
+from larch.xafs import feffit, ftwindow
+from larch.xafs.xafsutils import ETOK
+
+# compiled gds expressions
+import lib.gds_graph as gds_graph
+# evaluation budget and status of the fit
+import lib.fit_budget as fit_budget
+
+# same order and defaults used by larch FeffPathGroup
+PATH_PARS = ('degen', 's02', 'e0', 'ei', 'deltar', 'sigma2', 'third', 'fourth')
+SMALL_ENERGY = 1.e-6
+
+# names defined by larch for each path when evaluating path parameters
+PATH_SYMBOLS = ('reff',)
+
+# evaluations per variable (plus one) allowed to the feffit confirmation
+# of a basis fit
+CONFIRM_NFEV = 20
+
+
+# compile a path parameter (value or expression) for the basis
+# returns [value, code] where code is None for constant values
+def compile_path_param(label, pname, value, known_names):
+    if value is None or (isinstance(value, str) and value.strip() == ''):
+        return [None, None]
+    try:
+        return [float(value), None]
+    except (TypeError, ValueError):
+        pass
+    code, _ = gds_graph.compile_expr("path '%s' %s" % (label, pname), str(value).strip(),
+                                     list(known_names) + list(PATH_SYMBOLS))
+    return [None, code]
+
+# spline coefficients (t, c, k) from the UnivariateSpline created by larch
+def spline_tck(spline):
+    t, c, k = spline._eval_args
+    return t, c[:len(t)-k-1], k
+
+ #######################################################
+# |  Check that the basis can be built for a data set | #
+# | (fit space r or k and path parameters the         | #
+# V compiled graph supports), raises ValueError       V #
+ #######################################################
+def check_basis(dset, graph):
+    trans = dset.transform
+    if trans.fitspace not in ('r', 'k'):
+        raise ValueError("basis engine supports fitspace 'r' or 'k', not '%s'" % trans.fitspace)
+    for path in dset.paths.values():
+        for pname in PATH_PARS:
+            compile_path_param(path.label, pname, getattr(path, pname), graph['names'])
+
+ #######################################################
+# |     Build the path basis for a feffit data set    | #
+# | graph: compiled gds parameters (lib/gds_graph.py) | #
+# V   (needs to be called after dset.prepare_fit)     V #
+ #######################################################
+def build_path_basis(dset, graph):
+    trans = dset.transform
+    paths = list(dset.paths.values())
+    basis = {'labels': [p.label for p in paths],
+             'reff': np.array([p.reff for p in paths]),
+             'graph': graph,
+             'fitspace': trans.fitspace,
+             'kweight': trans.get_kweight()}
+    check_basis(dset, graph)
+
+    # path parameters: constant values in one array per parameter, and the
+    # expressions shared by several paths evaluated once for all of them
+    # (with reff as an array)
+    defaults = {'s02': 1.0}
+    basis['consts'] = {pname: np.zeros(len(paths)) + defaults.get(pname, 0.0)
+                       for pname in PATH_PARS}
+    path_exprs = {}
+    for p_idx, path in enumerate(paths):
+        for pname in PATH_PARS:
+            value = getattr(path, pname)
+            val, code = compile_path_param(path.label, pname, value, graph['names'])
+            if code is not None:
+                key = (pname, str(value).strip())
+                if key not in path_exprs:
+                    path_exprs[key] = [pname, code, []]
+                path_exprs[key][2].append(p_idx)
+            elif val is not None:
+                basis['consts'][pname][p_idx] = val
+            elif pname == 'degen':
+                # larch uses the degeneracy from feff when none is given
+                basis['consts'][pname][p_idx] = path._feffdat.degen
+    basis['exprs'] = [[pname, code, np.array(idx)] for pname, code, idx in path_exprs.values()]
+    # source of the expressions (code objects can not be sent to other processes)
+    basis['expr_src'] = [expr for _, expr in path_exprs]
+
+    basis['blocks'] = path_blocks(paths)
+
+    # data and uncertainties on the fit k grid
+    k = dset.model.k
+    basis['k'] = k
+    basis['chi'] = np.interp(k, dset.data.k, dset.data.chi)
+    eps_k = dset.epsilon_k
+    if isinstance(eps_k, np.ndarray):
+        eps_k = eps_k.copy()
+        eps_k[np.where(eps_k < 1.e-12)[0]] = 1.e-12
+    basis['eps_k'] = eps_k
+    basis['eps_r'] = dset.epsilon_r
+
+    # cached window and transform
+    if trans.fitspace == 'k':
+        iqmin = int(max(0, 0.01 + trans.kmin/trans.kstep))
+        iqmax = int(min(trans.nfft/2, 0.01 + trans.kmax/trans.kstep))
+        basis['kslice'] = slice(iqmin, iqmax)
+        basis['kwt'] = k**basis['kweight']
+    else:
+        if trans.kwin is None:
+            trans.kwin = ftwindow(trans.k_, xmin=trans.kmin, xmax=trans.kmax,
+                                  dx=trans.dk, dx2=trans.dk2, window=trans.window)
+        irmin = int(max(0, 0.01 + trans.rmin/trans.rstep))
+        irmax = int(min(trans.nfft/2, 0.01 + trans.rmax/trans.rstep))
+        # only the bins inside the fit range are used by the residual, so the
+        # forward transform (window, k-weight and fft) reduces to a matrix
+        kwin_kw = trans.kwin[:len(k)] * k**basis['kweight']
+        r_idx = np.arange(irmin, irmax)[:, None]
+        k_idx = np.arange(len(k))[None, :]
+        basis['ft'] = ((trans.kstep/np.sqrt(np.pi)) * kwin_kw *
+                       np.exp(-2j*np.pi*r_idx*k_idx/trans.nfft))
+    return basis
+
+# group the paths (larch FeffPathGroup) that share the same spline knots
+# (same feff k grid) so the tables for all paths in a block are evaluated
+# in one call
+def path_blocks(paths):
+    blocks = {}
+    for p_idx, path in enumerate(paths):
+        if path.spline_coefs is None:
+            path.create_spline_coefs()
+        tcks = [spline_tck(path.spline_coefs[name]) for name in ('pha', 'amp', 'rep', 'lam')]
+        t, _, k = tcks[0]
+        key = (k, t.tobytes())
+        if key not in blocks:
+            blocks[key] = {'t': t, 'k': k, 'idx': [], 'c': []}
+        blocks[key]['idx'].append(p_idx)
+        blocks[key]['c'].append(np.stack([c for _, c, _ in tcks], axis=1))
+    spline_blocks = []
+    for block in blocks.values():
+        # coefficients with shape (n coefs, 4 tables, n paths)
+        coefs = np.stack(block['c'], axis=2)
+        spline_blocks.append({'idx': np.array(block['idx']),
+                              't': block['t'], 'k': block['k'], 'c': coefs,
+                              'spline': BSpline(block['t'], coefs, block['k'])})
+    return spline_blocks
+
+# names used by the path expressions in the basis, directly or through the
+# gds expressions
+def basis_names(basis):
+    gds_codes = {gds_name: code for gds_name, _, code in basis['graph']['exprs']}
+    pending = set()
+    for _, code, _ in basis['exprs']:
+        pending.update(code.co_names)
+    used = set()
+    while pending:
+        name = pending.pop()
+        if name in used:
+            continue
+        used.add(name)
+        if name in gds_codes:
+            pending.update(gds_codes[name].co_names)
+    return used
+
+# basis for a subset of the paths (indices in the basis), the variables not
+# used by those paths are fixed at the values given (or the graph values)
+def subset_basis(basis, idx, values=None):
+    idx = np.asarray(idx)
+    new_idx = -np.ones(len(basis['reff']), dtype=int)
+    new_idx[idx] = np.arange(len(idx))
+    subset = dict(basis)
+    subset['labels'] = [basis['labels'][i] for i in idx]
+    subset['reff'] = basis['reff'][idx]
+    subset['consts'] = {pname: consts[idx] for pname, consts in basis['consts'].items()}
+    subset['exprs'] = []
+    subset['expr_src'] = []
+    for (pname, code, e_idx), src in zip(basis['exprs'], basis['expr_src']):
+        e_idx = new_idx[e_idx]
+        e_idx = e_idx[e_idx >= 0]
+        if len(e_idx) > 0:
+            subset['exprs'].append([pname, code, e_idx])
+            subset['expr_src'].append(src)
+    subset['blocks'] = []
+    for block in basis['blocks']:
+        sel = np.where(new_idx[block['idx']] >= 0)[0]
+        if len(sel) == 0:
+            continue
+        coefs = block['c'][:, :, sel]
+        subset['blocks'].append({'idx': new_idx[block['idx'][sel]],
+                                 't': block['t'], 'k': block['k'], 'c': coefs,
+                                 'spline': BSpline(block['t'], coefs, block['k'])})
+
+    graph = dict(basis['graph'])
+    graph['values'] = dict(graph['values'])
+    if values is not None:
+        graph['values'].update(values)
+    used = basis_names(subset)
+    graph['variables'] = [name for name in basis['graph']['variables'] if name in used]
+    graph['fixed'] = basis['graph']['fixed'] + [name for name in basis['graph']['variables']
+                                                if name not in used]
+    subset['graph'] = graph
+    return subset
+
+# copy of the basis that can be pickled (expressions as source text)
+def portable_basis(basis):
+    portable = dict(basis)
+    portable['graph'] = dict(basis['graph'])
+    portable['graph']['exprs'] = [[gds_name, expr, None]
+                                  for gds_name, expr, _ in basis['graph']['exprs']]
+    portable['exprs'] = [[pname, None, idx] for pname, _, idx in basis['exprs']]
+    return portable
+
+# compile the expressions of a portable basis
+def restore_basis(portable):
+    basis = dict(portable)
+    basis['graph'] = dict(portable['graph'])
+    basis['graph']['exprs'] = [[gds_name, expr, compile(expr, '<gds:%s>' % gds_name, 'eval')]
+                               for gds_name, expr, _ in portable['graph']['exprs']]
+    basis['exprs'] = [[pname, compile(src, '<path %s>' % pname, 'eval'), idx]
+                      for (pname, _, idx), src in zip(portable['exprs'], portable['expr_src'])]
+    return basis
+
+ #######################################################
+# |     Evaluate path parameters for all the paths    | #
+# | values: gds values (from gds_graph.evaluate_gds)  | #
+# V returns a dictionary of arrays (one value per path) V #
+ #######################################################
+def basis_params(basis, values):
+    symbols = dict(gds_graph.EXPR_SYMBOLS)
+    symbols.update(values)
+    out = {pname: vals.copy() for pname, vals in basis['consts'].items()}
+    for pname, code, idx in basis['exprs']:
+        symbols['reff'] = basis['reff'][idx]
+        out[pname][idx] = eval(code, {'__builtins__': {}}, symbols)
+    return out
+
+ #######################################################
+# |    Evaluate path parameters and their gradients   | #
+# V  with respect to the variables of the gds graph   V #
+ #######################################################
+def basis_params_grad(basis, var_values):
+    graph = basis['graph']
+    values = gds_graph.evaluate_gds(graph, gds_graph.dual_values(graph, var_values))
+    symbols = dict(gds_graph.EXPR_SYMBOLS)
+    symbols.update(values)
+    nvar = len(graph['variables'])
+    npath = len(basis['reff'])
+    vals = {pname: consts.copy() for pname, consts in basis['consts'].items()}
+    grads = {pname: np.zeros((npath, nvar)) for pname in PATH_PARS}
+    for pname, code, idx in basis['exprs']:
+        symbols['reff'] = basis['reff'][idx]
+        val = eval(code, {'__builtins__': {}}, symbols)
+        if isinstance(val, gds_graph.Dual):
+            grads[pname][idx] = val.der
+            val = val.val
+        vals[pname][idx] = val
+    return vals, grads
+
+# e0-shifted wavenumber for the fit k grid (as in FeffPathGroup._calc_chi)
+def shifted_k(k, e0):
+    en = k*k - e0*ETOK
+    if min(abs(en)) < SMALL_ENERGY:
+        en[np.where(abs(en) < 1.5*SMALL_ENERGY)] = SMALL_ENERGY
+    return np.sign(en)*np.sqrt(abs(en))
+
+# evaluate the feff tables (pha, amp, rep, lam) for the paths in
+# a block that share the same e0 (or their derivatives with respect to q)
+def block_tables(block, sel, q, nu=0):
+    if len(sel) == len(block['idx']):
+        spline = block['spline']
+    else:
+        spline = BSpline(block['t'], block['c'][:, :, sel], block['k'])
+    # (n k, 4, n paths) -> 4 arrays of shape (n paths, n k)
+    tabs = spline(q, nu=nu).transpose(1, 2, 0)
+    return tabs[0], tabs[1], tabs[2], tabs[3]
+
+ #######################################################
+# |      Calculate chi(k) for all paths in the basis  | #
+# V    returns an array with shape (n paths, n k)     V #
+ #######################################################
+def basis_chi(basis, pars):
+    k = basis['k']
+    chi = np.zeros((len(basis['reff']), len(k)))
+    for block in basis['blocks']:
+        block_e0 = pars['e0'][block['idx']]
+        for e0 in np.unique(block_e0):
+            sel = np.where(block_e0 == e0)[0]
+            idx = block['idx'][sel]
+            q = shifted_k(k, e0)
+            pha, amp, rep, lam = block_tables(block, sel, q)
+            reff = basis['reff'][idx, None]
+            degen, s02, ei, deltar, sigma2, third, fourth = [
+                pars[pname][idx, None] for pname in
+                ('degen', 's02', 'ei', 'deltar', 'sigma2', 'third', 'fourth')]
+            # the xafs equation
+            pp = (rep + 1j/lam)**2 + 1j * ei * ETOK
+            p = np.sqrt(pp)
+            cchi = np.exp(-2*reff*p.imag - 2*pp*(sigma2 - pp*fourth/3) +
+                          1j*(2*q*reff + pha +
+                              2*p*(deltar - 2*sigma2/reff - 2*pp*third/3)))
+            cchi = degen * s02 * amp * cchi / (q*(reff + deltar)**2)
+            cchi[:, 0] = 2*cchi[:, 1] - cchi[:, 2]
+            chi[idx] = cchi.imag
+    return chi
+
+# apply the fit space transform to (a stack of) chi(k) arrays
+def basis_transform(basis, chi):
+    if basis['fitspace'] == 'k':
+        return (chi * basis['kwt'] / basis['eps_k'])[..., basis['kslice']]
+    chir = (chi @ basis['ft'].T) / basis['eps_r']
+    # interleave real and imaginary parts like larch realimag
+    return np.stack((chir.real, chir.imag), axis=-1).reshape(chir.shape[:-1] + (-1,))
+
+ #######################################################
+# |          Residual for the basis engine            | #
+# V      same values as FeffitDataSet._residual       V #
+ #######################################################
+def basis_residual(params, basis):
+    var_values = {name: params[name].value for name in basis['graph']['variables']}
+    values = gds_graph.evaluate_gds(basis['graph'], var_values)
+    pars = basis_params(basis, values)
+    model = basis_chi(basis, pars).sum(axis=0)
+    return basis_transform(basis, basis['chi'] - model)
+
+ #######################################################
+# |   Derivatives of chi(k) for all paths with respect | #
+# |   to each path parameter                          | #
+# V returns a dictionary of arrays (n paths, n k)     V #
+ #######################################################
+def basis_chi_derivs(basis, pars):
+    k = basis['k']
+    shape = (len(basis['reff']), len(k))
+    derivs = {pname: np.zeros(shape) for pname in PATH_PARS}
+    for block in basis['blocks']:
+        block_e0 = pars['e0'][block['idx']]
+        for e0 in np.unique(block_e0):
+            sel = np.where(block_e0 == e0)[0]
+            idx = block['idx'][sel]
+            q = shifted_k(k, e0)
+            pha, amp, rep, lam = block_tables(block, sel, q)
+            dpha, damp, drep, dlam = block_tables(block, sel, q, nu=1)
+            reff = basis['reff'][idx, None]
+            degen, s02, ei, deltar, sigma2, third, fourth = [
+                pars[pname][idx, None] for pname in
+                ('degen', 's02', 'ei', 'deltar', 'sigma2', 'third', 'fourth')]
+            # the xafs equation as in basis_chi, keeping the intermediate terms
+            pp = (rep + 1j/lam)**2 + 1j * ei * ETOK
+            p = np.sqrt(pp)
+            expo = np.exp(-2*reff*p.imag - 2*pp*(sigma2 - pp*fourth/3) +
+                          1j*(2*q*reff + pha +
+                              2*p*(deltar - 2*sigma2/reff - 2*pp*third/3)))
+            unit = amp * expo / (q*(reff + deltar)**2)
+            cchi = degen * s02 * unit
+            # derivative of the exponent with respect to p (p.imag handled apart)
+            dexpo_dp = (-4*p*sigma2 + 8*p*pp*fourth/3 +
+                        1j*(2*deltar - 4*sigma2/reff - 4*pp*third))
+            # e0 changes q, and with it the feff tables
+            dp_dq = (rep + 1j/lam)*(drep - 1j*dlam/lam**2)/p
+            dexpo_dq = (-2*reff*dp_dq.imag + dexpo_dp*dp_dq +
+                        1j*(2*reff + dpha))
+            dcchi_dq = degen * s02 * expo / (q*(reff + deltar)**2) * (
+                damp + amp*(dexpo_dq - 1.0/q))
+            dq_de0 = -ETOK/(2*np.abs(q))
+            dp_dei = 1j*ETOK/(2*p)
+            cderivs = {'degen': s02 * unit,
+                       's02': degen * unit,
+                       'e0': dcchi_dq * dq_de0,
+                       'ei': cchi * (-2*reff*dp_dei.imag + dexpo_dp*dp_dei),
+                       'deltar': cchi * (2j*p - 2.0/(reff + deltar)),
+                       'sigma2': cchi * (-2*pp - 4j*p/reff),
+                       'third': cchi * (-4j*p*pp/3),
+                       'fourth': cchi * (2*pp*pp/3)}
+            for pname, dcchi in cderivs.items():
+                dcchi[:, 0] = 2*dcchi[:, 1] - dcchi[:, 2]
+                derivs[pname][idx] = dcchi.imag
+    return derivs
+
+ #######################################################
+# |     Analytic jacobian for the basis residual      | #
+# V   returns an array with shape (n vars, n resid)   V #
+ #######################################################
+def basis_jacobian(params, basis):
+    var_names = basis['graph']['variables']
+    pars, grads = basis_params_grad(basis, {name: params[name].value for name in var_names})
+    derivs = basis_chi_derivs(basis, pars)
+    # chain rule: d model / d var = sum over paths and path parameters
+    dmodel = np.zeros((len(var_names), len(basis['k'])))
+    for pname in PATH_PARS:
+        if grads[pname].any():
+            dmodel += grads[pname].T @ derivs[pname]
+    return -basis_transform(basis, dmodel)
+
+# graph with the variables not used by any path fixed, as feffit does
+# (params: gds and path parameters, after dset.prepare_fit)
+def fix_unused_variables(graph, params):
+    if not fit_budget.FIX_UNUSED:
+        return graph
+    unused = fit_budget.unused_variables(params)
+    return dict(graph, variables=[name for name in graph['variables'] if name not in unused],
+                fixed=graph['fixed'] + [name for name in graph['variables'] if name in unused])
+
+ #######################################################
+# |      Run a fit using the basis residual engine    | #
+# V   returns the feffit results for the dataset      V #
+ #######################################################
+# graph: compiled gds parameters (lib/gds_graph.py)
+# jacobian: None for finite differences or 'analytic'
+# budget: FitBudget (lib/fit_budget.py) for the basis fit, the feffit
+#         confirmation has its own allowance (CONFIRM_NFEV evaluations per
+#         variable and the same timeout)
+def basis_fit(gds, graph, dset, session, jacobian=None, budget=None, **kws):
+    if budget is None:
+        budget = fit_budget.FitBudget()
+    work_gds = deepcopy(gds)
+    params = group2params(work_gds)
+    dset.prepare_fit(params=params)
+    graph = fix_unused_variables(graph, params)
+    basis = build_path_basis(dset, graph)
+
+    # the minimiser only sees the variables, the dependent gds and path
+    # parameters are evaluated from the compiled graph
+    fit_params = gds_graph.graph_params(graph, params)
+    fit = Minimizer(basis_residual, fit_params, fcn_args=(basis,), scale_covar=True,
+                    iter_cb=budget, **kws)
+    if jacobian not in (None, 'analytic'):
+        raise ValueError("unknown jacobian option: " + str(jacobian))
+    init_values = {name: par.value for name, par in fit_params.items()}
+    confirm_budget = None
+    try:
+        if jacobian == 'analytic':
+            result = fit.leastsq(Dfun=basis_jacobian, col_deriv=True)
+        else:
+            result = fit.leastsq()
+    except fit_budget.FitStopped:
+        out = fit_budget.finish_at_best(gds, dset, session, budget, **kws)
+        success = False
+    else:
+        # feffit from the optimised values only needs a few evaluations to
+        # confirm the minimum and produces the standard outputs, within the
+        # evaluations and time left by the basis fit
+        basis_values = {name: result.params[name].value for name in result.var_names}
+        confirm_budget = budget.remaining(CONFIRM_NFEV*(len(basis_values) + 1))
+        if confirm_budget.stopped:
+            # nothing left, outputs at the values of the basis fit
+            out = fit_budget.feffit_at_values(gds, dset, session, values=basis_values, **kws)
+        else:
+            try:
+                out = feffit(fit_budget.gds_with_values(gds, basis_values), dset,
+                             _larch=session, iter_cb=confirm_budget, **kws)
+            except fit_budget.FitStopped:
+                out = fit_budget.feffit_at_values(
+                    gds, dset, session, values=confirm_budget.best_values or basis_values,
+                    **kws)
+        budget.update_from(confirm_budget)
+        success = bool(result.success) and bool(out.success)
+    for name, par in out.params.items():
+        if name in init_values:
+            par.init_value = init_values[name]
+    out.basis_nfev = budget.nfev
+    out.confirm_nfev = confirm_budget.nfev if confirm_budget is not None else 0
+    fit_budget.set_fit_status(out, budget, success)
+    return out
@@ -0,0 +1,174 @@
+# Rank FEFF paths by their contribution to chi(R)
+#
+# show_feff_paths lists all the paths calculated by FEFF so they can be
+# selected by hand, which is not practical for large clusters with
+# thousands of paths. The functions in this module read all the
+# feffNNNN.dat files of a FEFF run, calculate chi(k) for all the paths at
+# once with default path parameters, transform them with the fit window
+# (kmin, kmax, kw, dk, window) and rank the paths by the integral of
+# |chi(R)| between rmin and rmax. The top ranked paths are written to a
+# selected paths csv file that can be read with read_selected_paths_list.
+#
+# read_feff_paths: reads all the paths of a FEFF run into arrays.
+# paths_chi: chi(k) of all the paths with the default path parameters.
+# rank_feff_paths: ranks the paths by their |chi(R)| in the fit window.
+# gds_path_pars: path parameters built from the names of the gds parameters.
+# check_path_pars: checks that the path parameters only use gds names.
+# save_ranked_paths: writes the top ranked paths as selected paths csv.
+
+# File handling
+from pathlib import Path
+
+import numpy as np
+from larch.xafs import ftwindow
+from larch.xafs.feffdat import FeffPathGroup
+
+# library containign functions that read and write to csv files
+import lib.handle_csv as csvhandler
+# check the names used by the path parameters
+import lib.gds_graph as gds_graph
+import lib.path_basis as path_basis
+
+# usual expressions for the path parameters of the selected paths csv file,
+# the first one that only uses names of the gds parameters is used
+PATH_PAR_CANDIDATES = {'s02': ('amp', 's02', 'so2'),
+                       'e0': ('enot', 'e0', 'de0', 'dele0'),
+                       'sigma2': ('ss', 'sigma2', 'ss2', 'ss1'),
+                       'deltar': ('alpha*reff', 'delr', 'deltar', 'dr')}
+
+
+# path label following show_feff_paths: scattering atoms, absorbing atom
+# and path index
+def path_label(path, path_id):
+    atoms = [atom[0] for atom in path.geom]
+    atoms = atoms[1:] + atoms[:1]
+    return '.'.join(atoms) + '.' + str(path_id)
+
+ #######################################################
+# |       Read all the paths from a FEFF directory    | #
+# | the feffNNNN.dat files are read by larch          | #
+# | (FeffPathGroup) and their spline tables grouped   | #
+# | as in the path basis (lib/path_basis.py)          | #
+# V returns a dictionary of arrays (one row per path) V #
+ #######################################################
+def read_feff_paths(feff_dir):
+    dat_files = sorted(Path(feff_dir).glob('feff[0-9][0-9][0-9][0-9].dat'))
+    if len(dat_files) == 0:
+        raise ValueError("no feffNNNN.dat files found in " + str(feff_dir))
+    paths = [FeffPathGroup(filename=str(dat_file)) for dat_file in dat_files]
+    return {'filename': [str(Path(feff_dir, dat_file.name).as_posix())
+                         for dat_file in dat_files],
+            'label': [path_label(path, int(dat_file.name[4:8]))
+                      for path, dat_file in zip(paths, dat_files)],
+            'nleg': np.array([path._feffdat.nleg for path in paths]),
+            'degen': np.array([path._feffdat.degen for path in paths]),
+            'reff': np.array([path._feffdat.reff for path in paths]),
+            'blocks': path_basis.path_blocks(paths)}
+
+# chi(k) for all the paths with the same path parameters (s02 = 1,
+# e0 = 0, deltar = 0, the given sigma2), calculated with the path basis
+def paths_chi(feff_paths, k, sigma2=0.003):
+    basis = {'k': k, 'reff': feff_paths['reff'], 'blocks': feff_paths['blocks']}
+    pars = {pname: np.zeros(len(feff_paths['reff'])) for pname in path_basis.PATH_PARS}
+    pars['degen'] = feff_paths['degen']
+    pars['s02'] += 1.0
+    pars['sigma2'] += sigma2
+    return path_basis.basis_chi(basis, pars)
+
+ #######################################################
+# |    Rank the paths by |chi(R)| in the fit window   | #
+# | fv: fit variables (kmin, kmax, kw, dk, window,    | #
+# |     rmin, rmax)                                   | #
+# V returns a list of paths (dictionaries), best first V #
+ #######################################################
+def rank_feff_paths(feff_dir, fv, sigma2=0.003, kstep=0.05, nfft=2048):
+    feff_paths = read_feff_paths(feff_dir)
+    k = np.arange(0, fv['kmax'] + fv['dk'] + kstep, kstep)
+    chi = paths_chi(feff_paths, k, sigma2)
+    kwin = ftwindow(k, xmin=fv['kmin'], xmax=fv['kmax'], dx=fv['dk'], window=fv['window'])
+    # forward transform for all the paths (same normalisation as xftf)
+    rstep = np.pi/(kstep*nfft)
+    weighted = np.zeros((len(chi), nfft))
+    weighted[:, :len(k)] = chi * kwin * k**fv['kw']
+    chir = (kstep/np.sqrt(np.pi)) * np.fft.fft(weighted, axis=1)[:, :nfft//2]
+    r = rstep*np.arange(nfft//2)
+    r_range = (r >= fv['rmin']) & (r <= fv['rmax'])
+    weights = np.abs(chir[:, r_range]).sum(axis=1) * rstep
+
+    order = np.argsort(-weights, kind='stable')
+    total = weights.sum()
+    ranked = []
+    for rank, p_idx in enumerate(order):
+        ranked.append({'rank': rank + 1,
+                       'filename': feff_paths['filename'][p_idx],
+                       'label': feff_paths['label'][p_idx],
+                       'nleg': int(feff_paths['nleg'][p_idx]),
+                       'degen': feff_paths['degen'][p_idx],
+                       'reff': feff_paths['reff'][p_idx],
+                       'weight': weights[p_idx],
+                       'fraction': weights[p_idx]/total if total > 0 else 0.0})
+    return ranked
+
+# path parameters from the gds parameters (names in gds_names): the first
+# candidate expression that only uses gds names, and for sigma2 the first
+# gds name starting with ss or sigma if none of the candidates is defined
+def gds_path_pars(gds_names):
+    path_pars = {}
+    for path_par, candidates in PATH_PAR_CANDIDATES.items():
+        for expr in candidates:
+            if gds_graph.expr_names(expr) <= set(gds_names) | set(path_basis.PATH_SYMBOLS):
+                path_pars[path_par] = expr
+                break
+        else:
+            if path_par == 'sigma2':
+                sigma_names = [gds_name for gds_name in gds_names
+                               if gds_name.lower().startswith(('ss', 'sigma'))]
+                if sigma_names:
+                    path_pars[path_par] = sigma_names[0]
+                    continue
+            raise ValueError("no gds parameter found for the path parameter %s "
+                             "(tried %s), give the path parameters" %
+                             (path_par, ', '.join(candidates)))
+    return path_pars
+
+# check that the path parameters only use names of the gds parameters
+# (raises ValueError)
+def check_path_pars(path_pars, gds_names):
+    for path_par in ('s02', 'e0', 'sigma2', 'deltar'):
+        if path_par not in path_pars:
+            raise ValueError("missing path parameter: " + path_par)
+        gds_graph.compile_expr("ranked paths " + path_par, str(path_pars[path_par]),
+                               list(gds_names) + list(path_basis.PATH_SYMBOLS))
+
+ #######################################################
+# |  Save the top ranked paths as selected paths csv  | #
+# | gds_file: csv file with the gds parameters used   | #
+# |     with the selected paths                       | #
+# | top_n: number of paths to select (all if None)    | #
+# | path_pars: s02, e0, sigma2 and deltar for the     | #
+# |     selected paths (gds_path_pars if None), they  | #
+# |     are checked against the gds parameters        | #
+# V the paths are written in order of path index      V #
+ #######################################################
+def save_ranked_paths(ranked, file_name, gds_file, top_n=None, path_pars=None):
+    gds_pars, _ = csvhandler.read_csv_data(gds_file)
+    if len(gds_pars) == 0:
+        raise ValueError("no gds parameters read from " + str(gds_file))
+    gds_names = [str(gds_pars[par_idx]['name']).strip() for par_idx in gds_pars]
+    if path_pars is None:
+        path_pars = gds_path_pars(gds_names)
+    check_path_pars(path_pars, gds_names)
+    selected = sorted(ranked[:top_n], key=lambda path: path['filename'])
+    sp_list = {}
+    for path_count, path in enumerate(selected, start=1):
+        sp_list[path_count] = {'id': path_count,
+                               'filename': path['filename'],
+                               'label': path['label'],
+                               's02': path_pars['s02'],
+                               'e0': path_pars['e0'],
+                               'sigma2': path_pars['sigma2'],
+                               'deltar': path_pars['deltar'],
+                               'rank': path['rank'],
+                               'weight': path['weight']}
+    csvhandler.write_csv_data(sp_list, file_name)
+    return selected
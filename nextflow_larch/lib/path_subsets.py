@@ -0,0 +1,264 @@
+# Combinatorial testing of path subsets
+#
+# Deciding which scattering paths to include in a fit usually means trying
+# many combinations by hand. The functions in this module fit all the
+# combinations of the selected paths (with a minimum and maximum number of
+# paths, and paths that must always be included) using the path basis
+# engine, distributing the fits over a pool of processes, and rank them by
+# reduced chi-square and R-factor. The Hamilton test gives the probability
+# that the improvement of each model compared with the best ranked one (or
+# of the best one compared with it) is due to chance.
+#
+# Fitting all the combinations takes 2**N fits for N optional paths, so the
+# number of combinations is limited by max_subsets. For many paths the
+# stepwise search adds one path at a time (the one that lowers the reduced
+# chi-square most) and stops when no path improves the fit, which takes at
+# most N*(N+1)/2 fits but does not test every combination.
+#
+# path_subsets: lists the combinations of paths to test.
+# hamilton_test: significance of the improvement between two models.
+# stepwise_subsets: fits the combinations found by the stepwise search.
+# fit_path_subsets: fits and ranks the combinations.
+# save_subsets: writes the ranked results to csv.
+
+# copy the gds group before changing it
+from copy import deepcopy
+# combinations of paths
+import itertools
+import os
+
+import numpy as np
+from scipy.special import betainc
+from lmfit import Minimizer
+
+from larch.fitting import group2params
+
+# library containign functions that read and write to csv files
+import lib.handle_csv as csvhandler
+# transform and data set for the fits
+import lib.manage_fit as fit_manager
+# fast residual engine and analytic jacobian
+import lib.path_basis as path_basis
+# compiled gds expressions
+import lib.gds_graph as gds_graph
+# evaluation budget for each fit
+import lib.fit_budget as fit_budget
+# run the fits in parallel
+import lib.worker_pool as worker_pool
+
+# largest number of combinations fitted by the exhaustive search
+MAX_SUBSETS = 4096
+# searches of the combinations: every combination or stepwise
+SUBSET_SEARCHES = ('all', 'stepwise')
+
+
+ #######################################################
+# |     List the combinations of paths to test        | #
+# | labels: labels of the selected paths              | #
+# | required: labels always included                  | #
+# | min_paths, max_paths: number of paths in a subset | #
+# V returns a list of tuples of path indices          V #
+ #######################################################
+def path_subsets(labels, required=(), min_paths=1, max_paths=None):
+    fixed, optional = _split_paths(labels, required)
+    if max_paths is None:
+        max_paths = len(labels)
+    subsets = []
+    for n_optional in range(len(optional) + 1):
+        n_paths = len(fixed) + n_optional
+        if n_paths < max(min_paths, 1) or n_paths > max_paths:
+            continue
+        for combination in itertools.combinations(optional, n_optional):
+            subsets.append(tuple(sorted(fixed + list(combination))))
+    return subsets
+
+# indices of the required and of the optional paths
+def _split_paths(labels, required):
+    unknown = set(required) - set(labels)
+    if unknown:
+        raise ValueError("required paths not selected: " + ', '.join(sorted(unknown)))
+    fixed = [i for i, label in enumerate(labels) if label in required]
+    optional = [i for i, label in enumerate(labels) if label not in required]
+    return fixed, optional
+
+# rank by reduced chi-square, then R-factor (failed fits last)
+def _rank_key(result):
+    return (not np.isfinite(result['chi2_reduced']),
+            result['chi2_reduced'] if np.isfinite(result['chi2_reduced']) else 0,
+            result['rfactor'])
+
+# Hamilton test: probability that the improvement of model b (more
+# variables, lower chi-square) over model a is due to chance
+def hamilton_test(chi2_a, nvar_a, chi2_b, nvar_b, n_idp):
+    extra = nvar_b - nvar_a
+    free = n_idp - nvar_b
+    if extra <= 0 or free <= 0 or chi2_a <= 0:
+        return np.nan
+    ratio = min(chi2_b/chi2_a, 1.0)
+    return betainc(free/2, extra/2, ratio)
+
+
+# basis with all the paths shared by the fits in a worker process
+def _setup_worker(portable, n_idp, data_norm, max_nfev):
+    return {'basis': path_basis.restore_basis(portable), 'n_idp': n_idp,
+            'data_norm': data_norm, 'max_nfev': max_nfev}
+
+# fit one subset of paths, returns a dictionary with the statistics
+def _subset_fit(subset):
+    worker = worker_pool.worker_state()
+    basis = path_basis.subset_basis(worker['basis'], subset)
+    graph = basis['graph']
+    n_idp = worker['n_idp']
+    result = {'paths': [basis['labels'][i] for i in range(len(subset))],
+              'nvarys': len(graph['variables']), 'success': False,
+              'chi_square': np.nan, 'chi2_reduced': np.nan, 'rfactor': np.nan,
+              'values': {}}
+    fit_params = gds_graph.graph_params(graph)
+    budget = fit_budget.FitBudget(max_nfev=worker['max_nfev'])
+    try:
+        if len(graph['variables']) > 0:
+            fit = Minimizer(path_basis.basis_residual, fit_params, fcn_args=(basis,),
+                            iter_cb=budget)
+            fit_out = fit.leastsq(Dfun=path_basis.basis_jacobian, col_deriv=True)
+            fit_params = fit_out.params
+            result['success'] = bool(fit_out.success)
+        else:
+            result['success'] = True
+    except (fit_budget.FitStopped, ValueError):
+        # stopped by the budget, or diverged (lmfit raises ValueError for
+        # nan residuals): keep the best values found
+        if not budget.best_values:
+            return result
+        for name, value in budget.best_values.items():
+            fit_params[name].value = value
+    resid = path_basis.basis_residual(fit_params, basis)
+    sum_sq = (resid**2).sum()
+    result['chi_square'] = sum_sq * n_idp / len(resid)
+    if n_idp > result['nvarys']:
+        result['chi2_reduced'] = result['chi_square'] / (n_idp - result['nvarys'])
+    result['rfactor'] = sum_sq / worker['data_norm']
+    result['values'] = {name: fit_params[name].value for name in graph['variables']}
+    return result
+
+ #######################################################
+# |  Stepwise search of the combinations of paths     | #
+# | labels: labels of the selected paths              | #
+# | fit_subsets: function fitting a list of subsets   | #
+# |   (returns their results in the same order)       | #
+# | required: labels always included                  | #
+# | min_paths, max_paths: number of paths in a subset | #
+# V returns the results of all the subsets fitted     V #
+ #######################################################
+def stepwise_subsets(labels, fit_subsets, required=(), min_paths=1, max_paths=None):
+    fixed, optional = _split_paths(labels, required)
+    if max_paths is None:
+        max_paths = len(labels)
+    results = []
+    current = fixed
+    current_chi2 = np.inf
+    if len(fixed) > 0 and len(fixed) <= max_paths:
+        results += fit_subsets([tuple(fixed)])
+        if np.isfinite(results[0]['chi2_reduced']):
+            current_chi2 = results[0]['chi2_reduced']
+    remaining = list(optional)
+    while remaining and len(current) < max_paths:
+        candidates = [tuple(sorted(current + [p_idx])) for p_idx in remaining]
+        step = fit_subsets(candidates)
+        results += step
+        best_idx = min(range(len(step)), key=lambda c_idx: _rank_key(step[c_idx]))
+        best_chi2 = step[best_idx]['chi2_reduced']
+        # stop when the best path added does not improve the fit (once the
+        # minimum number of paths is reached)
+        improves = np.isfinite(best_chi2) and best_chi2 < current_chi2
+        if not improves and len(current) >= max(min_paths, 1):
+            break
+        current = list(candidates[best_idx])
+        current_chi2 = best_chi2 if np.isfinite(best_chi2) else np.inf
+        remaining.remove(remaining[best_idx])
+    return [result for result in results if len(result['paths']) >= min_paths]
+
+ #######################################################
+# |   Fit and rank combinations of the selected paths | #
+# | data_group, gds, selected_paths, fv, session: as  | #
+# |   in manage_fit.run_fit                           | #
+# | required: labels of the paths always included     | #
+# | min_paths, max_paths: number of paths in a subset | #
+# | workers: number of processes (None for all cpus)  | #
+# | search: 'all' fits every combination, 'stepwise'  | #
+# |   adds the best path at a time                    | #
+# | max_subsets: largest number of combinations for   | #
+# |   search='all' (ValueError if exceeded, None for  | #
+# |   no limit)                                       | #
+# V returns a list of results ranked (best first)     V #
+ #######################################################
+def fit_path_subsets(data_group, gds, selected_paths, fv, session, required=(),
+                     min_paths=1, max_paths=None, workers=None, max_nfev=None,
+                     search='all', max_subsets=MAX_SUBSETS):
+    if search not in SUBSET_SEARCHES:
+        raise ValueError("unknown search of the path combinations: " + str(search))
+    trans, dset = fit_manager.fit_dataset(data_group, selected_paths, fv, session)
+    dset.prepare_fit(params=group2params(deepcopy(gds)))
+    graph = gds_graph.compile_gds(fit_manager.gds_to_dict(gds))
+    basis = path_basis.build_path_basis(dset, graph)
+    data_norm = (path_basis.basis_transform(basis, basis['chi'])**2).sum()
+    n_idp = dset.n_idp
+
+    if search == 'all':
+        subsets = path_subsets(basis['labels'], required, min_paths, max_paths)
+        if max_subsets is not None and len(subsets) > max_subsets:
+            raise ValueError("%i combinations of paths to fit (more than max_subsets = %i), "
+                             "set max_paths or required paths, or use the stepwise search"
+                             % (len(subsets), max_subsets))
+        n_tasks = len(subsets)
+    else:
+        n_tasks = len(basis['labels']) - len(required)
+    if max_nfev is None:
+        max_nfev = fv.get('max_nfev', None) or 200*(len(graph['variables']) + 1)
+    setup_args = (path_basis.portable_basis(basis), n_idp, data_norm, max_nfev)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, n_tasks))
+
+    # a single worker fits the subsets in this process
+    with worker_pool.WorkerPool(_setup_worker, setup_args,
+                                workers if workers > 1 else 0) as pool:
+        def fit_subsets(subsets):
+            return pool.map(_subset_fit, subsets)
+
+        if search == 'all':
+            results = fit_subsets(subsets)
+        else:
+            results = stepwise_subsets(basis['labels'], fit_subsets, required,
+                                       min_paths, max_paths)
+
+    results.sort(key=_rank_key)
+    best = results[0] if results else None
+    for rank, result in enumerate(results):
+        result['rank'] = rank + 1
+        result['n_idp'] = n_idp
+        if result['nvarys'] < best['nvarys']:
+            result['hamilton'] = hamilton_test(result['chi_square'], result['nvarys'],
+                                               best['chi_square'], best['nvarys'], n_idp)
+        elif result['nvarys'] > best['nvarys']:
+            result['hamilton'] = hamilton_test(best['chi_square'], best['nvarys'],
+                                               result['chi_square'], result['nvarys'], n_idp)
+        else:
+            result['hamilton'] = np.nan
+    return results
+
+# write the ranked results to a csv file
+def save_subsets(results, file_name):
+    rows = {}
+    for result in results:
+        rows[result['rank']] = {'id': result['rank'],
+                                'paths': ' '.join(result['paths']),
+                                'n_paths': len(result['paths']),
+                                'nvarys': result['nvarys'],
+                                'n_idp': result['n_idp'],
+                                'chi_square': result['chi_square'],
+                                'chi2_reduced': result['chi2_reduced'],
+                                'rfactor': result['rfactor'],
+                                'hamilton': result['hamilton'],
+                                'success': result['success']}
+        rows[result['rank']].update(result['values'])
+    csvhandler.write_csv_data(rows, file_name)
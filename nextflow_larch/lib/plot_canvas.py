@@ -0,0 +1,117 @@
+# Reusable figures for the plots saved by the batch tasks
+#
+# The plot helpers in manage_athena and manage_fit create pyplot figures,
+# which stay in memory (pyplot keeps a reference to each figure) until
+# they are closed. Saving the plots of many files in the same process
+# then uses more memory and gets slower for each file. The canvas defined
+# here keeps one figure for each plot, drawn with the non-interactive Agg
+# backend (without pyplot), which is cleared and drawn again for each
+# file and closed when the canvas is closed.
+#
+# The plots saved for each fit are chosen with the plots option of the
+# ini file (see plot_selection):
+#   nme: mu on energy
+#   rmr: overlapped chi(k) and chi(R) plots (similar to Demeter's Rmr plot)
+#   chikr: separate chi(k) and chi(R) plots
+#
+# plot_selection: names of the plots to save from the ini option.
+# PlotCanvas: figures reused for the plots, closed with close() or at the
+#             end of a with block.
+# save_fit_plots: draws and saves the selected plots of a fit.
+
+# File handling
+from pathlib import Path
+
+# plotting library (loaded on first use)
+import lib.lazy_import as lazy_import
+mpl_figure = lazy_import.lazy_module('matplotlib.figure')
+mpl_agg = lazy_import.lazy_module('matplotlib.backends.backend_agg')
+
+# plot of mu on energy
+import lib.manage_athena as athenamgr
+# plots of the fit
+import lib.manage_fit as fit_manager
+
+# plots and their figure size (None for the default size)
+PLOT_SIZES = {'nme': None, 'rmr': None, 'chikr': (16, 4)}
+PLOT_NAMES = tuple(PLOT_SIZES)
+
+
+# names of the plots from a comma separated list ('all' for all the plots,
+# 'none' or empty for no plots)
+def plot_selection(plots_text):
+    plots_text = (plots_text or '').strip().lower()
+    if plots_text in ('', 'none'):
+        return ()
+    if plots_text == 'all':
+        return PLOT_NAMES
+    plots = tuple(name.strip() for name in plots_text.split(',') if name.strip())
+    unknown = [name for name in plots if name not in PLOT_SIZES]
+    if unknown:
+        raise ValueError("Unknown plot(s) " + ', '.join(unknown) +
+                         ", valid plots are: " + ', '.join(PLOT_NAMES))
+    return plots
+
+ #######################################################
+# |       Figures reused for the batch plots          | #
+# | plots: names of the plots to draw                 | #
+# | dpi: resolution of the saved images (matplotlib   | #
+# |      default if None)                             | #
+# V  use as: with PlotCanvas(plots) as canvas: ...    V #
+ #######################################################
+class PlotCanvas:
+    def __init__(self, plots=PLOT_NAMES, dpi=None):
+        self.plots = tuple(plots)
+        self.dpi = dpi
+        self._figures = {}
+
+    # the figure for a plot, cleared to draw it again
+    def figure(self, name):
+        if name not in self._figures:
+            figure = mpl_figure.Figure(figsize=PLOT_SIZES.get(name, None))
+            mpl_agg.FigureCanvasAgg(figure)
+            self._figures[name] = figure
+        else:
+            self._figures[name].clear()
+        return self._figures[name]
+
+    def save(self, name, file_name):
+        self._figures[name].savefig(file_name, dpi=self.dpi or 'figure')
+        return file_name
+
+    # clear and release the figures (the canvas can still be used after,
+    # the figures are created again)
+    def close(self):
+        for figure in self._figures.values():
+            figure.clear()
+        self._figures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+ #######################################################
+# |       Draw and save the selected fit plots        | #
+# | canvas: PlotCanvas with the plots to save         | #
+# | data_group: fitted data group                     | #
+# | data_set: fitted data set (run_fit)               | #
+# | fv: fit variables (rmin, rmax, kmin, kmax)        | #
+# | base_path, name: output directory and file name   | #
+# V returns the list of files saved                   V #
+ #######################################################
+def save_fit_plots(canvas, data_group, data_set, fv, base_path, name):
+    saved = []
+    for plot in canvas.plots:
+        figure = canvas.figure(plot)
+        if plot == 'nme':
+            athenamgr.draw_normalised(figure.add_subplot(111), data_group)
+        elif plot == 'rmr':
+            fit_manager.draw_rmr(figure.add_subplot(111), data_set, fv['rmin'], fv['rmax'])
+        elif plot == 'chikr':
+            fit_manager.draw_chikr(figure, data_set, fv['rmin'], fv['rmax'],
+                                   fv['kmin'], fv['kmax'])
+        saved.append(canvas.save(plot, Path(base_path, name + "_fit_" + plot + ".png")))
+    return saved
@@ -0,0 +1,152 @@
+# Rendering of the fit plots in a separate process
+#
+# Drawing the plots and encoding the PNG files takes time that is not
+# needed by the fits. The plot pool sends the arrays needed for the plots
+# of each fit (fit_plot_data) to worker processes, which draw and save
+# them with the Agg backend on reused figures (lib/plot_canvas.py), while
+# the task writes the fit report and moves on to the next fit. The task
+# waits for the plots left when the pool is closed.
+#
+# The plots to save are chosen with the plots option of the ini file
+# (none to skip plotting) and the number of rendering processes with
+# plot_workers (0 to render in the task process, as before).
+#
+# fit_plot_data: arrays of a fit used by the plots (can be pickled).
+# PlotPool: renders the plots in worker processes, submit the plots of
+#           each fit and close the pool (or use in a with block) at the end.
+#           A function given to submit is called with the files saved once
+#           the plots of that fit are rendered (not called if they fail).
+
+from types import SimpleNamespace
+#library for writing to log
+import logging
+
+import numpy as np
+
+# figures reused for the plots
+import lib.plot_canvas as plot_canvas
+# timing of the stages
+import lib.tracing as tracing
+# render the plots in parallel with the fits
+import lib.worker_pool as worker_pool
+
+
+# canvas of a worker process
+def _setup_canvas(plots):
+    return {'canvas': plot_canvas.PlotCanvas(plots)}
+
+# draw and save the plots of one fit, returns the files and the trace
+# events of the worker (added to the trace of the task)
+def _render(plot_data, base_path, name):
+    canvas = worker_pool.worker_state()['canvas']
+    with tracing.span('plot', 'plot_pool', file=name):
+        saved = plot_canvas.save_fit_plots(canvas, plot_data['group'], plot_data['dset'],
+                                           plot_data['fv'], base_path, name)
+    return saved, tracing.pop_events()
+
+def _arrays(group, names):
+    return SimpleNamespace(**{name: np.asarray(getattr(group, name)) for name in names})
+
+ #######################################################
+# |       Arrays used by the plots of a fit           | #
+# | data_group: fitted data group                     | #
+# | data_set: fitted data set (run_fit)               | #
+# | fv: fit variables (rmin, rmax, kmin, kmax)        | #
+# V returns a dictionary that can be sent to workers  V #
+ #######################################################
+def fit_plot_data(data_group, data_set, fv):
+    group = _arrays(data_group, ['energy', 'mu'])
+    group.filename = str(getattr(data_group, 'filename', ''))
+    fit_arrays = ['k', 'chi', 'r', 'chir_mag', 'chir_re']
+    dset = SimpleNamespace(data=_arrays(data_set.data, fit_arrays),
+                           model=_arrays(data_set.model, fit_arrays))
+    return {'group': group, 'dset': dset,
+            'fv': {name: fv[name] for name in ('rmin', 'rmax', 'kmin', 'kmax')}}
+
+ #######################################################
+# |     Pool of processes rendering the fit plots     | #
+# | plots: names of the plots to save (plot_canvas)   | #
+# | workers: number of rendering processes, 0 renders | #
+# |          the plots in the task process            | #
+# | max_pending: plots waiting to be rendered before  | #
+# |          submit waits (2 per worker by default)   | #
+# V use as: with PlotPool(plots, 1) as pool: ...      V #
+ #######################################################
+class PlotPool:
+    def __init__(self, plots=plot_canvas.PLOT_NAMES, workers=1, max_pending=None):
+        self.plots = tuple(plots)
+        self.workers = workers if len(self.plots) > 0 else 0
+        self.max_pending = max_pending or 2*max(1, self.workers)
+        self.saved = []
+        self._pending = []
+        self._pool = None
+        self._canvas = None
+
+    def _start(self):
+        if self.workers > 0 and self._pool is None:
+            self._pool = worker_pool.WorkerPool(_setup_canvas, (self.plots,), self.workers)
+        elif self.workers == 0 and self._canvas is None:
+            self._canvas = plot_canvas.PlotCanvas(self.plots)
+
+    # collect the plots rendered (wait for the oldest ones when
+    # more than keep are pending)
+    def _collect(self, keep):
+        while len(self._pending) > keep or (self._pending and self._pending[0][1].done()):
+            name, future, done = self._pending.pop(0)
+            try:
+                saved, events = future.result()
+            except Exception as plot_error:
+                logging.error("Plots failed for " + name + ": " + str(plot_error))
+                continue
+            tracing.add_events(events)
+            self._saved(saved, done)
+
+    def _saved(self, saved, done):
+        self.saved.extend(saved)
+        if done is not None:
+            done(saved)
+
+    # render the plots of a fit (data from fit_plot_data) and save them
+    # to base_path as <name>_fit_<plot>.png, done (optional) is called with
+    # the list of files saved when the plots are rendered
+    def submit(self, plot_data, base_path, name, done=None):
+        if len(self.plots) == 0:
+            self._saved([], done)
+            return
+        self._start()
+        if self._pool is None:
+            with tracing.span('plot', 'task', file=name):
+                try:
+                    saved = plot_canvas.save_fit_plots(
+                        self._canvas, plot_data['group'], plot_data['dset'], plot_data['fv'],
+                        base_path, name)
+                except Exception as plot_error:
+                    logging.error("Plots failed for " + name + ": " + str(plot_error))
+                    return
+            self._saved(saved, done)
+            return
+        self._collect(self.max_pending - 1)
+        self._pending.append((name, self._pool.submit(_render, plot_data, base_path, name),
+                              done))
+
+    # wait for all the plots submitted
+    def wait(self):
+        self._collect(0)
+        return self.saved
+
+    # wait for the plots and stop the workers
+    def close(self):
+        self.wait()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        if self._canvas is not None:
+            self._canvas.close()
+            self._canvas = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
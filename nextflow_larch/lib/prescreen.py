@@ -0,0 +1,178 @@
+# Cheap pre-screen of spectra before the fits
+#
+# A full fit is expensive and is wasted on spectra that are too noisy,
+# badly normalised or very far from the model. The functions in this
+# module calculate for a batch of spectra (all at once using arrays with
+# one row per spectrum):
+#   - the noise level (epsilon_k and epsilon_r) from the high R part of
+#     chi(R), with larch FeffitDataSet.estimate_noise (one spectrum at a
+#     time),
+#   - the edge step and e0 from the normalisation (pre_edge),
+#   - the R-factor of the model calculated with the initial gds values,
+#     without fitting (the same model for all spectra).
+# The spectra that do not pass the thresholds given in the fit variables
+# are flagged, so they can be skipped (or only reported) by the batch.
+# When the model cannot be calculated (gds expressions or a fit space not
+# supported by the path basis) only the checks of the data are done and a
+# note is added to each spectrum, the batch goes on.
+#
+# chi_noise: noise level of a chi(k) array.
+# prescreen_groups: calculates the checks for a batch of data groups.
+# screen_report: text lines for a spectrum that did not pass the checks.
+# save_prescreen: writes the checks for all spectra to csv.
+
+# copy the gds group before changing it
+from copy import deepcopy
+#library for writing to log
+import logging
+
+import numpy as np
+from larch.fitting import group2params
+
+# library containign functions that read and write to csv files
+import lib.handle_csv as csvhandler
+# transform and data set for the fits
+import lib.manage_fit as fit_manager
+# model for all paths with the initial values
+import lib.path_basis as path_basis
+# compiled gds expressions
+import lib.gds_graph as gds_graph
+
+# pre-screen modes
+PRESCREEN_OFF = 'off'
+PRESCREEN_FLAG = 'flag'
+PRESCREEN_SKIP = 'skip'
+# number of files read and pre-screened together by the batch task
+PRESCREEN_CHUNK = 50
+
+# checks and the fit variables with their thresholds
+THRESHOLDS = {'noise': 'prescreen_max_noise',
+              'edge_step_min': 'prescreen_min_edge_step',
+              'edge_step_max': 'prescreen_max_edge_step',
+              'rfactor': 'prescreen_max_rfactor'}
+
+
+# noise level (epsilon_k, epsilon_r) of a chi(k) array on the k grid of
+# the fit, from larch FeffitDataSet.estimate_noise (as feffit)
+def chi_noise(dset, chi):
+    dset.estimate_noise(chi=chi, all_kweights=False)
+    return dset.epsilon_k, dset.epsilon_r
+
+# thresholds from the fit variables (None for the checks not used)
+def prescreen_thresholds(fv):
+    return {check: fv.get(fv_name, None) for check, fv_name in THRESHOLDS.items()}
+
+ #######################################################
+# |     Pre-screen a batch of data groups             | #
+# | data_groups: groups after calc_with_defaults      | #
+# | gds, selected_paths, fv, session: as in           | #
+# |   manage_fit.run_fit, the thresholds are read     | #
+# |   from fv (THRESHOLDS)                            | #
+# | names: names for the groups in the results        | #
+# |   (group filename by default)                     | #
+# V returns a list of dictionaries (one per group)    V #
+# V (notes says why a check was not done)             V #
+ #######################################################
+def prescreen_groups(data_groups, gds, selected_paths, fv, session, names=None):
+    thresholds = prescreen_thresholds(fv)
+    if names is None:
+        names = [getattr(data_group, 'filename', str(g_idx))
+                 for g_idx, data_group in enumerate(data_groups)]
+    results = [{'group': names[g_idx],
+                'edge_step': float(getattr(data_group, 'edge_step', np.nan)),
+                'e0': float(getattr(data_group, 'e0', np.nan)),
+                'notes': []}
+               for g_idx, data_group in enumerate(data_groups)]
+    if len(data_groups) == 0:
+        return results
+
+    # model with the initial gds values, calculated once on the fit k grid
+    trans, dset = fit_manager.fit_dataset(data_groups[0], selected_paths, fv, session)
+    try:
+        dset.prepare_fit(params=group2params(deepcopy(gds)))
+        graph = gds_graph.compile_gds(fit_manager.gds_to_dict(gds))
+        basis = path_basis.build_path_basis(dset, graph)
+        values = gds_graph.evaluate_gds(graph)
+        model = path_basis.basis_chi(basis, path_basis.basis_params(basis, values)).sum(axis=0)
+        k = basis['k']
+    except ValueError as model_error:
+        # checks of the data only, on the k grid of the fit (as larch)
+        logging.warning("pre-screen without the initial R-factor: " + str(model_error))
+        for result in results:
+            result['notes'].append('initial R-factor not checked (%s)' % model_error)
+        model = None
+        k_max = max(np.max(data_group.k) for data_group in data_groups)
+        k = trans.kstep*np.arange(int(1.01 + k_max/trans.kstep))
+
+    # data of all the spectra on the same grid
+    chi = np.array([np.interp(k, data_group.k, data_group.chi) for data_group in data_groups])
+    eps_k, eps_r = np.array([chi_noise(dset, group_chi) for group_chi in chi]).T
+    if model is not None:
+        # R-factor in the fit space (the uncertainties cancel out)
+        unit = dict(basis, eps_k=1.0, eps_r=1.0)
+        data_tr = path_basis.basis_transform(unit, chi)
+        resid_tr = path_basis.basis_transform(unit, chi - model)
+        data_norm = (data_tr**2).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rfactor = np.where(data_norm > 0, (resid_tr**2).sum(axis=1)/data_norm, np.nan)
+    else:
+        rfactor = np.full(len(data_groups), np.nan)
+
+    for g_idx, result in enumerate(results):
+        result['noise'] = eps_k[g_idx]
+        result['noise_r'] = eps_r[g_idx]
+        result['rfactor'] = rfactor[g_idx]
+        energy = getattr(data_groups[g_idx], 'energy', None)
+        flags = []
+        if not np.isfinite(result['edge_step']) or result['edge_step'] <= 0:
+            flags.append('no edge step')
+        if energy is not None and not (min(energy) < result['e0'] < max(energy)):
+            flags.append('e0 outside data')
+        if not np.isfinite(result['noise']) or \
+                (model is not None and not np.isfinite(result['rfactor'])):
+            flags.append('invalid chi')
+        if thresholds['noise'] is not None and result['noise'] > thresholds['noise']:
+            flags.append('noise %.4g > %.4g' % (result['noise'], thresholds['noise']))
+        if thresholds['edge_step_min'] is not None and \
+                result['edge_step'] < thresholds['edge_step_min']:
+            flags.append('edge step %.4g < %.4g' % (result['edge_step'],
+                                                    thresholds['edge_step_min']))
+        if thresholds['edge_step_max'] is not None and \
+                result['edge_step'] > thresholds['edge_step_max']:
+            flags.append('edge step %.4g > %.4g' % (result['edge_step'],
+                                                    thresholds['edge_step_max']))
+        if thresholds['rfactor'] is not None and result['rfactor'] > thresholds['rfactor']:
+            flags.append('initial R-factor %.4g > %.4g' % (result['rfactor'],
+                                                           thresholds['rfactor']))
+        result['flags'] = flags
+        result['passed'] = len(flags) == 0
+    return results
+
+# text lines for a spectrum that did not pass the pre-screen
+def screen_report(result):
+    lines = ['[[Pre-screen]]',
+             '   passed             = %s' % result['passed'],
+             '   noise (eps_k)      = %.7g' % result['noise'],
+             '   edge step          = %.7g' % result['edge_step'],
+             '   initial R-factor   = %.7g' % result['rfactor']]
+    for flag in result['flags']:
+        lines.append('   flag               = %s' % flag)
+    for note in result['notes']:
+        lines.append('   note               = %s' % note)
+    return '\n'.join(lines) + '\n'
+
+# write the checks for all the spectra to a csv file
+def save_prescreen(results, file_name):
+    rows = {}
+    for r_idx, result in enumerate(results, start=1):
+        rows[r_idx] = {'id': r_idx,
+                       'group': result['group'],
+                       'passed': result['passed'],
+                       'noise': result['noise'],
+                       'noise_r': result['noise_r'],
+                       'edge_step': result['edge_step'],
+                       'e0': result['e0'],
+                       'rfactor': result['rfactor'],
+                       'flags': '; '.join(result['flags']),
+                       'notes': '; '.join(result['notes'])}
+    csvhandler.write_csv_data(rows, file_name)
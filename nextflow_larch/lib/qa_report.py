@@ -0,0 +1,256 @@
+# Quality report for a batch of fits
+#
+# Checking the quality of a batch means opening the plots of each fit. The
+# functions in this module save the arrays behind the chi(k) and chi(R)
+# plots of each fit (save_qa_data, <name>_fit_qa.npz when qa_data is set
+# in the ini file) and use them to create, for a whole run:
+#   - montages with the chi(k) and |chi(R)| of many fits on each page,
+#     rendered in parallel (each page only reads the fits it shows and
+#     the arrays are downsampled with lttb_indices of manage_athena),
+#   - a static html index with all the fits sorted by R-factor (worst
+#     first) linking to the pages and to the plots of each fit.
+#
+# save_qa_data: writes the plot arrays and statistics of a fit.
+# read_qa_summary: name and statistics of a fit (without the arrays).
+# downsample: reduces a curve to a maximum number of points.
+# qa_report: creates the montages and index for a directory of fits.
+#
+# The report for a directory can be created with:
+#   python -m lib.qa_report <prefix>_fit [fits_per_page] [workers]
+
+# escape the names in the index
+import html
+import os
+import sys
+# File handling
+from pathlib import Path
+
+import numpy as np
+
+# downsample the curves keeping their shape
+import lib.manage_athena as athenamgr
+# render the pages in parallel
+import lib.worker_pool as worker_pool
+
+# plotting library (loaded on first use)
+import lib.lazy_import as lazy_import
+mpl_figure = lazy_import.lazy_module('matplotlib.figure')
+mpl_patches = lazy_import.lazy_module('matplotlib.patches')
+mpl_agg = lazy_import.lazy_module('matplotlib.backends.backend_agg')
+
+QA_SUFFIX = '_fit_qa.npz'
+# range shown in the plots (as plot_chikr)
+K_MAX = 15.0
+R_MAX = 5.0
+# fits in each row of a page
+COLUMNS = 4
+
+
+ #######################################################
+# |     Save the arrays used in the QA report         | #
+# | plot_data: arrays of the fit (fit_plot_data)      | #
+# | fit_out: results of the fit (run_fit)             | #
+# | name: name of the fit (group name)                | #
+# V file_name: npz file (<name>_fit_qa.npz)           V #
+ #######################################################
+def save_qa_data(plot_data, fit_out, name, file_name):
+    arrays = {}
+    for part in ('data', 'model'):
+        for array in ('k', 'chi', 'r', 'chir_mag'):
+            values = getattr(getattr(plot_data['dset'], part), array)
+            arrays[part + '_' + array] = np.asarray(values, dtype=np.float32)
+    with open(file_name, 'wb') as qa_file:
+        np.savez(qa_file, name=np.array(name),
+                 rfactor=np.array(getattr(fit_out, 'rfactor', np.nan), dtype=float),
+                 chi2_reduced=np.array(getattr(fit_out, 'chi2_reduced', np.nan), dtype=float),
+                 status=np.array(getattr(fit_out, 'fit_status_message', '')),
+                 fit_range=np.array([plot_data['fv'][limit] for limit in
+                                     ('kmin', 'kmax', 'rmin', 'rmax')], dtype=float),
+                 **arrays)
+    return file_name
+
+# name and statistics of a fit (the arrays are not read)
+def read_qa_summary(qa_file):
+    with np.load(qa_file) as qa_data:
+        return {'file': Path(qa_file),
+                'name': str(qa_data['name']),
+                'rfactor': float(qa_data['rfactor']),
+                'chi2_reduced': float(qa_data['chi2_reduced']),
+                'status': str(qa_data['status'])}
+
+# reduce a curve to at most max_points (largest triangle three buckets, so
+# the ends and the peaks are still shown)
+def downsample(x, y, max_points=200):
+    if max_points < 3:
+        raise ValueError("max_points must be at least 3 (the two ends of the curve "
+                         "and one point between them), got " + str(max_points))
+    index = athenamgr.lttb_indices(x, y, max_points)
+    return x[index], y[index]
+
+# k^2 chi(k) and |chi(R)| of a fit in the plot range
+def _qa_curves(qa_data, max_points):
+    curves = {}
+    for part in ('data', 'model'):
+        k = qa_data[part + '_k']
+        in_k = k <= K_MAX
+        curves[part + '_k'] = downsample(k[in_k], (qa_data[part + '_chi']*k**2)[in_k], max_points)
+        r = qa_data[part + '_r']
+        in_r = r <= R_MAX
+        curves[part + '_r'] = downsample(r[in_r], qa_data[part + '_chir_mag'][in_r], max_points)
+    return curves
+
+# settings of a worker process (its page figure is created on first use)
+def _setup_worker(per_page, max_points, dpi):
+    return {'per_page': per_page, 'max_points': max_points, 'dpi': dpi, 'page': None}
+
+# figure of a page with the axes and lines of each fit, created once in
+# each worker and updated with the data of each page
+def _page_layout(per_page):
+    rows = -(-per_page // COLUMNS)
+    figure = mpl_figure.Figure(figsize=(4.5*COLUMNS, 2.2*rows))
+    mpl_agg.FigureCanvasAgg(figure)
+    figure.subplots_adjust(left=0.03, right=0.99, bottom=0.04, top=0.97,
+                           wspace=0.25, hspace=0.45)
+    panels = []
+    for f_idx in range(per_page):
+        panel = {}
+        for s_idx, (space, x_max) in enumerate((('k', K_MAX), ('r', R_MAX))):
+            ax = figure.add_subplot(rows, 2*COLUMNS, 2*f_idx + s_idx + 1)
+            ax.set_xlim(0, x_max)
+            ax.tick_params(labelsize=6)
+            panel[space] = {'ax': ax,
+                            'data': ax.plot([], [], color='b', linewidth=0.8)[0],
+                            'model': ax.plot([], [], color='r', linewidth=0.8)[0],
+                            'range': ax.add_patch(mpl_patches.Rectangle(
+                                (0, 0), 1, 1, transform=ax.get_xaxis_transform(),
+                                color='g', alpha=0.1))}
+        panel['title'] = panel['k']['ax'].set_title('', fontsize=7, loc='left')
+        panels.append(panel)
+    return {'figure': figure, 'panels': panels}
+
+# fit range shown as a shaded band (rectangle from x_low to x_high over the
+# full height of the axes)
+def _set_range(band, x_low, x_high):
+    band.set_x(x_low)
+    band.set_width(x_high - x_low)
+
+# draw one page of the montage (the figure of the worker is reused, only
+# the data of the lines and the titles change)
+def _render_page(page):
+    page_file, qa_files = page
+    worker = worker_pool.worker_state()
+    if worker['page'] is None:
+        worker['page'] = _page_layout(worker['per_page'])
+    layout = worker['page']
+    for f_idx, panel in enumerate(layout['panels']):
+        visible = f_idx < len(qa_files)
+        panel['k']['ax'].set_visible(visible)
+        panel['r']['ax'].set_visible(visible)
+        if not visible:
+            continue
+        with np.load(qa_files[f_idx]) as qa_data:
+            curves = _qa_curves(qa_data, worker['max_points'])
+            kmin, kmax, rmin, rmax = qa_data['fit_range']
+            panel['title'].set_text("%s  R=%.4f" % (qa_data['name'], qa_data['rfactor']))
+        for space, low, high in (('k', kmin, kmax), ('r', rmin, rmax)):
+            panel[space]['data'].set_data(*curves['data_' + space])
+            panel[space]['model'].set_data(*curves['model_' + space])
+            _set_range(panel[space]['range'], low, high)
+            ax = panel[space]['ax']
+            ax.relim(visible_only=True)
+            ax.autoscale_view(scalex=False)
+    layout['figure'].savefig(page_file, dpi=worker['dpi'])
+    return page_file
+
+# static html page with the fits sorted by R-factor
+def _write_index(summaries, page_files, per_page, index_file):
+    out_dir = Path(index_file).parent
+    lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8">',
+             '<title>Fit QA report</title>',
+             '<style>body{font-family:sans-serif} td,th{padding:2px 8px;text-align:left}'
+             ' tr:nth-child(even){background:#eee}</style></head><body>',
+             '<h1>Fit QA report</h1>',
+             '<p>%i fits sorted by R-factor (worst first). Pages: %s</p>' % (
+                 len(summaries), ' '.join('<a href="%s">%i</a>' % (
+                     html.escape(Path(page_file).name), p_idx + 1)
+                     for p_idx, page_file in enumerate(page_files))),
+             '<table><tr><th>rank</th><th>fit</th><th>R-factor</th>'
+             '<th>reduced chi-square</th><th>status</th><th>page</th><th>plots</th></tr>']
+    for rank, summary in enumerate(summaries):
+        page_file = Path(page_files[rank // per_page]).name
+        plots = []
+        for plot in ('chikr', 'rmr', 'nme'):
+            plot_file = summary['file'].parent / (summary['name'] + '_fit_' + plot + '.png')
+            if plot_file.exists():
+                plots.append('<a href="%s">%s</a>' % (
+                    html.escape(os.path.relpath(plot_file, out_dir)), plot))
+        lines.append('<tr><td>%i</td><td>%s</td><td>%.5f</td><td>%.4g</td><td>%s</td>'
+                     '<td><a href="%s">%i</a></td><td>%s</td></tr>' % (
+                         rank + 1, html.escape(summary['name']), summary['rfactor'],
+                         summary['chi2_reduced'], html.escape(summary['status']),
+                         html.escape(page_file), rank // per_page + 1, ' '.join(plots)))
+    lines += ['</table>', '</body></html>']
+    with open(index_file, 'w', encoding="utf8") as out_file:
+        out_file.write('\n'.join(lines) + '\n')
+    return index_file
+
+ #######################################################
+# |       QA report for a directory of fits           | #
+# | fit_dir: directory with the <name>_fit_qa.npz     | #
+# |          files of the run                         | #
+# | out_dir: directory for the report (fit_dir/qa by  | #
+# |          default)                                 | #
+# | per_page: fits in each page of the montage        | #
+# | workers: processes rendering the pages (None for  | #
+# |          all cpus)                                | #
+# | max_points: points of each curve after            | #
+# |             downsampling                          | #
+# V returns the index file (html), ValueError if the  V #
+# V directory has no fits to report or max_points < 3 V #
+ #######################################################
+def qa_report(fit_dir, out_dir=None, per_page=20, workers=None, max_points=200, dpi=72):
+    if max_points < 3:
+        raise ValueError("max_points must be at least 3, got " + str(max_points))
+    fit_dir = Path(fit_dir)
+    qa_files = sorted(fit_dir.glob('*' + QA_SUFFIX))
+    if len(qa_files) == 0:
+        raise ValueError("no *" + QA_SUFFIX + " files found in " + str(fit_dir) +
+                         " (set qa_data = True in the ini file of the fits)")
+    out_dir = Path(out_dir) if out_dir is not None else fit_dir / 'qa'
+    out_dir.mkdir(parents=True, exist_ok=True)
+    summaries = [read_qa_summary(qa_file) for qa_file in qa_files]
+    # worst fits first, fits without R-factor at the end
+    summaries.sort(key=lambda summary: (np.isnan(summary['rfactor']), -summary['rfactor']))
+    pages = [(out_dir / ('qa_page_%04i.png' % (p_idx + 1)),
+              [summary['file'] for summary in summaries[start:start + per_page]])
+             for p_idx, start in enumerate(range(0, len(summaries), per_page))]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(pages)))
+    # a single worker renders the pages in this process
+    with worker_pool.WorkerPool(_setup_worker, (per_page, max_points, dpi),
+                                workers if workers > 1 else 0) as pool:
+        page_files = pool.map(_render_page, pages, chunksize=1)
+    return _write_index(summaries, page_files, per_page, out_dir / 'index.html')
+
+# create the report for a directory of fits
+if __name__ == '__main__':
+    usage = "usage: python -m lib.qa_report <prefix>_fit [fits_per_page] [workers]"
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print(usage)
+        sys.exit(1)
+    try:
+        fits_per_page = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+        n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    except ValueError:
+        print("fits_per_page and workers must be integers\n" + usage)
+        sys.exit(1)
+    if fits_per_page < 1 or (n_workers is not None and n_workers < 1):
+        print("fits_per_page and workers must be at least 1\n" + usage)
+        sys.exit(1)
+    try:
+        print(qa_report(sys.argv[1], per_page=fits_per_page, workers=n_workers))
+    except ValueError as report_error:
+        print(report_error)
+        sys.exit(1)
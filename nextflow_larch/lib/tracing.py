@@ -0,0 +1,238 @@
+# Tracing of the workflow stages
+#
+# The log tells what happened, but not how long each stage took. The spans
+# defined here record the start and duration of the stages (read,
+# normalise, background, ft, feff, fit, plot, report) as Chrome trace
+# events, which can be opened with chrome://tracing or https://ui.perfetto.dev,
+# and are summarised as tables of percentiles for each stage.
+#
+# Tracing is off unless the environment variable LARCH_TRACE is set to the
+# name of the trace file (json). When it is off a span does nothing.
+#
+# span: context manager that records the time of a stage.
+# traced: decorator that records each call to a function as a span.
+# pop_events, add_events: move the events of a worker process to the task.
+# start_batch_trace: empties the events file of the trace at the start of a
+#                    batch, so it only has the events of that batch.
+# write_trace: appends the events to the events file of the trace (one json
+#              line per event, so a batch of processes can share it).
+# read_events: reads the events of all the processes from the events file.
+# merge_trace: writes the events of all the processes to the trace file.
+# stage_summary: count, total and percentiles of the duration of each stage.
+# summary_table: text table with the stage summary.
+# finish_trace: writes the events and logs the summary of this process at
+#               the end of a task.
+# finish_batch_trace: writes the events, merges the events of all the
+#                     processes and logs their summary at the end of a batch.
+#
+# The events of all the processes are merged into the trace file (trace.json
+# from trace.json.jsonl) and summarised with:
+#   python -m lib.tracing trace.json
+
+# environment variable with the trace file
+import os
+import json
+import threading
+import time
+import functools
+import sys
+from contextlib import contextmanager, nullcontext
+#library for writing to log
+import logging
+
+import numpy as np
+
+# lock the events file shared by several processes (not available on windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+TRACE_ENV = 'LARCH_TRACE'
+
+# trace file (None when tracing is off) and the events recorded
+_trace = {'file': os.environ.get(TRACE_ENV, None) or None, 'events': []}
+_lock = threading.Lock()
+_no_span = nullcontext()
+
+
+def tracing_enabled():
+    return _trace['file'] is not None
+
+# turn tracing on (trace_file) or off (None) without the environment variable
+def enable_tracing(trace_file):
+    _trace['file'] = str(trace_file) if trace_file is not None else None
+
+def trace_events():
+    return list(_trace['events'])
+
+# remove and return the events recorded (sent by a worker process to the task)
+def pop_events():
+    with _lock:
+        events = _trace['events']
+        _trace['events'] = []
+    return events
+
+# add the events recorded by a worker process
+def add_events(events):
+    with _lock:
+        _trace['events'].extend(events)
+
+@contextmanager
+def _span(name, category, args):
+    # wall-clock start (events of several processes on the same timeline)
+    # and duration from the performance counter
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        event = {'name': name, 'cat': category, 'ph': 'X',
+                 'ts': start_time*1.e6, 'dur': (end - start)*1.e6,
+                 'pid': os.getpid(), 'tid': threading.get_ident()}
+        if args:
+            event['args'] = {key: str(value) for key, value in args.items()}
+        with _lock:
+            _trace['events'].append(event)
+
+ #######################################################
+# |          Record the time of a stage               | #
+# | name: stage name (read, normalise, fit, ...)      | #
+# | category: module or task recording the stage      | #
+# | args: values shown with the event (file name,...) | #
+# V   use as: with span('fit', file=name): ...        V #
+ #######################################################
+def span(name, category='larch', **args):
+    if _trace['file'] is None:
+        return _no_span
+    return _span(name, category, args)
+
+# decorator recording each call to the function as a span
+def traced(name, category='larch'):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with span(name, category):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorate
+
+# file where the processes append their events (json lines)
+def events_file(trace_file):
+    return str(trace_file) + '.jsonl'
+
+# empty the events file of the trace (events of previous batches) at the
+# start of a batch, before its processes write their events. The events
+# already recorded in this process are kept.
+def start_batch_trace(trace_file=None):
+    trace_file = trace_file or _trace['file']
+    if trace_file is None:
+        return None
+    with open(events_file(trace_file), 'a', encoding="utf8") as out_file:
+        if fcntl is not None:
+            fcntl.flock(out_file, fcntl.LOCK_EX)
+        out_file.truncate(0)
+    return events_file(trace_file)
+
+# append the events recorded in this process to the events file of the
+# trace, one json line per event (the file is locked while the lines are
+# written, so the lines of several processes are not mixed)
+def write_trace(trace_file=None):
+    trace_file = trace_file or _trace['file']
+    if trace_file is None:
+        return None
+    with _lock:
+        events = _trace['events']
+        _trace['events'] = []
+    lines = ''.join(json.dumps(event) + '\n' for event in events)
+    with open(events_file(trace_file), 'a', encoding="utf8") as out_file:
+        if fcntl is not None:
+            fcntl.flock(out_file, fcntl.LOCK_EX)
+        out_file.write(lines)
+        out_file.flush()
+    return events_file(trace_file)
+
+# events of all the processes in the events file of the trace
+def read_events(trace_file):
+    events = []
+    if not os.path.exists(events_file(trace_file)):
+        return events
+    with open(events_file(trace_file), encoding="utf8") as in_file:
+        for a_line in in_file:
+            try:
+                events.append(json.loads(a_line))
+            except ValueError:
+                # incomplete line of a process that was interrupted
+                continue
+    return events
+
+# write the events of all the processes to the trace file (Chrome trace
+# format), returns the events
+def merge_trace(trace_file):
+    events = read_events(trace_file)
+    with open(trace_file, 'w', encoding="utf8") as out_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, out_file)
+    return events
+
+ #######################################################
+# |       Summary of the duration of each stage       | #
+# | events: trace events (recorded in this process by | #
+# |     default)                                      | #
+# V returns {stage: {count, total, p50, p90, p99, max}} V #
+ #######################################################
+def stage_summary(events=None, percentiles=(50, 90, 99)):
+    if events is None:
+        events = _trace['events']
+    durations = {}
+    for event in events:
+        if event.get('ph') == 'X':
+            durations.setdefault(event['name'], []).append(event['dur']/1.e6)
+    summary = {}
+    for name, times in durations.items():
+        times = np.array(times)
+        summary[name] = {'count': len(times), 'total': times.sum(), 'max': times.max()}
+        for pct, value in zip(percentiles, np.percentile(times, percentiles)):
+            summary[name]['p%i' % pct] = value
+    return summary
+
+# text table with the summary of each stage (times in seconds)
+def summary_table(summary=None):
+    if summary is None:
+        summary = stage_summary()
+    columns = ['count', 'total', 'p50', 'p90', 'p99', 'max']
+    lines = ['%-12s' % 'stage' + ''.join('%10s' % column for column in columns)]
+    for name, values in sorted(summary.items(), key=lambda item: -item[1]['total']):
+        lines.append('%-12s%10i' % (name, values['count']) +
+                     ''.join('%10.4f' % values.get(column, np.nan) for column in columns[1:]))
+    return '\n'.join(lines)
+
+# log the summary of the stages recorded in this process (not those of
+# other processes sharing the trace) and append its events to the events
+# file, merge_trace collects the events of all the processes
+def finish_trace():
+    if not tracing_enabled() or len(_trace['events']) == 0:
+        return None
+    logging.info("Stage timings (s):\n" + summary_table())
+    return write_trace()
+
+# write the events of this process, merge the events of all the processes
+# sharing the trace (workers and other tasks) into the trace file and log
+# the summary of all of them, at the end of a batch
+def finish_batch_trace():
+    if not tracing_enabled():
+        return None
+    write_trace()
+    events = merge_trace(_trace['file'])
+    if len(events) > 0:
+        logging.info("Stage timings of the batch (s):\n" +
+                     summary_table(stage_summary(events)))
+    return events
+
+# merge the events of all the processes into the trace file and print the
+# summary of the stages
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python -m lib.tracing trace.json")
+        sys.exit(1)
+    print(summary_table(stage_summary(merge_trace(sys.argv[1]))))
@@ -0,0 +1,102 @@
+# Pools of worker processes with a shared state
+#
+# The bootstrap replicas, the path combinations, the plots and the pages of
+# the QA report run on pools of processes where each worker first builds
+# what all its tasks use (a path basis, a figure...) and then runs the
+# tasks. WorkerPool starts the processes with a set up function and the
+# log queue of the task (lib/batch_logging.py) and keeps the dictionary
+# returned by the set up as the state of each worker, which the tasks read
+# with worker_state. With 0 workers the state is set up and the tasks are
+# run in the task process, without starting a pool; the state it replaces
+# (of an inline pool that opened this one) is restored when it is closed.
+#
+# WorkerPool: pool of processes with a state set up once in each worker,
+#             map or submit the tasks and close the pool (or use in a with
+#             block) at the end.
+# worker_state: state of the worker running a task.
+
+# run the tasks in parallel
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# send the log records of the workers to the main process
+import lib.batch_logging as batch_logging
+
+# state of this process as a worker (set up by the pool)
+_state = {}
+
+
+def _init_state(setup, setup_args, log_args=None):
+    if log_args is not None:
+        batch_logging.init_worker_logging(*log_args)
+    _set_state(setup(*setup_args))
+
+def _set_state(state):
+    _state.clear()
+    _state.update(state)
+
+# state set up for the worker running the task (a dictionary)
+def worker_state():
+    return _state
+
+ #######################################################
+# |   Pool of processes with a state for each worker  | #
+# | setup: function returning the state of a worker   | #
+# |        (a dictionary), called once in each worker | #
+# | setup_args: arguments of setup (sent to each      | #
+# |        worker, they must be picklable)            | #
+# | workers: number of processes, 0 runs the tasks in | #
+# |        the task process                           | #
+# V use as: with WorkerPool(setup, args, 2) as pool:  V #
+ #######################################################
+class WorkerPool:
+    def __init__(self, setup, setup_args=(), workers=0):
+        self.workers = workers
+        self._executor = None
+        self._outer_state = None
+        if workers > 0:
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_state,
+                initargs=(setup, tuple(setup_args), batch_logging.worker_logging_args()))
+        else:
+            # an inline pool opened by a task of another inline pool (a
+            # bootstrap run by a plot worker...) keeps the state of that pool
+            self._outer_state = dict(_state)
+            _set_state(setup(*setup_args))
+
+    # run func on each item, returns the list of results (in the order of
+    # the items), the items are sent to the workers in chunks
+    def map(self, func, items, chunksize=None):
+        items = list(items)
+        if self._executor is None:
+            return [func(item) for item in items]
+        if chunksize is None:
+            chunksize = max(1, len(items) // (4*self.workers))
+        return list(self._executor.map(func, items, chunksize=chunksize))
+
+    # run func(*args) on a worker, returns a future with the result
+    def submit(self, func, *args):
+        if self._executor is not None:
+            return self._executor.submit(func, *args)
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as task_error:
+            future.set_exception(task_error)
+        return future
+
+    # stop the workers (after the tasks submitted), or restore the state the
+    # task process had before the pool
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        elif self._outer_state is not None:
+            _set_state(self._outer_state)
+            self._outer_state = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
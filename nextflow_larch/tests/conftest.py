@@ -0,0 +1,69 @@
+# Fixtures shared by the tests of the workflow library (lib)
+#
+# The tests use the FeS2 example of larch_workflow: the athena project,
+# gds parameters and selected paths, with the FEFF paths calculated once
+# per test session in a temporary directory.
+#
+# Run from the nextflow_larch directory with:
+#   python -m pytest tests
+
+# File handling
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+WORKFLOW_DIR = Path(__file__).resolve().parent.parent
+EXAMPLE_DIR = WORKFLOW_DIR.parent / 'larch_workflow'
+EXAMPLE_FILES = ('FeS2.inp', 'FeS2_gds.csv', 'FeS2_sp.csv', 'fes2_larch.prj')
+
+# the library is imported as lib (as the task scripts do)
+sys.path.insert(0, str(WORKFLOW_DIR))
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+# fit variables used by the tests
+FIT_VARS = {'fitspace': 'r', 'kmin': 3, 'kmax': 14, 'kw': 2, 'dk': 1,
+            'window': 'hanning', 'rmin': 1.4, 'rmax': 3.0}
+
+
+# directory with the example files and the FEFF paths (FeS2_feff)
+@pytest.fixture(scope='session')
+def fes2_dir(tmp_path_factory):
+    import lib.atoms_feff as feff_runner
+    work_dir = tmp_path_factory.mktemp('fes2')
+    for name in EXAMPLE_FILES:
+        shutil.copy(EXAMPLE_DIR / name, work_dir / name)
+    start_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        feff_runner.run_feff(['FeS2.inp'])
+    finally:
+        os.chdir(start_dir)
+    return work_dir
+
+# run the test in the example directory (the selected paths are relative)
+@pytest.fixture
+def in_fes2_dir(fes2_dir, monkeypatch):
+    monkeypatch.chdir(fes2_dir)
+    return fes2_dir
+
+@pytest.fixture(scope='session')
+def session():
+    from larch import Interpreter
+    return Interpreter()
+
+# first group of the example project, recalculated with defaults
+@pytest.fixture(scope='session')
+def fes2_group(fes2_dir):
+    from larch.io import read_athena, extract_athenagroup
+    import lib.manage_athena as athenamgr
+    project = read_athena(str(fes2_dir / 'fes2_larch.prj'))
+    group_key = list(project._athena_groups.keys())[0]
+    return athenamgr.calc_with_defaults(extract_athenagroup(project._athena_groups[group_key]))
+
+@pytest.fixture
+def fit_vars():
+    return dict(FIT_VARS)
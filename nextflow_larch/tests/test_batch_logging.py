@@ -0,0 +1,86 @@
+# Logging for batch runs (lib/batch_logging.py)
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+
+import pytest
+
+import lib.batch_logging as batch_logging
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    level = logging.getLogger().level
+    yield tmp_path / 'batch.log'
+    batch_logging.stop_logging()
+    batch_logging.set_log_context(file=None, stage=None)
+    logging.getLogger().setLevel(level)
+
+def _read_lines(log_file):
+    batch_logging.stop_logging()
+    return log_file.read_text().splitlines()
+
+# record logged by a worker process
+def _log_in_worker(r_idx):
+    with batch_logging.log_context(stage='fit'):
+        logging.info("worker record %i", r_idx)
+    return r_idx
+
+def test_records_with_context(log_file):
+    batch_logging.set_logger(log_file)
+    logging.info("no context")
+    with batch_logging.log_context(file='a.prj', stage='fit'):
+        logging.info("in block")
+    batch_logging.set_log_context(file='b.prj', stage='plot')
+    logging.debug("after set")
+    batch_logging.set_log_context(stage=None)
+    logging.info("stage removed")
+    lines = _read_lines(log_file)
+    assert len(lines) == 4
+    assert lines[0].endswith('[MainProcess] no context')
+    assert lines[1].endswith('[MainProcess file=a.prj stage=fit] in block')
+    assert lines[2].endswith('DEBUG - [MainProcess file=b.prj stage=plot] after set')
+    assert lines[3].endswith('[MainProcess file=b.prj] stage removed')
+
+def test_set_logger_again_does_not_duplicate(log_file):
+    root = logging.getLogger()
+    n_handlers = len(root.handlers)
+    batch_logging.set_logger(log_file)
+    batch_logging.set_logger(log_file, level=logging.INFO)
+    assert len(root.handlers) == n_handlers + 1
+    logging.debug("below the level")
+    logging.info("once")
+    assert [line.split('] ')[-1] for line in _read_lines(log_file)] == ['once']
+    assert len(root.handlers) == n_handlers
+
+def test_new_file_replaces_the_listener(log_file, tmp_path):
+    batch_logging.set_logger(log_file)
+    logging.info("first file")
+    batch_logging.set_logger(tmp_path / 'second.log')
+    logging.info("second file")
+    batch_logging.stop_logging()
+    assert log_file.read_text().splitlines()[0].endswith('first file')
+    assert 'second file' not in log_file.read_text()
+    assert (tmp_path / 'second.log').read_text().count('second file') == 1
+
+def test_worker_records(log_file):
+    batch_logging.set_logger(log_file)
+    n_records = 20
+    with batch_logging.log_context(file='a.prj'):
+        log_args = batch_logging.worker_logging_args()
+    with ProcessPoolExecutor(max_workers=2, initializer=batch_logging.init_worker_logging,
+                             initargs=log_args) as executor:
+        assert list(executor.map(_log_in_worker, range(n_records))) == list(range(n_records))
+    lines = _read_lines(log_file)
+    assert len(lines) == n_records
+    messages = sorted(line.split('] ')[-1] for line in lines)
+    assert messages == sorted('worker record %i' % r_idx for r_idx in range(n_records))
+    for line in lines:
+        assert 'MainProcess' not in line
+        assert 'file=a.prj stage=fit] worker record' in line
+
+def test_worker_without_logger():
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    batch_logging.init_worker_logging(None)
+    assert root.handlers == handlers
@@ -0,0 +1,18 @@
+# Benchmarks of the workflow (benchmarks/bench_workflow.py), smoke tests of
+# the parts that do not time the whole workflow
+
+import sys
+from pathlib import Path
+
+import lib.manage_athena as athenamgr
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'benchmarks'))
+import bench_workflow
+
+
+def test_load_read_text_reads_the_sample_spectrum():
+    # the larch_workflow library is loaded next to the lib of nextflow_larch
+    read_text = bench_workflow.load_read_text()
+    a_group = read_text(str(bench_workflow.SAMPLE_XMU), "energy mu i0")
+    assert len(a_group.energy) > 0
+    assert sys.modules['lib.manage_athena'] is athenamgr
@@ -0,0 +1,68 @@
+# Bootstrap uncertainties (lib/fit_bootstrap.py)
+
+import numpy as np
+import pytest
+from larch.fitting import Parameter
+
+import lib.fit_bootstrap as fit_bootstrap
+import lib.gds_graph as gds_graph
+import lib.handle_csv as csvhandler
+import lib.manage_fit as fit_manager
+
+
+@pytest.fixture
+def base_fit(in_fes2_dir, fes2_group, fit_vars, session):
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    selected_paths = fit_manager.read_selected_paths_list('FeS2_sp.csv', session)
+    _, dset, out = fit_manager.run_fit(fes2_group, gds, selected_paths,
+                                       dict(fit_vars, engine='basis', jacobian='analytic'),
+                                       session)
+    return out, dset, gds_graph.compile_gds(fit_manager.gds_to_dict(gds))
+
+def test_bootstrap_distributions(base_fit):
+    out, dset, graph = base_fit
+    boot = fit_bootstrap.bootstrap_fit(out, dset, graph, n_replicas=40, workers=1)
+    # delr is not used by the selected paths, it is fixed as in the fit
+    assert boot['variables'] == [name for name in graph['variables'] if name != 'delr']
+    assert boot['n_replicas'] == 40 and boot['n_failed'] < 4
+    for name in boot['variables']:
+        values = boot['values'][name]
+        assert len(values) == 40 - boot['n_failed']
+        low, high = boot['ci'][name]
+        assert low <= boot['median'][name] <= high
+        assert boot['std'][name] > 0, name
+        # the replicas start at the fit and the noise has zero mean
+        assert abs(boot['mean'][name] - out.params[name].value) < 3*boot['std'][name], name
+
+def test_bootstrap_reproducible_with_workers(base_fit):
+    out, dset, graph = base_fit
+    single = fit_bootstrap.bootstrap_fit(out, dset, graph, n_replicas=8, workers=1, seed=3)
+    parallel = fit_bootstrap.bootstrap_fit(out, dset, graph, n_replicas=8, workers=2, seed=3)
+    other_seed = fit_bootstrap.bootstrap_fit(out, dset, graph, n_replicas=8, workers=1, seed=4)
+    for name in single['variables']:
+        np.testing.assert_allclose(single['values'][name], parallel['values'][name])
+    assert not np.allclose(single['values']['amp'], other_seed['values']['amp'])
+
+def test_bootstrap_report_and_csv(base_fit, tmp_path):
+    out, dset, graph = base_fit
+    boot = fit_bootstrap.bootstrap_fit(out, dset, graph, n_replicas=5, workers=1)
+    report = fit_bootstrap.bootstrap_report(boot)
+    assert report.startswith('[[Bootstrap]]')
+    assert all(name in report for name in boot['variables'])
+    fit_bootstrap.save_bootstrap(boot, tmp_path / 'boot.csv')
+    rows, _ = csvhandler.read_csv_data(tmp_path / 'boot.csv')
+    assert len(rows) == 5 - boot['n_failed']
+
+def test_bootstrap_fixes_variables_no_path_uses(in_fes2_dir, fes2_group, fit_vars, session):
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    gds.unused = Parameter(0.5, vary=True)
+    selected_paths = fit_manager.read_selected_paths_list('FeS2_sp.csv', session)
+    _, dset, out = fit_manager.run_fit(fes2_group, gds, selected_paths,
+                                       dict(fit_vars, engine='basis', jacobian='analytic'),
+                                       session)
+    graph = gds_graph.compile_gds(fit_manager.gds_to_dict(gds))
+    assert 'unused' in graph['variables'] and not out.params['unused'].vary
+    boot = fit_bootstrap.bootstrap_fit(out, dset, graph, n_replicas=8, workers=1)
+    assert set(boot['variables']) == set(name for name, par in out.params.items()
+                                         if par.vary and name in graph['variables'])
+    assert 'unused' not in boot['values'] and boot['n_failed'] == 0
@@ -0,0 +1,108 @@
+# Evaluation budgets and fit status (lib/fit_budget.py)
+
+from types import SimpleNamespace
+
+import pytest
+from lmfit import Parameters
+
+import lib.fit_budget as fit_budget
+import lib.manage_fit as fit_manager
+import lib.path_basis as path_basis
+
+
+def _params(**values):
+    params = Parameters()
+    for name, value in values.items():
+        params.add(name, value=value)
+    params.add('fixed', value=1.0, vary=False)
+    return params
+
+def _fit(group, fv, session, **options):
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    selected_paths = fit_manager.read_selected_paths_list('FeS2_sp.csv', session)
+    return fit_manager.run_fit(group, gds, selected_paths, dict(fv, **options), session)
+
+def test_budget_keeps_best_values_and_stops():
+    budget = fit_budget.FitBudget(max_nfev=3)
+    budget(_params(a=1.0), 0, [3.0, 0.0])
+    budget(_params(a=2.0), 1, [1.0, 1.0])
+    with pytest.raises(fit_budget.FitStopped):
+        budget(_params(a=3.0), 2, [2.0, 2.0])
+    assert budget.nfev == 3 and budget.stopped
+    assert budget.status == fit_budget.FIT_MAX_NFEV
+    # best values of the variables only
+    assert budget.best_values == {'a': 2.0} and budget.best_chi2 == 2.0
+
+def test_budget_timeout():
+    budget = fit_budget.FitBudget(timeout=0)
+    with pytest.raises(fit_budget.FitStopped, match='time limit'):
+        budget(_params(a=1.0), 0, [1.0])
+    assert budget.status == fit_budget.FIT_TIMEOUT
+
+def test_remaining_budget():
+    budget = fit_budget.FitBudget(max_nfev=10, timeout=60)
+    for iteration in range(4):
+        budget(_params(a=1.0), iteration, [1.0])
+    stage = budget.remaining(20)
+    assert stage.max_nfev == 6 and 59 < stage.timeout <= 60 and not stage.stopped
+    assert budget.remaining(3).max_nfev == 3
+    assert fit_budget.FitBudget().remaining(3).timeout is None
+    budget.start_time -= 60
+    stage = budget.remaining(20)
+    assert stage.status == fit_budget.FIT_TIMEOUT
+    budget.update_from(stage)
+    assert budget.status == fit_budget.FIT_TIMEOUT
+
+def test_status_of_unsuccessful_fit():
+    budget = fit_budget.FitBudget()
+    out = SimpleNamespace(success=False)
+    fit_budget.set_fit_status(out, budget)
+    assert out.fit_status == fit_budget.FIT_NOT_CONVERGED
+    fit_budget.set_fit_status(out, budget, success=True)
+    assert out.fit_status == fit_budget.FIT_CONVERGED
+    assert fit_budget.status_report(out).startswith('[[Fit Status]]')
+    report = fit_budget.failure_report(ValueError('bad data'))
+    assert 'ValueError: bad data' in report and '= 3 (failed)' in report
+
+@pytest.mark.parametrize('engine', ['feffit', 'basis'])
+def test_stopped_fit_outputs_at_best_values(in_fes2_dir, fes2_group, fit_vars, session, engine):
+    _, dset, out = _fit(fes2_group, fit_vars, session, engine=engine, max_nfev=5)
+    assert out.fit_status == fit_budget.FIT_MAX_NFEV
+    assert out.fit_nfev == 5 and len(out.best_values) == out.nvarys
+    for name, value in out.best_values.items():
+        assert out.params[name].value == pytest.approx(value)
+    # statistics of the best values, as calculated without fitting
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    again = fit_budget.feffit_at_values(gds, dset, session, values=out.best_values)
+    assert out.chi_square == pytest.approx(again.chi_square, rel=1.e-6)
+    assert out.rfactor == pytest.approx(again.rfactor, rel=1.e-6)
+    assert 'best values found before stopping' in fit_budget.status_report(out)
+
+def test_feffit_at_values_matches_feffit(in_fes2_dir, fes2_group, fit_vars, session):
+    _, dset, out = _fit(fes2_group, fit_vars, session)
+    assert out.fit_status == fit_budget.FIT_CONVERGED
+    values = {name: out.params[name].value for name in out.var_names}
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    at_values = fit_budget.feffit_at_values(gds, dset, session, values=values)
+    assert at_values.chi_square == pytest.approx(out.chi_square, rel=1.e-6)
+    assert at_values.rfactor == pytest.approx(out.rfactor, rel=1.e-6)
+    assert at_values.nvarys == out.nvarys
+
+# the feffit confirmation of the basis engine only has the evaluations and
+# time left by the basis fit
+def test_basis_confirmation_within_budget(in_fes2_dir, fes2_group, fit_vars, session,
+                                          monkeypatch):
+    basis_nfev = _fit(fes2_group, fit_vars, session, engine='basis')[2].basis_nfev
+    out = _fit(fes2_group, fit_vars, session, engine='basis', max_nfev=basis_nfev + 2)[2]
+    assert out.basis_nfev == basis_nfev and out.confirm_nfev == 2
+    assert out.fit_status == fit_budget.FIT_MAX_NFEV
+    # basis fit using all the time: no confirmation
+    leastsq = path_basis.Minimizer.leastsq
+    def slow_leastsq(minimizer, *args, **kws):
+        result = leastsq(minimizer, *args, **kws)
+        minimizer.iter_cb.start_time -= 60
+        return result
+    monkeypatch.setattr(path_basis.Minimizer, 'leastsq', slow_leastsq)
+    out = _fit(fes2_group, fit_vars, session, engine='basis', timeout=60)[2]
+    assert out.fit_status == fit_budget.FIT_TIMEOUT and out.confirm_nfev == 0
+    assert out.chi_square > 0
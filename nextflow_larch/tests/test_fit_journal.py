@@ -0,0 +1,76 @@
+# Checkpoint journal of batch fits (lib/fit_journal.py)
+
+import pytest
+
+import lib.fit_budget as fit_budget
+import lib.fit_journal as fit_journal
+import larch_task02
+
+
+def _inputs(tmp_path):
+    data_file = tmp_path / 'data.prj'
+    data_file.write_bytes(b'spectrum')
+    gds_file = tmp_path / 'gds.csv'
+    gds_file.write_text('id,name,value,expr,vary\n1,amp,1.0,,True\n')
+    return data_file, gds_file
+
+def test_hash_changes_with_the_inputs(tmp_path):
+    data_file, gds_file = _inputs(tmp_path)
+    fit_vars = {'kmin': 3, 'kmax': 14}
+    file_hash = fit_journal.inputs_hash([data_file, gds_file], fit_vars)
+    assert file_hash == fit_journal.inputs_hash([data_file, gds_file], dict(fit_vars))
+    assert file_hash != fit_journal.inputs_hash([data_file, gds_file], {'kmin': 3, 'kmax': 12})
+    assert file_hash != fit_journal.inputs_hash([data_file, gds_file], fit_vars, prefix='paths')
+    gds_file.write_text('id,name,value,expr,vary\n1,amp,0.9,,True\n')
+    assert file_hash != fit_journal.inputs_hash([data_file, gds_file], fit_vars)
+
+def test_completed_fits(tmp_path):
+    data_file, gds_file = _inputs(tmp_path)
+    journal_file = tmp_path / 'journal.jsonl'
+    file_hash = fit_journal.inputs_hash([data_file, gds_file])
+    report = tmp_path / 'data_fit_rep.txt'
+    report.write_text('report')
+    assert fit_journal.read_journal(journal_file) == {}
+    fit_journal.record_fit(journal_file, data_file, 'old hash', [report], 1)
+    fit_journal.record_fit(journal_file, data_file, file_hash, [report], 0)
+    entries = fit_journal.read_journal(journal_file)
+    # the last entry of each file is kept
+    assert entries[str(data_file)]['status'] == 0
+    assert fit_journal.is_completed(entries, data_file, file_hash)
+    assert not fit_journal.is_completed(entries, data_file, 'other hash')
+    assert not fit_journal.is_completed(entries, tmp_path / 'other.prj', file_hash)
+    # an output removed after the fit
+    report.unlink()
+    assert not fit_journal.is_completed(entries, data_file, file_hash)
+
+def test_interrupted_journal(tmp_path):
+    data_file, _ = _inputs(tmp_path)
+    journal_file = tmp_path / 'journal.jsonl'
+    fit_journal.record_fit(journal_file, data_file, 'hash', [], 0)
+    with open(journal_file, 'a') as journal:
+        journal.write('{"file": "second.prj", "ha')
+    entries = fit_journal.read_journal(journal_file)
+    assert list(entries) == [str(data_file)]
+
+def test_unreadable_files_are_recorded_as_failed(tmp_path):
+    data_file, gds_file = _inputs(tmp_path)
+    journal_file = tmp_path / 'journal.jsonl'
+    file_hash = fit_journal.inputs_hash([data_file, gds_file])
+    with pytest.raises(Exception) as read_error:
+        larch_task02.read_data_group(data_file)
+    # the report of a file that cannot be read is named after the file
+    fit_file = larch_task02.record_read_failure(journal_file, tmp_path, data_file, file_hash,
+                                                read_error.value)
+    assert fit_file.name == larch_task02.output_name(data_file) + '_fit_rep.txt'
+    assert fit_file.name == 'data_fit_rep.txt'
+    entries = fit_journal.read_journal(journal_file)
+    assert entries[str(data_file)]['status'] == fit_budget.FIT_FAILED
+    assert entries[str(data_file)]['outputs'] == [str(fit_file)]
+    assert fit_journal.is_completed(entries, data_file, file_hash)
+    # on resume the report is written again, not appended
+    report = fit_file.read_text()
+    larch_task02.record_read_failure(journal_file, tmp_path, data_file, file_hash,
+                                     read_error.value, resume=True)
+    assert fit_file.read_text() == report
+    # the outputs of a file that is read are named after its first group
+    assert larch_task02.output_name(data_file, 'fes2_rt01') == 'fes2_rt01'
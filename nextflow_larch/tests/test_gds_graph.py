@@ -0,0 +1,69 @@
+# Compiled gds expressions and their derivatives (lib/gds_graph.py)
+
+import re
+
+import pytest
+
+import lib.gds_graph as gds_graph
+
+
+def test_dual_derivatives_match_finite_differences():
+    gds = {1: {'name': 'a', 'value': 1.3, 'expr': '', 'vary': 'True'},
+           2: {'name': 'b', 'value': 0.4, 'expr': '', 'vary': 'True'},
+           3: {'name': 'c', 'value': 0, 'expr': 'sqrt(a)*exp(-b)/(1 + b**2)', 'vary': 'False'},
+           4: {'name': 'd', 'value': 0, 'expr': 'max(a*b, 0.1) + min(c, a)**1.5', 'vary': 'False'},
+           5: {'name': 'e', 'value': 0, 'expr': 'log(a)*tanh(b) - 2**b', 'vary': 'False'}}
+    graph = gds_graph.compile_gds(gds)
+    values = {'a': 1.3, 'b': 0.4}
+    duals = gds_graph.evaluate_gds(graph, gds_graph.dual_values(graph, values))
+    for i_var, name in enumerate(graph['variables']):
+        step = 1.e-6
+        plus = gds_graph.evaluate_gds(graph, dict(values, **{name: values[name] + step}))
+        minus = gds_graph.evaluate_gds(graph, dict(values, **{name: values[name] - step}))
+        for gds_name in ('c', 'd', 'e'):
+            numeric = (plus[gds_name] - minus[gds_name])/(2*step)
+            assert duals[gds_name].der[i_var] == pytest.approx(numeric, rel=1.e-6, abs=1.e-9)
+
+def test_compile_gds_rejects_undefined_and_circular_expressions():
+    undefined = {1: {'name': 'a', 'value': 1, 'expr': 'b + c', 'vary': 'False'},
+                 2: {'name': 'b', 'value': 1, 'expr': '', 'vary': 'True'}}
+    with pytest.raises(ValueError, match='undefined names: c'):
+        gds_graph.compile_gds(undefined)
+    circular = {1: {'name': 'a', 'value': 1, 'expr': 'b', 'vary': 'False'},
+                2: {'name': 'b', 'value': 1, 'expr': 'a', 'vary': 'False'}}
+    with pytest.raises(ValueError, match='circular'):
+        gds_graph.compile_gds(circular)
+
+@pytest.mark.parametrize('expr, forbidden', [
+    ('().__class__.__base__.__subclasses__()', 'a call to Attribute'),
+    ('sqrt.__globals__', 'Attribute'),
+    ('b[0]', 'Subscript'),
+    ('2*(lambda: b)', 'Lambda'),
+    ('[b for c in (1, 2)]', 'ListComp'),
+    ('sqrt(b for c in (1, 2))', 'GeneratorExp'),
+    ('__import__', 'the name __import__'),
+    ('round(b)', 'a call to round'),
+    ('b(2)', 'a call to b'),
+    ("'x'*2", "the constant 'x'"),
+    ('b if b > 0 else 0', 'IfExp')])
+def test_compile_gds_rejects_unsafe_expressions(expr, forbidden):
+    gds = {1: {'name': 'a', 'value': 1, 'expr': expr, 'vary': 'False'},
+           2: {'name': 'b', 'value': 1, 'expr': '', 'vary': 'True'}}
+    with pytest.raises(ValueError, match='gds:a: .* uses ' + re.escape(forbidden)):
+        gds_graph.compile_gds(gds)
+
+def test_evaluate_gds_in_dependency_order():
+    # d is defined before the parameters it uses
+    gds = {1: {'name': 'd', 'value': 0, 'expr': 'c*2', 'vary': 'False'},
+           2: {'name': 'c', 'value': 0, 'expr': 'a + b', 'vary': 'False'},
+           3: {'name': 'a', 'value': 1.5, 'expr': '', 'vary': 'True'},
+           4: {'name': 'b', 'value': 0.5, 'expr': '', 'vary': 'False'}}
+    graph = gds_graph.compile_gds(gds)
+    assert gds_graph.evaluate_gds(graph) == {'d': 4.0, 'c': 2.0, 'a': 1.5, 'b': 0.5}
+    assert gds_graph.evaluate_gds(graph, {'a': 2.5})['d'] == 6.0
+
+def test_compile_gds_rejects_invalid_names_with_expressions():
+    gds = {1: {'name': 'a b', 'value': 1, 'expr': 'c', 'vary': 'False'},
+           2: {'name': 'c', 'value': 1, 'expr': '', 'vary': 'True'}}
+    with pytest.raises(ValueError, match='valid name: a b'):
+        gds_graph.compile_gds(gds)
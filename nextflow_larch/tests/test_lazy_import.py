@@ -0,0 +1,60 @@
+# Lazy import of interactive and plotting libraries (lib/lazy_import.py)
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import lib.lazy_import as lazy_import
+
+# directory of the task scripts (the library is imported as lib)
+WORKFLOW_DIR = Path(__file__).resolve().parent.parent
+
+# modules loaded in a new process after running the code
+LOADED_CHECK = """
+import json, sys
+{code}
+print(json.dumps([name for name in ('matplotlib.pyplot', 'matplotlib.figure', 'ipysheet')
+                  if name in sys.modules]))
+"""
+
+
+def _loaded_after(code):
+    output = subprocess.run([sys.executable, '-c', LOADED_CHECK.format(code=code)],
+                            cwd=WORKFLOW_DIR, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.splitlines()[-1])
+
+def test_module_loaded_on_first_use():
+    lazy = lazy_import.lazy_module('colorsys')
+    if not isinstance(lazy, lazy_import.LazyModule):
+        # already imported by another module
+        assert lazy is sys.modules['colorsys']
+        return
+    assert 'not loaded' in repr(lazy)
+    assert lazy.rgb_to_hsv(1.0, 0.0, 0.0) == (0.0, 1.0, 1.0)
+    assert "'colorsys' (loaded)" in repr(lazy)
+    assert lazy._module is sys.modules['colorsys']
+
+def test_already_imported_module():
+    assert lazy_import.lazy_module('json') is json
+
+def test_setattr_sets_the_module():
+    lazy = lazy_import.LazyModule('types')
+    lazy.lazy_import_test_value = 1
+    assert sys.modules['types'].lazy_import_test_value == 1
+    del sys.modules['types'].lazy_import_test_value
+
+def test_library_does_not_load_pyplot():
+    loaded = _loaded_after("import lib.manage_athena, lib.manage_fit, lib.plot_canvas, "
+                           "lib.plot_pool, lib.qa_report")
+    assert loaded == []
+
+def test_canvas_without_pyplot():
+    loaded = _loaded_after("import lib.plot_canvas as plot_canvas\n"
+                           "plot_canvas.PlotCanvas(('rmr',)).figure('rmr')")
+    assert loaded == ['matplotlib.figure']
+
+def test_pyplot_loaded_when_used():
+    loaded = _loaded_after("import lib.manage_athena as athenamgr\n"
+                           "athenamgr.plt.close('all')")
+    assert 'matplotlib.pyplot' in loaded
@@ -0,0 +1,76 @@
+# Basis engine and analytic jacobian (lib/path_basis.py, lib/gds_graph.py)
+
+import logging
+
+import numpy as np
+import pytest
+from larch.fitting import group2params
+
+import lib.gds_graph as gds_graph
+import lib.manage_fit as fit_manager
+import lib.path_basis as path_basis
+
+# values of the variables away from the initial ones, for the derivatives
+TEST_VALUES = {'amp': 0.9, 'enot': 3.1, 'ss': 0.004, 'alpha': 0.01, 'ss2': 0.005,
+               'ss3': 0.006, 'ssfe': 0.007, 'delr': 0.02}
+
+
+def _fit(group, fv, session, **options):
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    selected_paths = fit_manager.read_selected_paths_list('FeS2_sp.csv', session)
+    return fit_manager.run_fit(group, gds, selected_paths, dict(fv, **options), session)[2]
+
+@pytest.mark.parametrize('jacobian', [None, 'analytic'])
+def test_basis_fit_matches_feffit(in_fes2_dir, fes2_group, fit_vars, session, jacobian):
+    feffit_out = _fit(fes2_group, fit_vars, session, engine='feffit')
+    basis_out = _fit(fes2_group, fit_vars, session, engine='basis', jacobian=jacobian)
+    assert basis_out.chi_square == pytest.approx(feffit_out.chi_square, rel=1.e-4)
+    assert basis_out.rfactor == pytest.approx(feffit_out.rfactor, rel=1.e-4)
+    assert sorted(basis_out.var_names) == sorted(feffit_out.var_names)
+    for name in feffit_out.var_names:
+        feffit_par = feffit_out.params[name]
+        assert basis_out.params[name].value == pytest.approx(
+            feffit_par.value, rel=1.e-3, abs=1.e-3*max(feffit_par.stderr or 0, 1.e-6))
+
+@pytest.mark.parametrize('fitspace', ['r', 'k'])
+def test_analytic_jacobian_matches_finite_differences(in_fes2_dir, fes2_group, fit_vars,
+                                                      session, fitspace):
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    selected_paths = fit_manager.read_selected_paths_list('FeS2_sp.csv', session)
+    graph = gds_graph.compile_gds(fit_manager.gds_to_dict(gds))
+    _, dset = fit_manager.fit_dataset(fes2_group, selected_paths,
+                                      dict(fit_vars, fitspace=fitspace), session)
+    params = group2params(gds)
+    for name, value in TEST_VALUES.items():
+        params[name].value = value
+    dset.prepare_fit(params=params)
+    basis = path_basis.build_path_basis(dset, graph)
+    jacobian = path_basis.basis_jacobian(params, basis)
+    assert jacobian.shape == (len(graph['variables']), len(path_basis.basis_residual(params, basis)))
+    for i_var, name in enumerate(graph['variables']):
+        value = params[name].value
+        step = 1.e-6*max(abs(value), 1.e-3)
+        params[name].value = value + step
+        resid_plus = path_basis.basis_residual(params, basis)
+        params[name].value = value - step
+        resid_minus = path_basis.basis_residual(params, basis)
+        params[name].value = value
+        numeric = (resid_plus - resid_minus)/(2*step)
+        scale = max(np.abs(numeric).max(), 1.e-12)
+        assert np.abs(jacobian[i_var] - numeric).max()/scale < 1.e-4, name
+
+# data sets the basis cannot fit are fitted with feffit
+@pytest.mark.parametrize('change', ['fitspace', 'path'])
+def test_unsupported_basis_uses_feffit(in_fes2_dir, fes2_group, fit_vars, session, caplog, change):
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    selected_paths = fit_manager.read_selected_paths_list('FeS2_sp.csv', session)
+    fv = dict(fit_vars, engine='basis', jacobian='analytic')
+    if change == 'fitspace':
+        fv['fitspace'] = 'q'
+    else:
+        # asteval function the compiled expressions do not support
+        selected_paths[0].sigma2 = 'round(ss*1000)/1000'
+    caplog.set_level(logging.WARNING)
+    _, dset, out = fit_manager.run_fit(fes2_group, gds, selected_paths, fv, session)
+    assert 'using the feffit engine' in caplog.text
+    assert not hasattr(out, 'basis_nfev') and out.chi_square > 0
@@ -0,0 +1,74 @@
+# Ranking of the FEFF paths (lib/path_ranking.py)
+
+import numpy as np
+import pytest
+from larch import Group
+from larch.xafs import feffpath, path2chi, xftf
+
+import lib.manage_fit as fit_manager
+import lib.path_ranking as path_ranking
+
+FEFF_DIR = 'FeS2_feff'
+GDS_NAMES = ['amp', 'delr', 'enot', 'ss', 'alpha', 'ss2', 'ss3', 'ssfe']
+
+
+# chi(k) of a path calculated by larch with the default path parameters
+def _larch_chi(dat_file, k, session):
+    path = feffpath(dat_file, s02=1.0, e0=0.0, sigma2=0.003, deltar=0.0, _larch=session)
+    path2chi(path, k=k, _larch=session)
+    return path
+
+def test_paths_match_larch(in_fes2_dir, session):
+    feff_paths = path_ranking.read_feff_paths(FEFF_DIR)
+    k = np.arange(0, 15.05, 0.05)
+    chi = path_ranking.paths_chi(feff_paths, k)
+    for p_idx, dat_file in enumerate(feff_paths['filename'][:10]):
+        path = _larch_chi(dat_file, k, session)
+        assert feff_paths['reff'][p_idx] == pytest.approx(path.reff)
+        assert feff_paths['nleg'][p_idx] == path.nleg
+        assert feff_paths['degen'][p_idx] == pytest.approx(path.degen)
+        # same splines and xafs equation as larch
+        assert np.allclose(chi[p_idx], path.chi, rtol=1.e-6, atol=1.e-9)
+    assert feff_paths['label'][0] == 'S.Fe.1' and feff_paths['label'][3] == 'Fe.Fe.4'
+
+def test_ranking_matches_larch_transform(in_fes2_dir, fit_vars, session):
+    ranked = path_ranking.rank_feff_paths(FEFF_DIR, fit_vars)
+    assert [path['rank'] for path in ranked] == list(range(1, len(ranked) + 1))
+    assert sum(path['fraction'] for path in ranked) == pytest.approx(1.0)
+    k = np.arange(0, 15.05, 0.05)
+    for path in ranked[:8]:
+        chi_group = Group(k=k, chi=_larch_chi(path['filename'], k, session).chi)
+        xftf(chi_group, kmin=fit_vars['kmin'], kmax=fit_vars['kmax'], kweight=fit_vars['kw'],
+             dk=fit_vars['dk'], window=fit_vars['window'], _larch=session)
+        in_r = (chi_group.r >= fit_vars['rmin']) & (chi_group.r <= fit_vars['rmax'])
+        weight = chi_group.chir_mag[in_r].sum()*(chi_group.r[1] - chi_group.r[0])
+        assert path['weight'] == pytest.approx(weight, rel=0.02), path['label']
+
+def test_path_pars_from_gds():
+    assert path_ranking.gds_path_pars(GDS_NAMES) == {'s02': 'amp', 'e0': 'enot',
+                                                     'sigma2': 'ss', 'deltar': 'alpha*reff'}
+    path_pars = path_ranking.gds_path_pars(['s02', 'e0', 'sig_fe', 'ssa', 'dr'])
+    assert path_pars == {'s02': 's02', 'e0': 'e0', 'sigma2': 'ssa', 'deltar': 'dr'}
+    with pytest.raises(ValueError, match='e0'):
+        path_ranking.gds_path_pars(['amp', 'ss', 'delr'])
+    path_ranking.check_path_pars({'s02': 'amp', 'e0': 'enot', 'sigma2': 'ss + 0.001',
+                                  'deltar': 'delr*reff'}, GDS_NAMES)
+    with pytest.raises(ValueError, match='undefined'):
+        path_ranking.check_path_pars({'s02': 'amp', 'e0': 'de0', 'sigma2': 'ss',
+                                      'deltar': 'delr'}, GDS_NAMES)
+
+def test_saved_paths_can_be_fitted(in_fes2_dir, fes2_group, fit_vars, session, tmp_path):
+    ranked = path_ranking.rank_feff_paths(FEFF_DIR, fit_vars)
+    paths_file = tmp_path / 'ranked_sp.csv'
+    selected = path_ranking.save_ranked_paths(ranked, paths_file, 'FeS2_gds.csv', top_n=4)
+    assert sorted(path['label'] for path in selected) == \
+        sorted(path['label'] for path in ranked[:4])
+    selected_paths = fit_manager.read_selected_paths_list(str(paths_file), session)
+    assert len(selected_paths) == 4
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    out = fit_manager.run_fit(fes2_group, gds, selected_paths, fit_vars, session)[2]
+    assert np.isfinite(out.chi_square)
+    with pytest.raises(ValueError, match='undefined'):
+        path_ranking.save_ranked_paths(ranked, paths_file, 'FeS2_gds.csv',
+                                       path_pars={'s02': 'amp', 'e0': 'enot', 'sigma2': 'sig2',
+                                                  'deltar': 'delr'})
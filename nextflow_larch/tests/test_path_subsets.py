@@ -0,0 +1,77 @@
+# Combinations of the selected paths (lib/path_subsets.py)
+
+import numpy as np
+import pytest
+from scipy.stats import f as f_dist
+
+import lib.handle_csv as csvhandler
+import lib.manage_fit as fit_manager
+import lib.path_subsets as path_subsets
+
+
+@pytest.fixture
+def subset_inputs(in_fes2_dir, fit_vars, session):
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    selected_paths = fit_manager.read_selected_paths_list('FeS2_sp.csv', session)
+    return gds, selected_paths, fit_vars, session
+
+def test_list_of_subsets():
+    labels = ['a', 'b', 'c', 'd']
+    assert len(path_subsets.path_subsets(labels)) == 15
+    subsets = path_subsets.path_subsets(labels, required=['b'], min_paths=2, max_paths=3)
+    # b with one or two of the other three paths
+    assert len(subsets) == 6 and all(1 in subset for subset in subsets)
+    assert all(2 <= len(subset) <= 3 for subset in subsets)
+    with pytest.raises(ValueError, match='e'):
+        path_subsets.path_subsets(labels, required=['e'])
+
+def test_hamilton_test():
+    # same as the F test for nested models
+    chi2_a, nvar_a, chi2_b, nvar_b, n_idp = 12.0, 4, 9.0, 6, 20
+    f_value = (chi2_a - chi2_b)/(nvar_b - nvar_a)/(chi2_b/(n_idp - nvar_b))
+    expected = f_dist.sf(f_value, nvar_b - nvar_a, n_idp - nvar_b)
+    assert path_subsets.hamilton_test(chi2_a, nvar_a, chi2_b, nvar_b, n_idp) == \
+        pytest.approx(expected)
+    assert np.isnan(path_subsets.hamilton_test(chi2_a, 6, chi2_b, 6, n_idp))
+
+def test_all_combinations(fes2_group, subset_inputs, tmp_path):
+    gds, selected_paths, fit_vars, session = subset_inputs
+    results = path_subsets.fit_path_subsets(fes2_group, gds, selected_paths, fit_vars, session,
+                                            workers=1)
+    assert len(results) == 15
+    assert [result['rank'] for result in results] == list(range(1, 16))
+    ranked = [result['chi2_reduced'] for result in results if np.isfinite(result['chi2_reduced'])]
+    assert ranked == sorted(ranked)
+    # the combination of all the paths is the full fit
+    all_paths = next(result for result in results if len(result['paths']) == 4)
+    full_fit = fit_manager.run_fit(fes2_group, gds, selected_paths,
+                                   dict(fit_vars, engine='basis', jacobian='analytic'), session)[2]
+    assert all_paths['chi_square'] == pytest.approx(full_fit.chi_square, rel=1.e-3)
+    assert all_paths['rfactor'] == pytest.approx(full_fit.rfactor, rel=1.e-3)
+    path_subsets.save_subsets(results, tmp_path / 'paths.csv')
+    rows, _ = csvhandler.read_csv_data(tmp_path / 'paths.csv')
+    assert len(rows) == 15
+
+def test_stepwise_search(fes2_group, subset_inputs):
+    gds, selected_paths, fit_vars, session = subset_inputs
+    exhaustive = path_subsets.fit_path_subsets(fes2_group, gds, selected_paths, fit_vars,
+                                               session, workers=1)
+    stepwise = path_subsets.fit_path_subsets(fes2_group, gds, selected_paths, fit_vars, session,
+                                             workers=2, search='stepwise')
+    # at most N*(N+1)/2 fits, and the same best combination
+    assert len(stepwise) <= 10
+    assert stepwise[0]['paths'] == exhaustive[0]['paths']
+    assert stepwise[0]['chi2_reduced'] == pytest.approx(exhaustive[0]['chi2_reduced'])
+
+def test_required_paths_and_limit(fes2_group, subset_inputs):
+    gds, selected_paths, fit_vars, session = subset_inputs
+    results = path_subsets.fit_path_subsets(fes2_group, gds, selected_paths, fit_vars, session,
+                                            required=['S.Fe.1'], max_paths=2, workers=1)
+    assert len(results) == 4
+    assert all('S.Fe.1' in result['paths'] for result in results)
+    with pytest.raises(ValueError, match='max_subsets'):
+        path_subsets.fit_path_subsets(fes2_group, gds, selected_paths, fit_vars, session,
+                                      max_subsets=10)
+    with pytest.raises(ValueError, match='unknown search'):
+        path_subsets.fit_path_subsets(fes2_group, gds, selected_paths, fit_vars, session,
+                                      search='random')
@@ -0,0 +1,78 @@
+# Reusable figures for the batch plots (lib/plot_canvas.py)
+
+import os
+
+import numpy as np
+import pytest
+from larch import Group
+from matplotlib.figure import Figure
+
+import lib.manage_athena as athenamgr
+import lib.manage_fit as fit_manager
+import lib.plot_canvas as plot_canvas
+
+
+@pytest.fixture(scope='module')
+def fitted(fes2_dir, fes2_group, session):
+    fit_vars = {'fitspace': 'r', 'kmin': 3, 'kmax': 14, 'kw': 2, 'dk': 1,
+                'window': 'hanning', 'rmin': 1.4, 'rmax': 3.0,
+                'engine': 'basis', 'jacobian': 'analytic'}
+    # the selected paths are relative to the example directory
+    start_dir = os.getcwd()
+    os.chdir(fes2_dir)
+    try:
+        gds = fit_manager.read_gds('FeS2_gds.csv', session)
+        selected_paths = fit_manager.read_selected_paths_list('FeS2_sp.csv', session)
+        _, dset, _ = fit_manager.run_fit(fes2_group, gds, selected_paths, fit_vars, session)
+    finally:
+        os.chdir(start_dir)
+    return fes2_group, dset, fit_vars
+
+def test_plot_selection():
+    assert plot_canvas.plot_selection(None) == ()
+    assert plot_canvas.plot_selection(' None ') == ()
+    assert plot_canvas.plot_selection('all') == plot_canvas.PLOT_NAMES
+    assert plot_canvas.plot_selection('rmr, chikr,') == ('rmr', 'chikr')
+    with pytest.raises(ValueError, match='rmk'):
+        plot_canvas.plot_selection('rmr, rmk')
+
+def test_figures_reused(fitted, tmp_path):
+    data_group, dset, fit_vars = fitted
+    with plot_canvas.PlotCanvas(plot_canvas.PLOT_NAMES) as canvas:
+        first = plot_canvas.save_fit_plots(canvas, data_group, dset, fit_vars, tmp_path, 'fit0')
+        figures = dict(canvas._figures)
+        second = plot_canvas.save_fit_plots(canvas, data_group, dset, fit_vars, tmp_path, 'fit1')
+        # the same figures, cleared before drawing again
+        assert canvas._figures == figures
+        assert [len(figure.axes) for figure in figures.values()] == [1, 1, 2]
+        assert figures['chikr'].get_size_inches().tolist() == [16, 4]
+    assert canvas._figures == {}
+    assert [file_name.name for file_name in first + second] == \
+        ['fit%i_fit_%s.png' % (f_idx, plot) for f_idx in range(2)
+         for plot in plot_canvas.PLOT_NAMES]
+    # the same plots drawn on the reused figures
+    for file_0, file_1 in zip(first, second):
+        assert file_0.read_bytes() == file_1.read_bytes()
+
+def test_no_pyplot_figures(fitted, tmp_path):
+    import matplotlib.pyplot as plt
+    data_group, dset, fit_vars = fitted
+    open_figures = plt.get_fignums()
+    with plot_canvas.PlotCanvas(('nme', 'rmr')) as canvas:
+        for f_idx in range(3):
+            plot_canvas.save_fit_plots(canvas, data_group, dset, fit_vars, tmp_path,
+                                       'fit%i' % f_idx)
+    assert plt.get_fignums() == open_figures
+    assert len(list(tmp_path.glob('*.png'))) == 6
+
+def test_normalised_plot_is_downsampled(fes2_group):
+    figure = Figure()
+    dense = Group(energy=np.linspace(fes2_group.energy[0], fes2_group.energy[-1], 50000),
+                  filename='dense')
+    dense.mu = np.interp(dense.energy, fes2_group.energy, fes2_group.mu)
+    athenamgr.draw_normalised(figure.subplots(), dense)
+    line = figure.axes[0].lines[0]
+    assert len(line.get_xdata()) == athenamgr.PLOT_POINTS
+    assert line.get_xdata()[0] == dense.energy[0] and line.get_xdata()[-1] == dense.energy[-1]
+    athenamgr.draw_normalised(figure.axes[0], dense, max_points=None)
+    assert len(figure.axes[0].lines[1].get_xdata()) == len(dense.energy)
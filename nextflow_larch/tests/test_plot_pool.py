@@ -0,0 +1,87 @@
+# Rendering of the fit plots in separate processes (lib/plot_pool.py)
+
+import functools
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+import lib.fit_journal as fit_journal
+import lib.manage_fit as fit_manager
+import lib.plot_canvas as plot_canvas
+import lib.plot_pool as plot_pool
+import larch_task02
+
+
+@pytest.fixture(scope='module')
+def plot_data(fes2_dir, fes2_group, session):
+    fit_vars = {'fitspace': 'r', 'kmin': 3, 'kmax': 14, 'kw': 2, 'dk': 1,
+                'window': 'hanning', 'rmin': 1.4, 'rmax': 3.0,
+                'engine': 'basis', 'jacobian': 'analytic'}
+    # the selected paths are relative to the example directory
+    start_dir = os.getcwd()
+    os.chdir(fes2_dir)
+    try:
+        gds = fit_manager.read_gds('FeS2_gds.csv', session)
+        selected_paths = fit_manager.read_selected_paths_list('FeS2_sp.csv', session)
+        _, dset, _ = fit_manager.run_fit(fes2_group, gds, selected_paths, fit_vars, session)
+    finally:
+        os.chdir(start_dir)
+    return plot_pool.fit_plot_data(fes2_group, dset, fit_vars), dset
+
+def test_fit_plot_data(plot_data, fes2_group):
+    data, dset = plot_data
+    data = pickle.loads(pickle.dumps(data))
+    assert np.array_equal(data['group'].mu, fes2_group.mu)
+    assert np.array_equal(data['dset'].model.chir_mag, dset.model.chir_mag)
+    assert data['fv'] == {'rmin': 1.4, 'rmax': 3.0, 'kmin': 3, 'kmax': 14}
+
+@pytest.mark.parametrize('workers', [0, 1, 2])
+def test_plots_saved(plot_data, tmp_path, workers):
+    names = ['fit%i' % f_idx for f_idx in range(3)]
+    done = {}
+    with plot_pool.PlotPool(plot_canvas.PLOT_NAMES, workers, max_pending=1) as pool:
+        for name in names:
+            pool.submit(plot_data[0], tmp_path, name,
+                        done=functools.partial(done.__setitem__, name))
+    expected = {name: [tmp_path / (name + '_fit_' + plot + '.png')
+                       for plot in plot_canvas.PLOT_NAMES] for name in names}
+    assert done == expected
+    assert pool.saved == [file_name for name in names for file_name in expected[name]]
+    assert all(file_name.stat().st_size > 0 for file_name in pool.saved)
+
+def test_no_plots(plot_data, tmp_path):
+    done = []
+    with plot_pool.PlotPool((), workers=1) as pool:
+        assert pool.workers == 0
+        pool.submit(plot_data[0], tmp_path, 'fit0', done=done.append)
+    assert done == [[]] and list(tmp_path.iterdir()) == []
+
+@pytest.mark.parametrize('workers', [0, 1])
+def test_failed_plots_not_recorded(plot_data, tmp_path, workers):
+    broken = dict(plot_data[0], fv={})
+    done = []
+    with plot_pool.PlotPool(('rmr',), workers) as pool:
+        pool.submit(broken, tmp_path, 'broken', done=done.append)
+        pool.submit(plot_data[0], tmp_path, 'fit0', done=done.append)
+    assert done == [[tmp_path / 'fit0_fit_rmr.png']]
+
+def test_journal_records_fits_with_plots(plot_data, tmp_path):
+    journal_file = tmp_path / 'fit_journal.jsonl'
+    fit_files = []
+    with plot_pool.PlotPool(('rmr',), 1) as pool:
+        for f_idx in range(3):
+            fit_file = tmp_path / ('fit%i.txt' % f_idx)
+            fit_file.write_text('report')
+            fit_files.append(fit_file)
+            record_done = functools.partial(larch_task02.record_with_plots, journal_file,
+                                            'file%i.prj' % f_idx, 'hash', [fit_file], 0)
+            pool.submit(plot_data[0], tmp_path, 'fit%i' % f_idx, done=record_done)
+    entries = fit_journal.read_journal(journal_file)
+    assert sorted(entries) == ['file0.prj', 'file1.prj', 'file2.prj']
+    assert entries['file1.prj']['outputs'] == [str(fit_files[1]), str(tmp_path / 'fit1_fit_rmr.png')]
+    assert fit_journal.is_completed(entries, 'file1.prj', 'hash')
+    # a fit whose plot is missing is done again on resume
+    (tmp_path / 'fit1_fit_rmr.png').unlink()
+    assert not fit_journal.is_completed(entries, 'file1.prj', 'hash')
@@ -0,0 +1,97 @@
+# Pre-screen of the spectra before the fits (lib/prescreen.py)
+
+import copy
+
+import numpy as np
+import pytest
+from larch.fitting import group2params
+
+import lib.fit_budget as fit_budget
+import lib.handle_csv as csvhandler
+import lib.manage_fit as fit_manager
+import lib.prescreen as prescreen
+
+
+@pytest.fixture
+def fit_inputs(in_fes2_dir, session):
+    gds = fit_manager.read_gds('FeS2_gds.csv', session)
+    selected_paths = fit_manager.read_selected_paths_list('FeS2_sp.csv', session)
+    return gds, selected_paths
+
+# copy of the group with noise added to chi(k)
+def _noisy(group, noise, seed=0):
+    noisy = copy.deepcopy(group)
+    noisy.chi = group.chi + noise*np.random.default_rng(seed).normal(size=len(group.chi))
+    noisy.filename = 'noisy %g' % noise
+    return noisy
+
+def test_noise_matches_larch(fes2_group, fit_inputs, fit_vars, session):
+    gds, selected_paths = fit_inputs
+    groups = [fes2_group, _noisy(fes2_group, 0.01), _noisy(fes2_group, 0.05)]
+    results = prescreen.prescreen_groups(groups, gds, selected_paths, fit_vars, session)
+    for data_group, result in zip(groups, results):
+        _, dset = fit_manager.fit_dataset(data_group, selected_paths, fit_vars, session)
+        dset.prepare_fit(params=group2params(copy.deepcopy(gds)))
+        # noise from chi(R) only (prepare_fit adds delta_chi to epsilon_k)
+        dset.estimate_noise(chi=np.interp(dset.model.k, data_group.k, data_group.chi))
+        assert result['noise'] == pytest.approx(dset.epsilon_k, rel=1.e-2)
+        assert result['noise_r'] == pytest.approx(dset.epsilon_r, rel=1.e-2)
+    assert results[0]['noise'] < results[1]['noise'] < results[2]['noise']
+
+def test_rfactor_of_the_initial_model(fes2_group, fit_inputs, fit_vars, session):
+    gds, selected_paths = fit_inputs
+    result = prescreen.prescreen_groups([fes2_group], gds, selected_paths, fit_vars, session)[0]
+    _, dset = fit_manager.fit_dataset(fes2_group, selected_paths, fit_vars, session)
+    initial = fit_budget.feffit_at_values(gds, dset, session)
+    assert result['rfactor'] == pytest.approx(initial.rfactor, rel=1.e-3)
+    assert result['edge_step'] == pytest.approx(fes2_group.edge_step)
+    assert result['passed'] and result['flags'] == []
+
+def test_thresholds_flag_groups(fes2_group, fit_inputs, fit_vars, session, tmp_path):
+    gds, selected_paths = fit_inputs
+    no_step = copy.deepcopy(fes2_group)
+    no_step.edge_step = 0.0
+    groups = [fes2_group, _noisy(fes2_group, 0.05), no_step]
+    clean = prescreen.prescreen_groups(groups[:1], gds, selected_paths, fit_vars, session)[0]
+    limits = dict(fit_vars, prescreen_max_noise=2*clean['noise'],
+                  prescreen_max_rfactor=2*clean['rfactor'])
+    results = prescreen.prescreen_groups(groups, gds, selected_paths, limits, session,
+                                         names=['clean', 'noisy', 'no step'])
+    assert [result['group'] for result in results] == ['clean', 'noisy', 'no step']
+    assert results[0]['passed']
+    assert any(flag.startswith('noise') for flag in results[1]['flags'])
+    assert 'no edge step' in results[2]['flags']
+    assert 'flag               = no edge step' in prescreen.screen_report(results[2])
+    prescreen.save_prescreen(results, tmp_path / 'prescreen.csv')
+    rows, _ = csvhandler.read_csv_data(tmp_path / 'prescreen.csv')
+    assert len(rows) == 3
+
+def test_edge_step_limits(fes2_group, fit_inputs, fit_vars, session):
+    gds, selected_paths = fit_inputs
+    limits = dict(fit_vars, prescreen_min_edge_step=2*fes2_group.edge_step)
+    result = prescreen.prescreen_groups([fes2_group], gds, selected_paths, limits, session)[0]
+    assert not result['passed'] and result['flags'][0].startswith('edge step')
+
+@pytest.mark.parametrize('change', ['gds', 'fitspace'])
+def test_checks_of_the_data_without_model(fes2_group, fit_inputs, fit_vars, session, change):
+    gds, selected_paths = fit_inputs
+    if change == 'gds':
+        # asteval function the compiled gds graph does not support
+        gds_dict = fit_manager.gds_to_dict(gds)
+        gds_dict[len(gds_dict) + 1] = {'id': len(gds_dict) + 1, 'name': 'rounded',
+                                       'value': 0, 'expr': 'round(alpha)', 'vary': 'False'}
+        gds = fit_manager.dict_to_gds(gds_dict, session)
+    fv = dict(fit_vars, fitspace='q' if change == 'fitspace' else fit_vars['fitspace'])
+    groups = [fes2_group, _noisy(fes2_group, 0.05)]
+    expected = prescreen.prescreen_groups(groups, fit_inputs[0], selected_paths, fit_vars, session)
+    results = prescreen.prescreen_groups(groups, gds, selected_paths,
+                                         dict(fv, prescreen_max_noise=2*expected[0]['noise']),
+                                         session)
+    for result, full in zip(results, expected):
+        assert result['noise'] == pytest.approx(full['noise'])
+        assert np.isnan(result['rfactor'])
+        assert result['notes'][0].startswith('initial R-factor not checked')
+    assert results[0]['passed'] and results[0]['flags'] == []
+    assert not results[1]['passed'] and results[1]['flags'][0].startswith('noise')
+    assert 'note               = initial R-factor not checked' in \
+        prescreen.screen_report(results[0])
@@ -0,0 +1,56 @@
+# Tests of the batch QA report (lib/qa_report.py) on synthetic fits
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import lib.qa_report as qa_report
+
+
+# plot arrays of a fit as returned by fit_plot_data
+def _plot_data(scale):
+    k = np.linspace(0, 20, 401)
+    r = np.linspace(0, 10, 326)
+    curves = SimpleNamespace(k=k, chi=scale*np.sin(2*k)*np.exp(-0.1*k),
+                             r=r, chir_mag=scale*np.exp(-(r - 2)**2))
+    return {'dset': SimpleNamespace(data=curves, model=curves),
+            'fv': {'kmin': 3, 'kmax': 14, 'rmin': 1.4, 'rmax': 3.0}}
+
+def _save_fits(fit_dir, rfactors):
+    for f_idx, rfactor in enumerate(rfactors):
+        name = 'fit%02i' % f_idx
+        fit_out = SimpleNamespace(rfactor=rfactor, chi2_reduced=10*rfactor,
+                                  fit_status_message='success')
+        qa_report.save_qa_data(_plot_data(f_idx + 1), fit_out, name,
+                               fit_dir / (name + qa_report.QA_SUFFIX))
+
+def test_report_without_fits_raises(tmp_path):
+    with pytest.raises(ValueError, match='qa_data'):
+        qa_report.qa_report(tmp_path)
+    assert not (tmp_path / 'qa').exists()
+
+def test_report_pages_and_index(tmp_path):
+    _save_fits(tmp_path, [0.02, np.nan, 0.08, 0.01, 0.05])
+    index_file = qa_report.qa_report(tmp_path, per_page=2, workers=1)
+    pages = sorted((tmp_path / 'qa').glob('qa_page_*.png'))
+    assert len(pages) == 3
+    index = index_file.read_text()
+    # worst fits first, the fit without R-factor last
+    order = [index.index('fit%02i' % f_idx) for f_idx in (2, 4, 0, 3, 1)]
+    assert order == sorted(order)
+
+def test_downsample_keeps_ends_and_peaks():
+    x = np.linspace(0, 10, 5001)
+    y = np.sin(7*x)
+    y[1234] = 5.0
+    x_down, y_down = qa_report.downsample(x, y, max_points=100)
+    assert len(x_down) == 100
+    assert (x_down[0], x_down[-1]) == (x[0], x[-1])
+    assert y_down.max() == 5.0
+    assert np.all(np.diff(x_down) > 0)
+    # short curves are not changed
+    assert len(qa_report.downsample(x[:50], y[:50], max_points=100)[0]) == 50
+    for max_points in (0, 1, 2):
+        with pytest.raises(ValueError, match='max_points'):
+            qa_report.downsample(x, y, max_points=max_points)
@@ -0,0 +1,143 @@
+# Tracing of the workflow stages (lib/tracing.py)
+
+import json
+import logging
+import multiprocessing
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import lib.tracing as tracing
+
+# directory of the task scripts (python -m lib.tracing)
+WORKFLOW_DIR = Path(__file__).resolve().parent.parent
+
+
+# tracing on, with the events of the test only
+@pytest.fixture
+def trace_file(tmp_path, monkeypatch):
+    monkeypatch.setitem(tracing._trace, 'file', str(tmp_path / 'trace.json'))
+    monkeypatch.setitem(tracing._trace, 'events', [])
+    return tmp_path / 'trace.json'
+
+# events written by a separate process sharing the trace
+def _write_events(trace_file, n_events):
+    tracing.enable_tracing(trace_file)
+    tracing.pop_events()
+    for e_idx in range(n_events):
+        with tracing.span('fit', 'worker', file='spectrum %i' % e_idx):
+            pass
+    tracing.write_trace()
+
+def test_span_off(monkeypatch):
+    monkeypatch.setitem(tracing._trace, 'file', None)
+    monkeypatch.setitem(tracing._trace, 'events', [])
+    with tracing.span('fit', file='a.prj'):
+        pass
+    assert not tracing.tracing_enabled()
+    assert tracing.trace_events() == []
+    assert tracing.write_trace() is None
+    assert tracing.finish_trace() is None
+
+def test_span_and_traced(trace_file):
+    @tracing.traced('ft', 'test')
+    def transform(value):
+        return 2*value
+
+    with tracing.span('fit', 'test', file='a.prj'):
+        assert transform(2) == 4
+    events = tracing.trace_events()
+    assert [event['name'] for event in events] == ['ft', 'fit']
+    assert events[1]['args'] == {'file': 'a.prj'}
+    # the inner span is within the outer one
+    assert events[1]['ts'] <= events[0]['ts']
+    assert events[0]['dur'] <= events[1]['dur']
+
+def test_span_recorded_on_error(trace_file):
+    with pytest.raises(ValueError):
+        with tracing.span('fit'):
+            raise ValueError('failed fit')
+    assert [event['name'] for event in tracing.trace_events()] == ['fit']
+
+def test_processes_share_the_events_file(trace_file):
+    n_processes, n_events = 4, 50
+    processes = [multiprocessing.Process(target=_write_events, args=(str(trace_file), n_events))
+                 for _ in range(n_processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    with tracing.span('report', 'task'):
+        pass
+    tracing.write_trace()
+    assert tracing.trace_events() == []
+    # interrupted process: incomplete last line
+    with open(tracing.events_file(trace_file), 'a', encoding="utf8") as out_file:
+        out_file.write('{"name": "fit", "ph"')
+    events = tracing.merge_trace(trace_file)
+    assert len(events) == n_processes*n_events + 1
+    assert len({event['pid'] for event in events}) == n_processes + 1
+    with open(trace_file, encoding="utf8") as in_file:
+        assert json.load(in_file)['traceEvents'] == events
+
+def test_stage_summary(trace_file):
+    durations = [0.1, 0.2, 0.4, 0.8, 1.6]
+    events = [{'name': 'fit', 'ph': 'X', 'ts': 0, 'dur': value*1.e6} for value in durations]
+    events.append({'name': 'plot', 'ph': 'X', 'ts': 0, 'dur': 5.e6})
+    events.append({'name': 'metadata', 'ph': 'M', 'ts': 0})
+    summary = tracing.stage_summary(events)
+    assert set(summary) == {'fit', 'plot'}
+    assert summary['fit']['count'] == 5
+    assert summary['fit']['total'] == pytest.approx(sum(durations))
+    assert summary['fit']['max'] == pytest.approx(1.6)
+    for pct in (50, 90, 99):
+        assert summary['fit']['p%i' % pct] == pytest.approx(np.percentile(durations, pct))
+    lines = tracing.summary_table(summary).splitlines()
+    # sorted by total time
+    assert [line.split()[0] for line in lines] == ['stage', 'plot', 'fit']
+
+def test_merge_from_the_command_line(trace_file):
+    _write_events(str(trace_file), 3)
+    output = subprocess.run([sys.executable, '-m', 'lib.tracing', str(trace_file)],
+                            cwd=WORKFLOW_DIR, capture_output=True, text=True, check=True)
+    assert output.stdout.splitlines()[1].split()[:2] == ['fit', '3']
+    with open(trace_file, encoding="utf8") as in_file:
+        assert len(json.load(in_file)['traceEvents']) == 3
+
+def test_finish_batch_trace(trace_file, caplog):
+    caplog.set_level(logging.INFO)
+    process = multiprocessing.Process(target=_write_events, args=(str(trace_file), 2))
+    process.start()
+    process.join()
+    with tracing.span('report', 'task'):
+        pass
+    events = tracing.finish_batch_trace()
+    assert sorted(event['name'] for event in events) == ['fit', 'fit', 'report']
+    with open(trace_file, encoding="utf8") as in_file:
+        assert json.load(in_file)['traceEvents'] == events
+    # summary of the events of both processes
+    table = caplog.text.split('Stage timings of the batch (s):')[1].splitlines()
+    counts = dict(line.split()[:2] for line in table[1:] if line.split())
+    assert counts == {'stage': 'count', 'fit': '2', 'report': '1'}
+
+def test_batches_in_a_row_only_merge_their_events(trace_file, caplog):
+    caplog.set_level(logging.INFO)
+    batches = []
+    for n_events in (3, 2):
+        tracing.start_batch_trace()
+        process = multiprocessing.Process(target=_write_events, args=(str(trace_file), n_events))
+        process.start()
+        process.join()
+        with tracing.span('report', 'task'):
+            pass
+        batches.append(tracing.finish_batch_trace())
+    assert [len(events) for events in batches] == [4, 3]
+    with open(trace_file, encoding="utf8") as in_file:
+        assert json.load(in_file)['traceEvents'] == batches[1]
+    # summary of the second batch only
+    table = caplog.text.split('Stage timings of the batch (s):')[2].splitlines()
+    counts = dict(line.split()[:2] for line in table[1:] if line.split())
+    assert counts == {'stage': 'count', 'fit': '2', 'report': '1'}
@@ -0,0 +1,48 @@
+# Pools of worker processes with a shared state (lib/worker_pool.py)
+
+import os
+
+import pytest
+
+import lib.worker_pool as worker_pool
+
+
+# state of a worker: an offset and the process that set it up
+def _setup(offset):
+    return {'offset': offset, 'pid': os.getpid()}
+
+def _add_offset(value):
+    state = worker_pool.worker_state()
+    return value + state['offset'], state['pid']
+
+def _fail(value):
+    raise ValueError("task %i failed" % value)
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_map_with_the_state_of_the_worker(workers):
+    with worker_pool.WorkerPool(_setup, (10,), workers) as pool:
+        results = pool.map(_add_offset, range(8))
+    assert [value for value, _ in results] == list(range(10, 18))
+    pids = set(pid for _, pid in results)
+    if workers == 0:
+        assert pids == {os.getpid()}
+    else:
+        assert os.getpid() not in pids
+    # the state of the task process is dropped when the pool is closed
+    assert worker_pool.worker_state() == {}
+
+@pytest.mark.parametrize('workers', [0, 1])
+def test_submit_returns_a_future(workers):
+    with worker_pool.WorkerPool(_setup, (1,), workers) as pool:
+        assert pool.submit(_add_offset, 2).result()[0] == 3
+        failed = pool.submit(_fail, 4)
+        with pytest.raises(ValueError, match='task 4 failed'):
+            failed.result()
+
+def test_inline_pools_keep_the_state_of_the_outer_pool():
+    with worker_pool.WorkerPool(_setup, (10,), 0) as outer:
+        with worker_pool.WorkerPool(_setup, (100,), 0) as inner:
+            assert inner.map(_add_offset, [1])[0][0] == 101
+        # the inner pool restores the state of the outer pool
+        assert outer.map(_add_offset, [1])[0][0] == 11
+    assert worker_pool.worker_state() == {}
@@ -12,8 +12,9 @@ from larch.io import create_athena, read_athena, extract_athenagroup
 from pathlib import Path
 import sys
 
-#plotting library
-import matplotlib.pyplot as plt
+#plotting library (loaded on first use)
+import lib.lazy_import as lazy_import
+plt = lazy_import.lazy_module('matplotlib.pyplot')
 
 #library for writing to log
 import logging
@@ -24,25 +25,16 @@ import ast
 # library to handle ini file 
 import configparser
 
+# timing of the stages (LARCH_TRACE=trace.json)
+import lib.tracing as tracing
+
 # Custom Functions
 # The functions defined (methods) for processing XAS files.
-# - set_logger: intialises the logging. 
 # - get_files_list: returns a list of files in the directory matching the given file pattern.
 # - rename_cols: renames the energy and mu columns (col1 and col2 in the dat files).
 ##- plot_normalised: shows the plot of normalised data
 
 
-# initialise log file
-def set_logger(log_file):
-    logger = logging.getLogger()
-    fhandler = logging.FileHandler(filename=log_file, mode='a')
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fhandler.setFormatter(formatter)
-    logger.addHandler(fhandler)
-    # prevent matplotlib font manager from writing to log
-    logging.getLogger('matplotlib.font_manager').disabled = True
-    logger.setLevel(logging.DEBUG)
-
 #reading all with the same extension files from a dir
 def get_files_list(source_dir, f_pattern):
     i_counter = 0
@@ -98,7 +90,8 @@ def start_task(files_path, f_prefix, show_graph):
         logging.info ("project name: "+ p_name)
         p_path = Path(p_name + ".prj")
         logging.info ("project path: "+ str(p_path))
-        xas_data = read_ascii(a_file)
+        with tracing.span('read', 'task', file=file_name):
+            xas_data = read_ascii(a_file)
         # using vars(fe_xas) we see that the object has the following properties: 
         # path, filename, header, data, attrs, energy, xmu, i0
         # print(vars(xas_data))
@@ -110,16 +103,20 @@ def start_task(files_path, f_prefix, show_graph):
 
         # calculate pre-edge and post edge and add them to group
         # using defaults
-        pre_edge(energy=xas_data.energy, mu=xas_data.mu , group=xas_data)
+        with tracing.span('normalise', 'task', file=file_name):
+            pre_edge(energy=xas_data.energy, mu=xas_data.mu , group=xas_data)
         # Show graph if needed
         if show_graph:
             plot_normalised(xas_data)
 
-        xas_project = create_athena(p_path)
-        xas_project.add_group(xas_data)
-        xas_project.save()
+        with tracing.span('save', 'task', file=file_name):
+            xas_project = create_athena(p_path)
+            xas_project.add_group(xas_data)
+            xas_project.save()
 
     logging.info("Finished processing")
+    # stage timings for all the files (when tracing is on)
+    tracing.finish_trace()
 
 # To avoid running if the intention was only to import a function
 if __name__ == '__main__':
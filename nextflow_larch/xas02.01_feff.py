@@ -15,14 +15,14 @@ from larch import Interpreter
 # File handling
 from pathlib import Path
 
-#plotting library
-import matplotlib.pyplot as plt
 
 # subprocess library used to run perl script
 import subprocess
 
 #library for writing to log
 import logging
+# queue based log file shared with the worker processes
+import lib.batch_logging as batch_logging
 
 
 # Library with the functions that handle athena files
@@ -37,6 +37,12 @@ import lib.atoms_feff as feff_runner
 # GDS parameters, and scattering paths. 
 import lib.manage_fit as fit_manager  
 
+# rank the paths calculated by FEFF
+import lib.path_ranking as path_ranking
+
+# timing of the stages (LARCH_TRACE=trace.json)
+import lib.tracing as tracing
+
 # managing parameters
 import sys
 
@@ -50,24 +56,8 @@ import configparser
 #
 # Functions (methods) for processing XAS files.
 #
-# set_logger: intialises the logging.
 # get_files_list: returns a list of files in the directory matching the given file pattern.
 
- #######################################################
-# |                Initialise log file                | #
-# V  provide the path and name of the log file to use V #
- #######################################################
-    
-def set_logger(log_file):
-    logger = logging.getLogger()
-    fhandler = logging.FileHandler(filename=log_file, mode='a')
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fhandler.setFormatter(formatter)
-    logger.addHandler(fhandler)
-    # prevent matplotlib font manager from writing to log
-    logging.getLogger('matplotlib.font_manager').disabled = True
-    logger.setLevel(logging.DEBUG)
-
  #######################################################
 # |                  Get a list of files              | #
 # V       provide the path and pattern to match       V #
@@ -132,7 +122,7 @@ def start_task(argv):
     log_file = Path("./",base_path,"process.log")
     print(log_file)
     # set path for log
-    set_logger(log_file)
+    batch_logging.set_logger(log_file)
 
     # get the list of files to process
     source_path = Path(data_path)
@@ -301,5 +291,27 @@ if __name__ == '__main__':
     #  task 02.02  run fit for each prj file
     # run feff once
     # it will output to filename_feff
-    feff_runner.run_feff(crystal_files)
-
+    feff_dirs = feff_runner.run_feff(crystal_files)
+    # optional: ini file with the fit window and number of paths to
+    # pre-select (rank_top_n), writes filename_feff_sp_ranked.csv
+    if len(sys.argv) > 2:
+        rank_config = configparser.ConfigParser()
+        rank_config.read(sys.argv[2])
+        top_n = rank_config['DEFAULT'].getint("rank_top_n", None)
+        if top_n is not None:
+            rank_vars = {}
+            rank_vars['kmin']=float(rank_config['DEFAULT']["kmin"])
+            rank_vars['kmax']=float(rank_config['DEFAULT']["kmax"])
+            rank_vars['kw']=int(rank_config['DEFAULT']["kw"])
+            rank_vars['dk']=float(rank_config['DEFAULT']["dk"])
+            rank_vars['window']=rank_config['DEFAULT']["window"]
+            rank_vars['rmin']=float(rank_config['DEFAULT']["rmin"])
+            rank_vars['rmax']=float(rank_config['DEFAULT']["rmax"])
+            # the path parameters are taken from the gds parameters of the fit
+            rank_gds_f = rank_config['DEFAULT']["gds_parms_f"]
+            for feff_dir in feff_dirs:
+                ranked = path_ranking.rank_feff_paths(feff_dir, rank_vars)
+                path_ranking.save_ranked_paths(ranked, feff_dir+"_sp_ranked.csv", rank_gds_f,
+                                               top_n)
+                print("Selected", min(top_n, len(ranked)), "of", len(ranked), "paths from", feff_dir)
+    tracing.finish_trace()
@@ -13,8 +13,6 @@ from larch import Interpreter
 # File handling
 from pathlib import Path
 
-#plotting library
-import matplotlib.pyplot as plt
 
 # subprocess library used to run perl script
 import subprocess
@@ -34,6 +32,19 @@ import lib.atoms_feff as feff_runner
 # GDS parameters, and scattering paths. 
 import lib.manage_fit as fit_manager  
 
+# cheap checks of the spectrum before the fit
+import lib.prescreen as prescreen
+
+# timing of the stages (LARCH_TRACE=trace.json)
+import lib.tracing as tracing
+
+# plots to save
+import lib.plot_canvas as plot_canvas
+# rendering of the plots in a separate process
+import lib.plot_pool as plot_pool
+# arrays of the fit for the batch QA report
+import lib.qa_report as qa_report
+
 # managing parameters
 import sys
 
@@ -47,24 +58,8 @@ import configparser
 #
 # Functions (methods) for processing XAS files.
 #
-# set_logger: intialises the logging.
 # get_files_list: returns a list of files in the directory matching the given file pattern.
 
- #######################################################
-# |                Initialise log file                | #
-# V  provide the path and name of the log file to use V #
- #######################################################
-    
-def set_logger(log_file):
-    logger = logging.getLogger()
-    fhandler = logging.FileHandler(filename=log_file, mode='a')
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fhandler.setFormatter(formatter)
-    logger.addHandler(fhandler)
-    # prevent matplotlib font manager from writing to log
-    logging.getLogger('matplotlib.font_manager').disabled = True
-    logger.setLevel(logging.DEBUG)
-
  #######################################################
 # |                  Get a list of files              | #
 # V       provide the path and pattern to match       V #
@@ -80,14 +75,21 @@ def get_files_list(source_dir, f_pattern):
     return files_list
 
 
-def single_file_task(a_file, gds_parms_f, sel_paths_f, fit_vars, out_pattern):
+# pool: renders the plots (shared when processing several files in the
+# same process), a pool for this file is used if None
+def single_file_task(a_file, gds_parms_f, sel_paths_f, fit_vars, out_pattern, pool=None):
+    if pool is None:
+        # the plots of this file are saved before returning
+        with plot_pool.PlotPool(fit_vars['plots'], fit_vars['plot_workers']) as file_pool:
+            return single_file_task(a_file, gds_parms_f, sel_paths_f, fit_vars,
+                                    out_pattern, file_pool)
     # session object
     session = Interpreter()
     # read the gds parameters from input file
     gds = fit_manager.read_gds(gds_parms_f, session)
     logging.info("GDS Parameters read OK")
     project_name = a_file.name
-    data_prj = read_athena(a_file)
+    data_prj = athenamgr.read_project(a_file)
     group_keys = list(data_prj._athena_groups.keys())
     athena_group = extract_athenagroup(data_prj._athena_groups[group_keys[0]])
 
@@ -106,31 +108,45 @@ def single_file_task(a_file, gds_parms_f, sel_paths_f, fit_vars, out_pattern):
     ##################################################################
     selected_paths = fit_manager.read_selected_paths_list(sel_paths_f, session)
     logging.info("Selected Paths read from " + sel_paths_f + " OK")
-    # run fit
-    trans, dset, out = fit_manager.run_fit(data_group, gds, selected_paths, fit_vars, session)
-    show_graph = True
-    if show_graph:    
-        # plot normalised mu on energy
-        # plot mu vs flat normalised mu for selected groups
-        plt = athenamgr.plot_normalised(data_group)
-        #plt.show()
-        fig_file = Path("./",base_path,group_keys[0]+"_fit_nme.png")
-        plt.savefig(fig_file)
-        # overlapped chi(k) and chi(R) plots (similar to Demeter's Rmr plot)
-        rmr_p = fit_manager.plot_rmr(dset,fit_vars['rmin'],fit_vars['rmax'])
-        #rmr_p.show()
-        fig_file = Path("./",base_path,group_keys[0]+"_fit_rmr.png")
-        rmr_p.savefig(fig_file)
-        # separate chi(k) and chi(R) plots
-        chikr_p = fit_manager.plot_chikr(dset,fit_vars['rmin'],fit_vars['rmax'],fit_vars['kmin'],fit_vars['kmax'])
-        #chikr_p.show()
-        fig_file = Path("./",base_path,group_keys[0]+"_fit_chikr.png")
-        chikr_p.savefig(fig_file)
-
-            
-    #save the fit report to a text file
     fit_file = Path("./",base_path,group_keys[0]+"_fit_rep.txt")
+    screen = None
+    if fit_vars['prescreen'] != prescreen.PRESCREEN_OFF:
+        screen = prescreen.prescreen_groups([data_group], gds, selected_paths, fit_vars,
+                                            session, names=group_keys[:1])[0]
+        if not screen['passed']:
+            logging.warning("Pre-screen flags for " + group_keys[0] + ": " + '; '.join(screen['flags']))
+            if fit_vars['prescreen'] == prescreen.PRESCREEN_SKIP:
+                # the spectrum is not fitted, only its pre-screen is reported
+                with open(fit_file, "a") as f:
+                    f.write(prescreen.screen_report(screen))
+                logging.info("Skipped file: " + group_keys[0])
+                return
+    # run fit, a fit that fails is recorded so the workflow can move on
+    try:
+        trans, dset, out = fit_manager.run_fit(data_group, gds, selected_paths, fit_vars, session)
+    except Exception as fit_error:
+        logging.error("Fit failed for " + group_keys[0] + ": " + str(fit_error))
+        fit_manager.save_fit_failure(fit_error, fit_file)
+        return
+    logging.info("Fit status: " + out.fit_status_message)
+    # mu on energy, overlapped chi(k) and chi(R) plots (similar to Demeter's
+    # Rmr plot) and separate chi(k) and chi(R) plots, rendered while the
+    # report is written
+    if len(pool.plots) > 0 or fit_vars['qa_data']:
+        plot_data = plot_pool.fit_plot_data(data_group, dset, fit_vars)
+        pool.submit(plot_data, base_path, group_keys[0])
+        if fit_vars['qa_data']:
+            qa_report.save_qa_data(plot_data, out, group_keys[0],
+                                   Path(base_path, group_keys[0] + qa_report.QA_SUFFIX))
+
+    #save the fit report to a text file
     fit_manager.save_fit_report(out, fit_file, session)
+    if screen is not None and not screen['passed']:
+        with open(fit_file, "a") as f:
+            f.write(prescreen.screen_report(screen))
+    if hasattr(out, 'bootstrap'):
+        boot_file = Path("./",base_path,group_keys[0]+"_bootstrap.csv")
+        fit_manager.save_bootstrap(out, boot_file)
 
     logging.info("Processed file: "+  group_keys[0])
 
@@ -158,6 +174,29 @@ def read_ini(ini_file_path):
             fit_vars['window']=fit_config['DEFAULT']["window"]
             fit_vars['rmin']=float(fit_config['DEFAULT']["rmin"])
             fit_vars['rmax']=float(fit_config['DEFAULT']["rmax"])
+            # optional fit backend: feffit (default) or basis
+            fit_vars['engine']=fit_config['DEFAULT'].get("fit_engine", "feffit")
+            # optional analytic jacobian for the basis engine
+            fit_vars['jacobian']=fit_config['DEFAULT'].get("fit_jacobian", None)
+            # optional limits for each fit: evaluations and time in seconds
+            fit_vars['max_nfev']=fit_config['DEFAULT'].getint("fit_max_nfev", None)
+            fit_vars['timeout']=fit_config['DEFAULT'].getfloat("fit_timeout", None)
+            # optional bootstrap uncertainties: number of replicas and processes
+            fit_vars['bootstrap']=fit_config['DEFAULT'].getint("bootstrap", 0)
+            fit_vars['bootstrap_workers']=fit_config['DEFAULT'].getint("bootstrap_workers", None)
+            # optional pre-screen of the spectrum: off (default), flag or skip
+            fit_vars['prescreen']=fit_config['DEFAULT'].get("prescreen", "off")
+            fit_vars['prescreen_max_noise']=fit_config['DEFAULT'].getfloat("prescreen_max_noise", None)
+            fit_vars['prescreen_min_edge_step']=fit_config['DEFAULT'].getfloat("prescreen_min_edge_step", None)
+            fit_vars['prescreen_max_edge_step']=fit_config['DEFAULT'].getfloat("prescreen_max_edge_step", None)
+            fit_vars['prescreen_max_rfactor']=fit_config['DEFAULT'].getfloat("prescreen_max_rfactor", None)
+            # optional plots saved for the fit: nme, rmr, chikr (all by default) or none
+            fit_vars['plots']=plot_canvas.plot_selection(fit_config['DEFAULT'].get("plots", "all"))
+            # optional processes rendering the plots (0 renders them in the task,
+            # the default for a single file, where a pool would not overlap fits)
+            fit_vars['plot_workers']=fit_config['DEFAULT'].getint("plot_workers", 0)
+            # optional arrays of the fit for the batch QA report (lib/qa_report.py)
+            fit_vars['qa_data']=fit_config['DEFAULT'].getboolean("qa_data", False)
         else:
             print("invalid or non existent ini file")
             raise NameError('IniFileError')            
@@ -183,5 +222,7 @@ if __name__ == '__main__':
   #  task 02.02  run fit for each prj file
   # feff must have already, the crystal files list is not used here
   # run for one file using the feef output
-  single_file_task(file_name, gds_file, selpaths_file, fit_vars, out_pattern)
+  with tracing.span('file', 'task', file=file_name.name):
+    single_file_task(file_name, gds_file, selpaths_file, fit_vars, out_pattern)
+  tracing.finish_trace()
 
@@ -0,0 +1,121 @@
+# Larch Libraries
+# managing athena files
+from larch.io import extract_athenagroup
+
+from larch import Interpreter
+
+# File handling
+from pathlib import Path
+
+#library for writing to log
+import logging
+# queue based log file shared with the worker processes
+import lib.batch_logging as batch_logging
+
+# Library with the functions that handle athena files
+import lib.manage_athena as athenamgr
+
+# library containign functions tho manage fit, at read, write
+# GDS parameters, and scattering paths.
+import lib.manage_fit as fit_manager
+
+# combinatorial testing of the selected paths
+import lib.path_subsets as path_subsets
+
+# timing of the stages (LARCH_TRACE=trace.json)
+import lib.tracing as tracing
+
+# managing parameters
+import sys
+
+# for converting text list to python list
+import ast
+
+# library to handle ini file
+import configparser
+
+# Test the combinations of the selected paths for one athena file. The
+# combinations are fitted (in parallel) and the ranked results are saved
+# to <group>_paths.csv in the output directory.
+#
+# The ini file provides the fit variables (as for xas02.02_fit.py) and the
+# optional settings for the combinations:
+#   required_paths = ['S.Fe.1']  labels of the paths always included
+#   min_paths = 1                minimum number of paths in a combination
+#   max_paths = 4                maximum number of paths in a combination
+#   subset_workers = 4           processes used (all cpus by default)
+#   subset_search = all          all combinations, or stepwise (adds the
+#                                path that improves the fit most each step)
+#   max_subsets = 4096           largest number of combinations for all
+
+def single_file_paths(a_file, gds_parms_f, sel_paths_f, fit_vars, subset_vars, out_pattern):
+    # session object
+    session = Interpreter()
+    gds = fit_manager.read_gds(gds_parms_f, session)
+    logging.info("GDS Parameters read OK")
+    data_prj = athenamgr.read_project(a_file)
+    group_keys = list(data_prj._athena_groups.keys())
+    athena_group = extract_athenagroup(data_prj._athena_groups[group_keys[0]])
+
+    # create the path for storing results
+    base_path = Path("./" , out_pattern+"_fit")
+    Path(base_path).mkdir(parents=True, exist_ok=True)
+
+    data_group = athenamgr.calc_with_defaults(athena_group)
+    selected_paths = fit_manager.read_selected_paths_list(sel_paths_f, session)
+    logging.info("Selected Paths read from " + sel_paths_f + " OK")
+
+    with tracing.span('subsets', 'task', file=group_keys[0]):
+        results = path_subsets.fit_path_subsets(data_group, gds, selected_paths, fit_vars, session,
+                                                required=subset_vars['required'],
+                                                min_paths=subset_vars['min_paths'],
+                                                max_paths=subset_vars['max_paths'],
+                                                workers=subset_vars['workers'],
+                                                search=subset_vars['search'],
+                                                max_subsets=subset_vars['max_subsets'])
+    paths_file = Path("./",base_path,group_keys[0]+"_paths.csv")
+    path_subsets.save_subsets(results, paths_file)
+    if len(results) > 0:
+        logging.info("Best paths for " + group_keys[0] + ": " + ' '.join(results[0]['paths']))
+    logging.info("Tested " + str(len(results)) + " combinations of paths for: " + group_keys[0])
+
+def read_ini(ini_file_path):
+    ini_file = Path(ini_file_path)
+    if not ini_file.exists():
+        print("invalid or non existent ini file")
+        raise NameError('IniFileError')
+    print ("reading from",ini_file)
+    fit_config = configparser.ConfigParser()
+    fit_config.read(ini_file)
+    fit_vars = {}
+    fit_vars['fitspace']=fit_config['DEFAULT']["fitspace"]
+    fit_vars['kmin']= int(fit_config['DEFAULT']["kmin"])
+    fit_vars['kmax']=int(fit_config['DEFAULT']["kmax"])
+    fit_vars['kw']=int(fit_config['DEFAULT']["kw"])
+    fit_vars['dk']=int(fit_config['DEFAULT']["dk"])
+    fit_vars['window']=fit_config['DEFAULT']["window"]
+    fit_vars['rmin']=float(fit_config['DEFAULT']["rmin"])
+    fit_vars['rmax']=float(fit_config['DEFAULT']["rmax"])
+    fit_vars['max_nfev']=fit_config['DEFAULT'].getint("fit_max_nfev", None)
+    subset_vars = {}
+    subset_vars['required']=ast.literal_eval(fit_config['DEFAULT'].get("required_paths", "[]"))
+    subset_vars['min_paths']=fit_config['DEFAULT'].getint("min_paths", 1)
+    subset_vars['max_paths']=fit_config['DEFAULT'].getint("max_paths", None)
+    subset_vars['workers']=fit_config['DEFAULT'].getint("subset_workers", None)
+    subset_vars['search']=fit_config['DEFAULT'].get("subset_search", "all")
+    subset_vars['max_subsets']=fit_config['DEFAULT'].getint("max_subsets", path_subsets.MAX_SUBSETS)
+    return fit_vars, subset_vars
+
+# do not run if only importing function(s)
+if __name__ == '__main__':
+  ini_file = sys.argv[1]
+  file_name = Path(sys.argv[2])
+  out_pattern = sys.argv[3]
+  gds_file = sys.argv[4]
+  selpaths_file = sys.argv[5]
+  fit_vars, subset_vars = read_ini(ini_file)
+  Path("./", out_pattern+"_fit").mkdir(parents=True, exist_ok=True)
+  batch_logging.set_logger(Path("./", out_pattern+"_fit", "paths.log"))
+  batch_logging.set_log_context(file=file_name.name)
+  single_file_paths(file_name, gds_file, selpaths_file, fit_vars, subset_vars, out_pattern)
+  tracing.finish_trace()
@@ -28,6 +28,12 @@ println "Task 01 process files in $params.data_dir using $params.athena_task and
 println "Task 02.01 generate paths from $params.crystal_files using $params.feff_task and output to dirs in $params.outdir"
 println "Task 02.02 fit paths to XAS spectra"
 
+// the trace of the run starts without the events of previous runs (only
+// when LARCH_TRACE is set to an absolute path)
+if (System.getenv('LARCH_TRACE')) {
+  file(System.getenv('LARCH_TRACE') + '.jsonl').delete()
+}
+
 process runAthena{
   output:
     file "*.prj" into athena_prjs
@@ -59,7 +65,9 @@ process runFit {
 
   output:
     file "**.txt"	
-    file "**.png"
+    file "**.png" optional true
+    file "**.csv" optional true
+    val apf into fits_done
 
   publishDir "$params.outdir", mode: 'copy', overwrite: true
   
@@ -68,3 +76,21 @@ process runFit {
   $params.app $params.fit_task $params.ini_file $apf $params.athena_dir $params.gds_file $params.sp_file
   """ 
 }
+
+// merge the tracing events of all the fits and print the stage timings of
+// the run (only when LARCH_TRACE is set to an absolute path)
+process mergeTrace {
+  input:
+    val fits from fits_done.collect()
+
+  when:
+    System.getenv('LARCH_TRACE')
+
+  echo true
+
+  script:
+  """
+  cd ${file(params.fit_task).parent}
+  $params.app -m lib.tracing ${System.getenv('LARCH_TRACE')}
+  """
+}